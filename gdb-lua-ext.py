@@ -7,8 +7,34 @@
 #   - glua_traceback [L]
 #   - glua_stackinfo [L [idx]]
 #   - glua_objectinfo [L]
-#   - glua_break [L] filename line_number
-#   - glua_breakr [L] regex line_number
+#   - glua_closures [-n top] [L]
+#   - glua_classes [-n top] [L]
+#   - glua_threads [-n top] [L]
+#   - glua_refs [-n top] [-s file] [-c file] [L]
+#   - glua_gcqueues [-n top] [L]
+#   - glua_gcstate [L]
+#   - glua_gctrace start [-f csv|jsonl] file | stop
+#   - glua_allocprof [-n top] [-e every] [-o file] [L] seconds
+#   - glua_watchmem [-k ticks] [-s every] [-n top] [-o file] [L] interval duration
+#   - glua_referrers [-n max] [L] address
+#   - glua_find [-n max] [L] key|keyre|string|number|address pattern
+#   - glua_modules [-n top] [-s] [L]
+#   - glua_dump value file [--depth N] [--format json|lua] [--max-string N] [--max-items N] [--state L]
+#   - glua_heapsnapshot [L] file
+#   - glua_export_sqlite [L] file
+#   - glua_break [-s] [L] filename line_number [if condition]
+#   - glua_breakr [-s] [L] regex line_number [if condition]
+#   - glua_break_func [L] name|filename:linedefined [if condition]
+#   - glua_lines [L] filename [line_number]
+#   - glua_breakpoints
+#   - glua_condition number [condition]
+#   - glua_ignore number count
+#   - glua_delete [number...]
+#   - glua_disasm closure|Proto*|CallInfo* [first[-last]]
+#   - glua_profile [-n] [-o file] [L] seconds hz
+#   - glua_hotspot [-n top] [-o file] [L] seconds hz
+#   - glua_perfcheck [-n top] [L]
+#   - glua_report [-L L] [-n top] [-o file] report...
 #
 # Utility functions:
 #   - $lua_getglobalstate(lua_State L) -> global_State*
@@ -26,6 +52,9 @@
 #   - $lua_getlocalname(lua_State L, int frame, int idx) -> string
 #   - $lua_getmetatable(TValue* v) -> Table*
 #
+# Frame filters:
+#   - glua (interleaves the Lua frames into 'bt')
+#
 # Pretty printers for:
 #   - TValue
 #   - TString
@@ -45,7 +74,24 @@ from __future__ import print_function  # for py2
 import os
 import re
 import sys
+import json
 import math
+import base64
+import codecs
+import array
+import heapq
+import bisect
+import struct
+import time
+import signal
+import threading
+
+from gdb.FrameDecorator import FrameDecorator
+
+try:
+    import sqlite3
+except ImportError:  # not every python embedded in gdb is built with it
+    sqlite3 = None
 
 print("GDB Lua5.3 Extension", file=sys.stderr)
 print("* To use this extension, you have to compile lua with debug symbols.", file=sys.stderr)
@@ -69,6 +115,8 @@ LUA_TFUNCTION = 6
 LUA_TUSERDATA = 7
 LUA_TTHREAD = 8
 
+LUA_TYPENAMES = ("nil", "boolean", "userdata", "number", "string", "table", "function", "userdata", "thread")
+
 LUA_NUMTAGS = 9
 LUA_TPROTO = LUA_NUMTAGS  # Function prototypes
 LUA_TDEADKEY = (LUA_NUMTAGS + 1)  # Removed keys in tables
@@ -101,6 +149,70 @@ def pointer_of(v):
     return gdb.Value(v.address).cast(t)
 
 
+def lua_ptrformat():
+    return "Q" if gdb.lookup_type("void").pointer().sizeof == 8 else "I"
+
+
+def lua_unpacktvalue(data, base, offsets):
+    # returns (tt, integer, float, pointer) of the TValue at 'base' in the bytes 'data'
+    value = base + offsets["value_"]
+    tt = struct.unpack_from("=i", data, base + offsets["tt_"])[0]
+    return (tt, struct.unpack_from("=q", data, value)[0], struct.unpack_from("=d", data, value)[0],
+            struct.unpack_from("=" + lua_ptrformat(), data, value)[0])
+
+
+def lua_readtvalues(ptr, count):
+    # reads a TValue array in one memory access, returns [(tt, integer, float, pointer)]
+    t = gdb.lookup_type("TValue")
+    offsets = dict((f.name, f.bitpos // 8) for f in t.fields())
+    data = bytes(gdb.selected_inferior().read_memory(long(ptr), count * t.sizeof))
+    return [lua_unpacktvalue(data, i * t.sizeof, offsets) for i in range(0, count)]
+
+
+def lua_readnodes(ptr, count):
+    # reads a Node array in one memory access, returns [(key, value)] of (tt, integer, float, pointer)
+    t = gdb.lookup_type("Node")
+    offsets = dict((f.name, f.bitpos // 8) for f in gdb.lookup_type("TValue").fields())
+    node_offsets = dict((f.name, f.bitpos // 8) for f in t.fields())
+    data = bytes(gdb.selected_inferior().read_memory(long(ptr), count * t.sizeof))
+    ret = []
+    for i in range(0, count):
+        base = i * t.sizeof
+        ret.append((lua_unpacktvalue(data, base + node_offsets["i_key"], offsets),
+                    lua_unpacktvalue(data, base + node_offsets["i_val"], offsets)))
+    return ret
+
+
+def lua_tableitems(t, limit=None):
+    # returns [(key, value)] of the non-nil slots of a Table*, as (tt, integer, float, pointer)
+    # with a 'limit', at most 'limit' slots are returned and the slots are read in chunks of 'limit'
+    ret = []
+    sizearray = int(t["sizearray"])
+    chunk = sizearray if limit is None else limit
+    for first in range(0, sizearray, max(1, chunk)):
+        for i, v in enumerate(lua_readtvalues(t["array"] + first, min(chunk, sizearray - first)), first):
+            if v[0] != LUA_TNIL:
+                ret.append(((LUA_TNUMINT, i + 1, float(i + 1), 0), v))
+                if len(ret) == limit:
+                    return ret
+    sizenode = 1 << int(t["lsizenode"])
+    chunk = sizenode if limit is None else limit
+    for first in range(0, sizenode, max(1, chunk)):
+        for k, v in lua_readnodes(t["node"] + first, min(chunk, sizenode - first)):
+            if v[0] != LUA_TNIL:
+                ret.append((k, v))
+                if len(ret) == limit:
+                    return ret
+    return ret
+
+
+def lua_readarray(ptr, count, fmt):
+    # reads 'count' items of the struct format 'fmt' in one memory access
+    size = struct.calcsize("=" + fmt)
+    data = gdb.selected_inferior().read_memory(long(ptr), count * size)
+    return struct.unpack("=%d%s" % (count, fmt), bytes(data))
+
+
 class TValueWrapper:
     def __init__(self, value):
         self.value = value
@@ -276,6 +388,9 @@ class TStringWrapper:
     def to_string(self):
         return self.get_buffer().string()
 
+    def to_bytes(self):
+        return bytes(gdb.selected_inferior().read_memory(long(self.get_buffer()), long(self.get_length())))
+
     def equals_to(self, s):
         s = s.encode("utf-8")
         l = self.get_length()
@@ -443,14 +558,39 @@ class CallInfoWrapper:
 
 
 LUAI_MAXSTACK = 15000
+EXTRA_STACK = 5
 LUA_REGISTRYINDEX = -LUAI_MAXSTACK - 1000
 LUA_MAXUPVAL = 255
 
 LUAI_HASHLIMIT = 5
 
+LUA_OK = 0
+LUA_YIELD = 1
+
 LUA_RIDX_MAINTHREAD = 1
 LUA_RIDX_GLOBALS = 2
 LUA_RIDX_LAST = LUA_RIDX_GLOBALS
+LUA_FREELIST_REF = 0  # 'freelist' of lauxlib.c
+
+LUA_GCS_PROPAGATE = 0
+LUA_GCS_ATOMIC = 1
+LUA_GCS_SWPALLGC = 2
+LUA_GCS_SWPFINOBJ = 3
+LUA_GCS_SWPTOBEFNZ = 4
+LUA_GCS_SWPEND = 5
+LUA_GCS_CALLFIN = 6
+LUA_GCS_PAUSE = 7
+LUA_GCS_NAMES = ("propagate", "atomic", "swpallgc", "swpfinobj", "swptobefnz", "swpend", "callfin", "pause")
+LUA_GCS_SWEEP_LISTS = {LUA_GCS_SWPALLGC: ("allgc", "finobj", "tobefnz"), LUA_GCS_SWPFINOBJ: ("finobj", "tobefnz"),
+                       LUA_GCS_SWPTOBEFNZ: ("tobefnz",)}
+
+KGC_NORMAL = 0
+KGC_EMERGENCY = 1
+
+STEPMULADJ = 200
+PAUSEADJ = 100
+
+LUA_LOADED_TABLE = "_LOADED"
 
 LUAI_MAXSHORTLEN = 40
 STRCACHE_N = 53
@@ -556,7 +696,8 @@ POS_C = (POS_A + SIZE_A)
 POS_B = (POS_C + SIZE_C)
 POS_Bx = POS_C
 POS_Ax = POS_A
-MAXARG_sBx = 2147483647  # INT_MAX
+MAXARG_Bx = (1 << SIZE_Bx) - 1
+MAXARG_sBx = MAXARG_Bx >> 1
 
 luaP_opmodes = [
     ((0 << 7) | (1 << 6) | (OP_MASK_ARG_R << 4) | (OP_MASK_ARG_N << 2) | OP_MODE_iABC),
@@ -818,17 +959,7 @@ def lua_rawget(t, key):
     if k.is_short_string():
         ts = k.get_tstring_value()
         assert ts["tt"] == LUA_TSHRSTR, "invalid key data"
-        n = t["node"][ts["hash"] & (nsz - 1)].address
-        while True:
-            gkey = TValueWrapper(n["i_key"]["tvk"])
-            if gkey.is_short_string() and gkey.get_tstring_value().address == ts.address:
-                return n["i_val"]
-            else:
-                nx = n["i_key"]["nk"]["next"]
-                if nx == 0:
-                    break
-                n += nx
-        return lua_nilobject()
+        return lua_rawgetshortstr(t, ts)
     elif k.is_integer():
         return lua_rawgeti(t, k.get_integer())
     elif k.is_nil():
@@ -872,6 +1003,34 @@ def lua_rawget(t, key):
     return lua_nilobject()
 
 
+def lua_rawgetshortstr(t, ts):
+    # short strings are interned, so the keys are compared by address
+    nsz = 1 << t["lsizenode"]
+    n = t["node"][ts["hash"] & (nsz - 1)].address
+    addr = long(ts)
+    while True:
+        gkey = TValueWrapper(n["i_key"]["tvk"])
+        if gkey.is_short_string() and long(gkey.get_tstring_value()) == addr:
+            return n["i_val"]
+        else:
+            nx = n["i_key"]["nk"]["next"]
+            if nx == 0:
+                break
+            n += nx
+    return lua_nilobject()
+
+
+def lua_rawgetlongstr(t, s):
+    # long strings are not interned, the keys of the hash part are compared by their content
+    tstring_ptr = gdb.lookup_type("TString").pointer()
+    for i, (k, v) in enumerate(lua_readnodes(t["node"], 1 << int(t["lsizenode"]))):
+        if (k[0] & 0x3F) == LUA_TLNGSTR and v[0] != LUA_TNIL:
+            ts = TStringWrapper(gdb.Value(k[3]).cast(tstring_ptr).dereference())
+            if ts.get_length() == len(s) and ts.to_bytes() == s:
+                return t["node"][i]["i_val"]
+    return lua_nilobject()
+
+
 def lua_rawgets(t, key):
     if t.type.unqualified().target().tag != "Table":
         t = TValueWrapper(t)
@@ -939,6 +1098,19 @@ def lua_getcachedstring(L, str):
     return None
 
 
+def lua_findshortstring(G, s):
+    # looks up the interned short string 's' (bytes) in the string table, returns TString* or None
+    if len(s) > LUAI_MAXSHORTLEN:
+        return None
+    h = lua_hashstring(bytearray(s), len(s), G["seed"])
+    ts = G["strt"]["hash"][h & (G["strt"]["size"] - 1)]
+    while ts:
+        if ts["shrlen"] == len(s) and TStringWrapper(ts.dereference()).to_bytes() == s:
+            return ts
+        ts = ts["u"]["hnext"]
+    return None
+
+
 def lua_getregistrytable(L):
     return lua_index2value(L, LUA_REGISTRYINDEX)
 
@@ -947,6 +1119,25 @@ def lua_getglobaltable(L):
     return lua_rawgeti(lua_getregistrytable(L), LUA_RIDX_GLOBALS)
 
 
+def lua_resolvefunction(L, name):
+    # resolves 'a.b.c' or 'a.b:c' through _G first, then package.loaded with the longest module name first
+    G = lua_getglobalstate(L)
+    parts = name.replace(":", ".").split(".")
+    v = lua_getglobaltable(L)
+    for key in parts:
+        v = lua_getfield(G, v, key)
+    if v is not None and TValueWrapper(v).is_function():
+        return v
+    loaded = lua_getfield(G, lua_getregistrytable(L), LUA_LOADED_TABLE)
+    for i in range(len(parts), 0, -1):
+        v = lua_getfield(G, loaded, ".".join(parts[0:i]))
+        for key in parts[i:]:
+            v = lua_getfield(G, v, key)
+        if v is not None and TValueWrapper(v).is_function():
+            return v
+    return None
+
+
 def lua_getstack(L, level):
     assert level >= 0, "invalid (negative) level"
     ci = L["ci"]
@@ -1120,9 +1311,13 @@ def lua_funcnamefromcode(L, ci):
     ciw = CallInfoWrapper(ci)
     p = TValueWrapper(ciw.get_func().dereference()).get_lua_closure_value()["p"]  # Calling function
     pc = ciw.get_current_pc()  # Calling instruction index
-    i = int(p["code"][pc])  # Calling instruction
     if ciw.is_hooked():
         return "?", "hook"
+    return lua_funcnamefrompc(L, p, pc)
+
+
+def lua_funcnamefrompc(L, p, pc):
+    i = int(p["code"][pc])  # Calling instruction
     opcode = lua_op_getcode(i)
     if opcode == OP_CALL or opcode == OP_TAILCALL:
         return lua_getobjname(p, pc, lua_op_getarga(i))
@@ -1276,6 +1471,1437 @@ def lua_getmetatable(obj):
     return None
 
 
+# Caches
+
+
+class StopCache(dict):
+    """A dict which is cleared as soon as the inferior resumes or exits.
+Everything read from the inferior while it is stopped can be kept here."""
+
+    instances = []
+
+    def __init__(self):
+        dict.__init__(self)
+        StopCache.instances.append(self)
+
+    @staticmethod
+    def invalidate(_event=None):
+        for cache in StopCache.instances:
+            cache.clear()
+
+
+callinfo_chain_cache = StopCache()
+
+
+def lua_getcallinfochain(L):
+    # returns [(CallInfo*, callstatus)] from L->ci down to base_ci (excluded)
+    key = long(L)
+    chain = callinfo_chain_cache.get(key)
+    if chain is None:
+        chain = []
+        base = L["base_ci"].address
+        ci = L["ci"]
+        while ci and ci != base:
+            chain.append((ci, int(ci["callstatus"])))
+            ci = ci["previous"]
+        callinfo_chain_cache[key] = chain
+    return chain
+
+
+short_string_cache = StopCache()
+
+
+def lua_internedstring(G, s):
+    # returns TString* of the short string 's' or None, cached until the inferior resumes
+    key = (long(G), s)
+    if key not in short_string_cache:
+        short_string_cache[key] = lua_findshortstring(G, s.encode("utf-8"))
+    return short_string_cache[key]
+
+
+def lua_getfield(G, v, key):
+    # v[key] for a TValue 'v' and a python key, returns None if 'v' is not a table or the key is not found
+    if v is None or not TValueWrapper(v).is_table():
+        return None
+    t = TValueWrapper(v).get_table_value()
+    if isinstance(key, bool) or key is None:
+        return None
+    elif isinstance(key, (int, long)):
+        ret = lua_rawgeti(t, key)
+    elif isinstance(key, float):
+        if math.floor(key) != key:
+            return None
+        ret = lua_rawgeti(t, long(key))
+    elif len(key.encode("utf-8")) > LUAI_MAXSHORTLEN:
+        ret = lua_rawgetlongstr(t, key.encode("utf-8"))
+    else:
+        ts = lua_internedstring(G, key)
+        if ts is None:  # not interned, no table has such a key
+            return None
+        ret = lua_rawgetshortstr(t, ts)
+    if ret is None or TValueWrapper(ret).is_nil():
+        return None
+    return ret
+
+
+# Heap walker
+
+
+LUA_OBJ_SHORT_STRING = "Short String"
+LUA_OBJ_LONG_STRING = "Long String"
+LUA_OBJ_USERDATA = "Userdata"
+LUA_OBJ_TABLE = "Table"
+LUA_OBJ_PROTO = "Prototype"
+LUA_OBJ_THREAD = "Coroutine"
+LUA_OBJ_C_CLOSURE = "C Closure"
+LUA_OBJ_LUA_CLOSURE = "Lua Closure"
+
+
+def lua_gcobjects(G, lists=("allgc",)):
+    # iterates GCUnion* on the gc lists of the global state
+    tu = gdb.lookup_type("union GCUnion").pointer()
+    for name in lists:
+        obj = G[name].cast(tu)
+        while obj:
+            yield obj
+            obj = obj["gc"]["next"].cast(tu)
+
+
+class LuaObjectSizer:
+    """Computes the memory used by a gc object, the same way as lmem.c allocates it."""
+
+    def __init__(self):
+        self.tvalue_sizeof = gdb.lookup_type("TValue").sizeof
+        self.tstring_sizeof = gdb.lookup_type("TString").sizeof
+        self.table_sizeof = gdb.lookup_type("Table").sizeof
+        self.userdata_sizeof = gdb.lookup_type("Udata").sizeof
+        self.proto_sizeof = gdb.lookup_type("Proto").sizeof
+        self.coroutine_sizeof = gdb.lookup_type("lua_State").sizeof
+        self.c_closure_sizeof = gdb.lookup_type("CClosure").sizeof
+        self.l_closure_sizeof = gdb.lookup_type("LClosure").sizeof
+        self.upval_sizeof = gdb.lookup_type("UpVal").sizeof
+        self.upval_ptr_sizeof = gdb.lookup_type("UpVal").pointer().sizeof
+        self.node_sizeof = gdb.lookup_type("Node").sizeof
+        self.instruction_sizeof = gdb.lookup_type("Instruction").sizeof
+        self.proto_ptr_sizeof = gdb.lookup_type("Proto").pointer().sizeof
+        self.int_sizeof = gdb.lookup_type("int").sizeof
+        self.locvar_sizeof = gdb.lookup_type("LocVar").sizeof
+        self.upvaldesc_sizeof = gdb.lookup_type("Upvaldesc").sizeof
+        self.callinfo_sizeof = gdb.lookup_type("CallInfo").sizeof
+
+    def size(self, obj):
+        # returns (kind, bytes) of a GCUnion*, or (None, 0) for unknown objects
+        tag = obj["gc"]["tt"]
+        tnov = tag & 0x0F
+        if tnov == LUA_TSTRING:
+            ts = TStringWrapper(obj["ts"])
+            if tag == LUA_TSHRSTR:
+                return LUA_OBJ_SHORT_STRING, ts.get_length() + self.tstring_sizeof
+            return LUA_OBJ_LONG_STRING, ts.get_length() + self.tstring_sizeof
+        elif tnov == LUA_TUSERDATA:
+            us = UDataWrapper(obj["u"])
+            return LUA_OBJ_USERDATA, us.get_length() + self.userdata_sizeof
+        elif tnov == LUA_TFUNCTION:
+            cl = obj["cl"]
+            if tag == LUA_TCCL:
+                upvalues = max(1, int(cl["c"]["nupvalues"]))
+                return LUA_OBJ_C_CLOSURE, self.tvalue_sizeof * (upvalues - 1) + self.c_closure_sizeof
+            upvalues = max(1, int(cl["l"]["nupvalues"]))
+            # sizeLclosure, the upvalue slots are UpVal pointers, the UpVals are allocated apart
+            return LUA_OBJ_LUA_CLOSURE, self.upval_ptr_sizeof * (upvalues - 1) + self.l_closure_sizeof
+        elif tnov == LUA_TTABLE:
+            table = obj["h"]
+            array_count = table["sizearray"]
+            node_count = (1 << int(table["lsizenode"]))
+            sz = self.tvalue_sizeof * array_count + self.table_sizeof
+            if table["lastfree"]:
+                sz += self.node_sizeof * node_count
+            return LUA_OBJ_TABLE, sz
+        elif tnov == LUA_TPROTO:
+            f = obj["p"]
+            sz = f["sizecode"] * self.instruction_sizeof + f["sizep"] * self.proto_ptr_sizeof + \
+                f["sizek"] * self.tvalue_sizeof + f["sizelineinfo"] * self.int_sizeof + \
+                f["sizelocvars"] * self.locvar_sizeof + f["sizeupvalues"] * self.upvaldesc_sizeof
+            return LUA_OBJ_PROTO, sz + self.proto_sizeof
+        elif tnov == LUA_TTHREAD:
+            # CallInfo Chain
+            th = obj["th"]
+            ci = th["base_ci"]
+            sz = 0
+            while ci:
+                sz += self.callinfo_sizeof
+                ci = ci["next"]
+            sz += th["stacksize"] * self.tvalue_sizeof
+            return LUA_OBJ_THREAD, sz + self.coroutine_sizeof
+        return None, 0
+
+
+def lua_objectstatistic(G):
+    # returns ({kind: [count, bytes]}, total count)
+    sizer = LuaObjectSizer()
+    stat = {}
+    cnt = 0
+    for obj in lua_gcobjects(G):
+        kind, sz = sizer.size(obj)
+        if kind is not None:
+            item = stat.setdefault(kind, [0, 0])
+            item[0] += 1
+            item[1] += long(sz)
+        cnt += 1
+    return stat, cnt
+
+
+def lua_gcheaders(G, lists=("allgc",)):
+    # iterates (address, tt) on the gc lists, reads only the raw CommonHeader, much cheaper than lua_gcobjects
+    t = gdb.lookup_type("struct GCObject")
+    offsets = dict((f.name, f.bitpos // 8) for f in t.fields())
+    ptrfmt = "=" + lua_ptrformat()
+    size = max(offsets["next"] + struct.calcsize(ptrfmt), offsets["tt"] + 1)
+    inferior = gdb.selected_inferior()
+    for name in lists:
+        addr = long(G[name])
+        while addr != 0:
+            data = bytes(inferior.read_memory(addr, size))
+            yield addr, struct.unpack_from("=B", data, offsets["tt"])[0]
+            addr = struct.unpack_from(ptrfmt, data, offsets["next"])[0]
+
+
+def lua_sampledcensus(G, every):
+    # returns ({(kind, metatable): [count, bytes]}, total count), only every 'every'-th object is inspected
+    sizer = LuaObjectSizer()
+    tu = gdb.lookup_type("union GCUnion").pointer()
+    census = {}
+    cnt = 0
+    for addr, tt in lua_gcheaders(G, ("allgc", "finobj")):
+        cnt += 1
+        if cnt % every != 0:
+            continue
+        obj = gdb.Value(addr).cast(tu)
+        kind, sz = sizer.size(obj)
+        if kind is None:
+            continue
+        mt = 0
+        if (tt & 0x0F) == LUA_TTABLE:
+            mt = long(obj["h"]["metatable"])
+        elif (tt & 0x0F) == LUA_TUSERDATA:
+            mt = long(obj["u"]["metatable"])
+        item = census.setdefault((kind, mt), [0, 0])
+        item[0] += every
+        item[1] += long(sz) * every
+    return census, cnt
+
+
+def lua_closurecensus(G):
+    # returns {Proto*: [closures, closure bytes, upvalues, upvalue bytes]} of the live Lua closures,
+    # an upvalue shared by several closures is counted once, for the first closure visited
+    sizer = LuaObjectSizer()
+    ptrfmt = lua_ptrformat()
+    upvalues = set()
+    census = {}
+    for obj in lua_gcobjects(G):
+        if obj["gc"]["tt"] != LUA_TLCL:
+            continue
+        _, sz = sizer.size(obj)
+        cl = obj["cl"]["l"]
+        item = census.setdefault(long(cl["p"]), [0, 0, 0, 0])
+        item[0] += 1
+        item[1] += long(sz)
+        n = int(cl["nupvalues"])
+        if n > 0:
+            for uv in lua_readarray(cl["upvals"].address, n, ptrfmt):
+                if uv != 0 and uv not in upvalues:
+                    upvalues.add(uv)
+                    item[2] += 1
+                    item[3] += sizer.upval_sizeof
+    return census
+
+
+def lua_classcensus(G):
+    # returns {metatable Table*: {kind: [count, bytes]}} of the tables and full userdata, 0 for no metatable
+    sizer = LuaObjectSizer()
+    census = {}
+    for obj in lua_gcobjects(G, ("allgc", "finobj")):
+        tnov = obj["gc"]["tt"] & 0x0F
+        if tnov == LUA_TTABLE:
+            mt = obj["h"]["metatable"]
+        elif tnov == LUA_TUSERDATA:
+            mt = obj["u"]["metatable"]
+        else:
+            continue
+        kind, sz = sizer.size(obj)
+        item = census.setdefault(long(mt), {}).setdefault(kind, [0, 0])
+        item[0] += 1
+        item[1] += long(sz)
+    return census
+
+
+def lua_threads(G):
+    # yields lua_State* of the main thread and all the coroutines
+    yield G["mainthread"]
+    for obj in lua_gcobjects(G):
+        if (obj["gc"]["tt"] & 0x0F) == LUA_TTHREAD:
+            yield obj["th"].address
+
+
+def lua_threadinfo(L, running=None):
+    # returns the stack and CallInfo usage of a lua_State, the status is named as coroutine.status does
+    tvalue_sizeof = gdb.lookup_type("TValue").sizeof
+    chain = lua_getcallinfochain(L)
+    stack = long(L["stack"])
+    top = long(L["top"])
+    status = int(L["status"])
+    if status == LUA_YIELD:
+        status_name = "suspended"
+    elif status != LUA_OK:
+        status_name = "dead"
+    elif len(chain) > 0:
+        status_name = "running" if running is not None and long(L) == long(running) else "normal"
+    elif top == long(L["ci"]["func"]) + tvalue_sizeof:
+        status_name = "dead"
+    else:
+        status_name = "suspended"
+
+    # the same as stackinuse() and luaD_shrinkstack() in ldo.c
+    lim = max([top, long(L["base_ci"]["top"])] + [long(ci["top"]) for ci, _ in chain])
+    inuse = (lim - stack) // tvalue_sizeof + 1
+    goodsize = inuse + inuse // 8 + 2 * EXTRA_STACK
+    stacksize = int(L["stacksize"])
+
+    upvalues = 0
+    uv = L["openupval"]
+    while uv:
+        upvalues += 1
+        uv = uv["u"]["open"]["next"]
+
+    current = "-"
+    for ci, callstatus in chain:
+        if (callstatus & CIST_LUA) != 0:
+            current = str(lua_getinfo(L, "Sl", ci.dereference()))
+            break
+    else:
+        if len(chain) > 0:
+            current = str(lua_getinfo(L, "Sl", chain[0][0].dereference()))
+
+    return {
+        "address": long(L),
+        "status": status_name,
+        "stacksize": stacksize,
+        "used": (top - stack) // tvalue_sizeof,
+        "spare_bytes": max(0, stacksize - goodsize) * tvalue_sizeof,
+        "callinfo": int(L["nci"]),
+        "depth": len(chain),
+        "spare_callinfo_bytes": (int(L["nci"]) - len(chain)) * gdb.lookup_type("CallInfo").sizeof,
+        "open_upvalues": upvalues,
+        "function": current,
+    }
+
+
+class LuaClassNames:
+    """Names the metatables by their '__name' field, or by the registry key, the global, the module or the field of
+a global or a module holding them. The names are kept until the inferior resumes."""
+
+    cache = StopCache()  # global_State* -> LuaClassNames
+
+    def __init__(self, G):
+        self.G = G
+        self.names = {}  # Table* -> name
+        self.holders = None  # Table* -> name, by reverse lookup
+        self.tstring_ptr = gdb.lookup_type("TString").pointer()
+        self.table_ptr = gdb.lookup_type("Table").pointer()
+
+    @staticmethod
+    def get(G):
+        key = long(G)
+        names = LuaClassNames.cache.get(key)
+        if names is None:
+            names = LuaClassNames(G)
+            LuaClassNames.cache[key] = names
+        return names
+
+    def string(self, ptr):
+        return TStringWrapper(gdb.Value(ptr).cast(self.tstring_ptr).dereference()).to_string()
+
+    def fields(self, t):
+        # yields (name, Table*) of the string keys holding a table
+        for k, v in lua_tableitems(gdb.Value(t).cast(self.table_ptr)):
+            if (k[0] & 0x0F) == LUA_TSTRING and (v[0] & 0x0F) == LUA_TTABLE:
+                yield self.string(k[3]), v[3]
+
+    def build(self):
+        holders = {}
+        registry = TValueWrapper(self.G["l_registry"]).get_table_value()
+        globals_table = None
+        loaded = None
+        for k, v in lua_tableitems(registry):
+            if (v[0] & 0x0F) != LUA_TTABLE:
+                continue
+            if (k[0] & 0x0F) == LUA_TNUMBER and k[1] == LUA_RIDX_GLOBALS:
+                globals_table = v[3]
+            elif (k[0] & 0x0F) == LUA_TSTRING:
+                name = self.string(k[3])
+                if name == LUA_LOADED_TABLE:
+                    loaded = v[3]
+                holders.setdefault(v[3], "registry.%s" % name)
+        containers = []
+        for t in (globals_table, loaded):
+            if t is not None:
+                for name, v in self.fields(t):
+                    holders.setdefault(v, name)
+                    containers.append((name, v))
+        for container, t in containers:
+            for name, v in self.fields(t):
+                holders.setdefault(v, "%s.%s" % (container, name))
+        return holders
+
+    def name(self, mt):
+        if mt == 0:
+            return "(none)"
+        name = self.names.get(mt)
+        if name is not None:
+            return name
+        ts = lua_internedstring(self.G, "__name")
+        v = lua_rawgetshortstr(gdb.Value(mt).cast(self.table_ptr), ts) if ts is not None else None
+        if v is not None and TValueWrapper(v).is_string():
+            name = TStringWrapper(TValueWrapper(v).get_tstring_value().dereference()).to_string()
+        else:
+            if self.holders is None:
+                self.holders = self.build()
+            name = self.holders.get(mt, "(Table *) 0x%x" % mt)
+        self.names[mt] = name
+        return name
+
+
+LUA_GRAY_LISTS = ("weak", "ephemeron", "allweak")
+LUA_FINALIZER_LISTS = ("finobj", "tobefnz")
+
+
+def lua_graylist(G, name):
+    # iterates GCUnion* on a list linked by 'gclist', only tables are found in the weak, ephemeron and allweak lists
+    tu = gdb.lookup_type("union GCUnion").pointer()
+    obj = G[name].cast(tu)
+    while obj:
+        yield obj
+        obj = obj["h"]["gclist"].cast(tu)
+
+
+table_mode_cache = StopCache()
+
+
+def lua_tablemode(G, mt):
+    # returns the __mode of a metatable or None, cached until the inferior resumes
+    key = long(mt)
+    if key not in table_mode_cache:
+        mode = None
+        if (int(mt["flags"]) & (1 << TM_MODE)) == 0:  # __mode is not cached as absent
+            ts = lua_internedstring(G, "__mode")
+            v = lua_rawgetshortstr(mt, ts) if ts is not None else None
+            if v is not None and TValueWrapper(v).is_string():
+                mode = TStringWrapper(TValueWrapper(v).get_tstring_value().dereference()).to_string()
+        table_mode_cache[key] = mode
+    return table_mode_cache[key]
+
+
+def lua_gcqueues(G):
+    # returns ({list: {kind: [count, bytes]}}, {Table*: (mode, bytes, entries)}) of the gc lists and the weak tables
+    sizer = LuaObjectSizer()
+    lists = {}
+    weak = {}
+    for name in LUA_GRAY_LISTS:
+        stat = lists.setdefault(name, {})
+        for obj in lua_graylist(G, name):
+            kind, sz = sizer.size(obj)
+            if kind is None:
+                continue
+            item = stat.setdefault(kind, [0, 0])
+            item[0] += 1
+            item[1] += long(sz)
+    for name in ("allgc",) + LUA_FINALIZER_LISTS:
+        stat = lists.setdefault(name, {})
+        for obj in lua_gcobjects(G, (name,)):
+            kind, sz = sizer.size(obj)
+            if kind is None:
+                continue
+            if name != "allgc":
+                item = stat.setdefault(kind, [0, 0])
+                item[0] += 1
+                item[1] += long(sz)
+            if kind == LUA_OBJ_TABLE and obj["h"]["metatable"]:
+                mode = lua_tablemode(G, obj["h"]["metatable"])
+                if mode is not None and ("k" in mode or "v" in mode):
+                    entries = len(lua_tableitems(obj["h"].address))
+                    weak[long(obj)] = (mode, long(sz), entries)
+    del lists["allgc"]
+    return lists, weak
+
+
+def lua_gcstate(G):
+    # decodes the collector state and predicts the allocation left before the next step and the end of the cycle
+    state = int(G["gcstate"])
+    totalbytes = long(G["totalbytes"])
+    debt = long(G["GCdebt"])
+    estimate = long(G["GCestimate"])
+    stepmul = int(G["gcstepmul"])
+    ret = {
+        "gcstate": LUA_GCS_NAMES[state] if 0 <= state < len(LUA_GCS_NAMES) else str(state),
+        "gckind": "emergency" if int(G["gckind"]) == KGC_EMERGENCY else "normal",
+        "gcrunning": int(G["gcrunning"]) != 0,
+        "totalbytes": totalbytes,
+        "GCdebt": debt,
+        "GCestimate": estimate,
+        "gcpause": int(G["gcpause"]),
+        "gcstepmul": stepmul,
+        "heap_bytes": totalbytes + debt,  # gettotalbytes()
+        "next_step_bytes": max(0, -debt),
+        "pause_threshold": estimate // PAUSEADJ * int(G["gcpause"]),  # setpause()
+    }
+
+    # the same costs as singlestep() in lgc.c, 'stepmul' units of work are done per STEPMULADJ bytes of allocation
+    sweep_cost = (gdb.lookup_type("TString").sizeof + 4) // 4  # GCSWEEPCOST
+    work = 0
+    if state in (LUA_GCS_PAUSE, LUA_GCS_PROPAGATE):
+        work += estimate  # the live data of the last cycle is an upper bound of what is left to traverse
+    sweep_lists = LUA_GCS_SWEEP_LISTS.get(state)
+    if sweep_lists is not None:
+        tu = gdb.lookup_type("union GCUnion").pointer()
+        left = 0
+        obj = G["sweepgc"].dereference().cast(tu) if G["sweepgc"] else None
+        while obj:
+            left += 1
+            obj = obj["gc"]["next"].cast(tu)
+        for name in sweep_lists[1:]:
+            left += sum(1 for _ in lua_gcobjects(G, (name,)))
+        ret["sweep_list"] = sweep_lists[0]
+        ret["sweep_left"] = left
+        work += left * sweep_cost
+    cycle = work * STEPMULADJ // max(1, stepmul)
+    if state == LUA_GCS_PAUSE:
+        cycle += ret["next_step_bytes"]
+    ret["cycle_bytes"] = cycle if ret["gcrunning"] else None
+    return ret
+
+
+class LuaValueCategory:
+    """Describes a value read by lua_readtvalues by its type, its class for tables and userdata, and its source or
+C function for functions."""
+
+    def __init__(self, G):
+        self.names = LuaClassNames.get(G)
+        self.table_ptr = gdb.lookup_type("Table").pointer()
+        self.udata_ptr = gdb.lookup_type("Udata").pointer()
+        self.lclosure_ptr = gdb.lookup_type("LClosure").pointer()
+        self.cclosure_ptr = gdb.lookup_type("CClosure").pointer()
+        self.functions = {}  # address -> description
+
+    def function(self, addr, describe):
+        ret = self.functions.get(addr)
+        if ret is None:
+            ret = describe()
+            self.functions[addr] = ret
+        return ret
+
+    def get(self, v):
+        tt, _, _, ptr = v
+        tnov = tt & 0x0F
+        if tt == LUA_TTABLE | BIT_ISCOLLECTABLE:
+            return "table %s" % self.names.name(long(gdb.Value(ptr).cast(self.table_ptr)["metatable"]))
+        elif tt == LUA_TUSERDATA | BIT_ISCOLLECTABLE:
+            return "userdata %s" % self.names.name(long(gdb.Value(ptr).cast(self.udata_ptr)["metatable"]))
+        elif tt == LUA_TLCL | BIT_ISCOLLECTABLE:
+            def describe():
+                p = gdb.Value(ptr).cast(self.lclosure_ptr)["p"]
+                src = TStringWrapper(p["source"].dereference()).to_string() if p["source"] else "=?"
+                return "function %s:%d" % (lua_chunkid(src, LUA_IDSIZE), int(p["linedefined"]))
+            return self.function(ptr, describe)
+        elif tt == LUA_TCCL | BIT_ISCOLLECTABLE:
+            return self.function(ptr, lambda: "function [C] %s" % lua_pcsymbol(
+                long(gdb.Value(ptr).cast(self.cclosure_ptr)["f"])))
+        elif tt == LUA_TLCF:
+            return self.function(ptr, lambda: "function [C] %s" % lua_pcsymbol(ptr))
+        return LUA_TYPENAMES[tnov] if tnov < len(LUA_TYPENAMES) else "?"
+
+
+def lua_registryrefs(G):
+    # returns ({ref: value}, [free refs]) of the luaL_ref references of the registry
+    registry = TValueWrapper(G["l_registry"]).get_table_value()
+    refs = {}
+    for k, v in lua_tableitems(registry):
+        if k[0] == LUA_TNUMINT and (k[1] == LUA_FREELIST_REF or k[1] > LUA_RIDX_LAST):
+            refs[k[1]] = v
+    free = []
+    visited = set()
+    head = refs.pop(LUA_FREELIST_REF, None)
+    ref = head[1] if head is not None and head[0] == LUA_TNUMINT else 0
+    while ref != 0 and ref not in visited:  # the last free slot holds nil
+        visited.add(ref)
+        free.append(ref)
+        v = refs.pop(ref, None)
+        ref = v[1] if v is not None and v[0] == LUA_TNUMINT else 0
+    return refs, free
+
+
+# Heap graph
+
+
+LUA_OBJ_CTYPES = {
+    LUA_OBJ_SHORT_STRING: "TString",
+    LUA_OBJ_LONG_STRING: "TString",
+    LUA_OBJ_USERDATA: "Udata",
+    LUA_OBJ_TABLE: "Table",
+    LUA_OBJ_PROTO: "Proto",
+    LUA_OBJ_THREAD: "lua_State",
+    LUA_OBJ_C_CLOSURE: "CClosure",
+    LUA_OBJ_LUA_CLOSURE: "LClosure",
+}
+
+
+LUA_EDGE_TYPES = ("context", "element", "property", "internal", "hidden", "shortcut", "weak")  # the same as V8
+LUA_EDGE_CONTEXT = 0  # upvalue
+LUA_EDGE_ELEMENT = 1  # integer key
+LUA_EDGE_PROPERTY = 2  # string key
+LUA_EDGE_INTERNAL = 3
+LUA_EDGE_WEAK = 6  # weak key or value of a table, strings are never removed from the weak tables
+LUA_EDGE_WEAK_LABEL = (LUA_EDGE_WEAK, None)
+
+
+class LuaHeapEdges:
+    """Enumerates the references from a gc object to the other gc objects, reading the arrays in bulk.
+The labels are (edge type, name) and only built on request, they are not needed to build the indexes. Without them
+the weak references are still told apart by LUA_EDGE_WEAK_LABEL, the others have None."""
+
+    def __init__(self, G):
+        self.G = G
+        self.ptrfmt = lua_ptrformat()
+        self.tvalue_sizeof = gdb.lookup_type("TValue").sizeof
+        self.tstring_ptr = gdb.lookup_type("TString").pointer()
+        self.strings = {}  # TString* -> str of the keys
+
+    def string(self, ptr):
+        ret = self.strings.get(ptr)
+        if ret is None:
+            ret = TStringWrapper(gdb.Value(ptr).cast(self.tstring_ptr).dereference()).to_bytes() \
+                .decode("utf-8", "replace")
+            self.strings[ptr] = ret
+        return ret
+
+    def pointers(self, ptr, n, field):
+        # reads the pointer 'field' of the 'n' structs at 'ptr' in one memory access
+        t = ptr.type.target().strip_typedefs()
+        offset = [f.bitpos // 8 for f in t.fields() if f.name == field][0]
+        data = bytes(gdb.selected_inferior().read_memory(long(ptr), n * t.sizeof))
+        return [struct.unpack_from("=" + self.ptrfmt, data, i * t.sizeof + offset)[0] for i in range(0, n)]
+
+    def key_label(self, k):
+        tnov = k[0] & 0x0F
+        if tnov == LUA_TSTRING:
+            return "[%s]" % lua_quotestring(TStringWrapper(gdb.Value(k[3]).cast(self.tstring_ptr).dereference())
+                                            .to_bytes())
+        elif k[0] == LUA_TNUMINT:
+            return "[%d]" % k[1]
+        elif k[0] == LUA_TNUMFLT:
+            return "[%.14g]" % k[2]
+        elif tnov == LUA_TBOOLEAN:
+            return "[%s]" % ("true" if k[1] & 0xFFFFFFFF else "false")
+        return "[%s: 0x%x]" % (LUA_TYPENAMES[tnov] if tnov < len(LUA_TYPENAMES) else "?", k[3])
+
+    def value_label(self, k):
+        if (k[0] & 0x0F) == LUA_TSTRING:
+            return LUA_EDGE_PROPERTY, self.string(k[3])
+        elif k[0] == LUA_TNUMINT:
+            return LUA_EDGE_ELEMENT, k[1]
+        return LUA_EDGE_INTERNAL, self.key_label(k)
+
+    @staticmethod
+    def label_text(label):
+        edge_type, name = label
+        if edge_type == LUA_EDGE_PROPERTY:
+            return "[%s]" % lua_quotestring(name.encode("utf-8"))
+        elif edge_type == LUA_EDGE_ELEMENT:
+            return "[%d]" % name
+        elif edge_type == LUA_EDGE_CONTEXT:
+            return "upvalue '%s'" % name
+        elif edge_type == LUA_EDGE_WEAK:
+            return "%s (weak)" % name
+        return name
+
+    def edges(self, obj, labels=False):
+        # yields (target address, label or None) of a GCUnion*
+        tag = int(obj["gc"]["tt"])
+        tnov = tag & 0x0F
+        if tnov == LUA_TTABLE:
+            h = obj["h"]
+            mode = None
+            if h["metatable"]:
+                yield long(h["metatable"]), (LUA_EDGE_INTERNAL, "metatable") if labels else None
+                mode = lua_tablemode(self.G, h["metatable"])
+            weak_keys = mode is not None and "k" in mode
+            weak_values = mode is not None and "v" in mode
+            for k, v in lua_tableitems(h.address):
+                if k[0] & BIT_ISCOLLECTABLE:
+                    if weak_keys and (k[0] & 0x0F) != LUA_TSTRING:
+                        yield k[3], (LUA_EDGE_WEAK, "key %s" % self.key_label(k)) if labels else LUA_EDGE_WEAK_LABEL
+                    else:
+                        yield k[3], (LUA_EDGE_INTERNAL, "key %s" % self.key_label(k)) if labels else None
+                if v[0] & BIT_ISCOLLECTABLE:
+                    if weak_values and (v[0] & 0x0F) != LUA_TSTRING:
+                        yield v[3], (LUA_EDGE_WEAK, self.key_label(k)) if labels else LUA_EDGE_WEAK_LABEL
+                    else:
+                        yield v[3], self.value_label(k) if labels else None
+        elif tnov == LUA_TUSERDATA:
+            u = obj["u"]
+            if u["metatable"]:
+                yield long(u["metatable"]), (LUA_EDGE_INTERNAL, "metatable") if labels else None
+            if int(u["ttuv_"]) & BIT_ISCOLLECTABLE:
+                yield long(u["user_"]["gc"]), (LUA_EDGE_INTERNAL, "user value") if labels else None
+        elif tag == LUA_TLCL:
+            cl = obj["cl"]["l"]
+            p = cl["p"]
+            if p:
+                yield long(p), (LUA_EDGE_INTERNAL, "prototype") if labels else None
+            n = int(cl["nupvalues"])
+            for i, uv in enumerate(lua_readarray(cl["upvals"].address, n, self.ptrfmt) if n > 0 else ()):
+                if uv == 0:
+                    continue
+                v = lua_readtvalues(gdb.Value(uv).cast(cl["upvals"][0].type)["v"], 1)[0]
+                if v[0] & BIT_ISCOLLECTABLE:
+                    yield v[3], (LUA_EDGE_CONTEXT, lua_upvalname(p, i)) if labels else None
+        elif tag == LUA_TCCL:
+            cl = obj["cl"]["c"]
+            n = int(cl["nupvalues"])
+            for i, v in enumerate(lua_readtvalues(cl["upvalue"].address, n) if n > 0 else ()):
+                if v[0] & BIT_ISCOLLECTABLE:
+                    yield v[3], (LUA_EDGE_CONTEXT, "#%d" % (i + 1)) if labels else None
+        elif tnov == LUA_TPROTO:
+            f = obj["p"]
+            if f["source"]:
+                yield long(f["source"]), (LUA_EDGE_INTERNAL, "source") if labels else None
+            n = int(f["sizek"])
+            for i, k in enumerate(lua_readtvalues(f["k"], n) if n > 0 else ()):
+                if k[0] & BIT_ISCOLLECTABLE:
+                    yield k[3], (LUA_EDGE_INTERNAL, "constant #%d" % i) if labels else None
+            n = int(f["sizep"])
+            for i, child in enumerate(lua_readarray(f["p"], n, self.ptrfmt) if n > 0 else ()):
+                if child != 0:
+                    yield child, (LUA_EDGE_INTERNAL, "prototype #%d" % i) if labels else None
+            n = int(f["sizeupvalues"])
+            for i, name in enumerate(self.pointers(f["upvalues"], n, "name") if n > 0 and f["upvalues"] else ()):
+                if name != 0:
+                    yield name, (LUA_EDGE_INTERNAL, "upvalue name #%d" % i) if labels else None
+            n = int(f["sizelocvars"])
+            for i, name in enumerate(self.pointers(f["locvars"], n, "varname") if n > 0 and f["locvars"] else ()):
+                if name != 0:
+                    yield name, (LUA_EDGE_INTERNAL, "local name #%d" % i) if labels else None
+        elif tnov == LUA_TTHREAD:
+            th = obj["th"]
+            n = (long(th["top"]) - long(th["stack"])) // self.tvalue_sizeof
+            for i, v in enumerate(lua_readtvalues(th["stack"], n) if n > 0 else ()):
+                if v[0] & BIT_ISCOLLECTABLE:
+                    yield v[3], (LUA_EDGE_INTERNAL, "stack slot %d" % i) if labels else None
+
+
+def lua_heapobjects(G):
+    # iterates GCUnion* of all the objects linked in the gc lists, and the main thread which is not,
+    # 'fixedgc' holds the metamethod names and the reserved words which are never collected
+    tu = gdb.lookup_type("union GCUnion").pointer()
+    yield G["mainthread"].cast(tu)
+    for obj in lua_gcobjects(G, ("allgc", "finobj", "tobefnz", "fixedgc")):
+        yield obj
+
+
+LUA_FIND_MODES = ("key", "keyre", "string", "number", "address")
+
+
+class LuaTableMatcher:
+    """Matches the slots read by lua_tableitems. Short strings are interned, so the strings are compared by the
+address of their TString, only the long strings and the regular expressions need the strings to be decoded."""
+
+    def __init__(self, G, mode, pattern):
+        self.mode = mode
+        self.tstring_ptr = gdb.lookup_type("TString").pointer()
+        self.strings = {}  # TString* -> bytes or match result
+        self.ts = None
+        if mode in ("key", "string"):
+            self.pattern = pattern.encode("utf-8")
+            if len(self.pattern) <= LUAI_MAXSHORTLEN:
+                ts = lua_internedstring(G, pattern)
+                self.ts = long(ts) if ts is not None else 0  # not interned, nothing can match
+        elif mode == "keyre":
+            self.pattern = re.compile(pattern)
+        elif mode == "number":
+            try:
+                self.pattern = int(pattern, 0)
+            except ValueError:
+                self.pattern = float(pattern)  # 1 == 1.0 in python as in Lua
+        elif mode == "address":
+            self.pattern = long(gdb.parse_and_eval(pattern))
+        else:
+            raise gdb.GdbError("Unknown search %s" % mode)
+
+    def decode(self, ptr):
+        ret = self.strings.get(ptr)
+        if ret is None:
+            ret = TStringWrapper(gdb.Value(ptr).cast(self.tstring_ptr).dereference()).to_bytes()
+            if self.mode == "keyre":
+                ret = self.pattern.search(ret.decode("utf-8", "replace")) is not None
+            self.strings[ptr] = ret
+        return ret
+
+    def match_string(self, v):
+        if self.ts is not None:
+            return v[0] == LUA_TSHRSTR | BIT_ISCOLLECTABLE and v[3] == self.ts
+        return v[0] == LUA_TLNGSTR | BIT_ISCOLLECTABLE and self.decode(v[3]) == self.pattern
+
+    def match(self, k, v):
+        if self.mode == "key":
+            return self.match_string(k)
+        elif self.mode == "keyre":
+            return (k[0] & 0x0F) == LUA_TSTRING and self.decode(k[3])
+        elif self.mode == "string":
+            return self.match_string(v)
+        elif self.mode == "number":
+            return (v[0] == LUA_TNUMINT and v[1] == self.pattern) or (v[0] == LUA_TNUMFLT and v[2] == self.pattern)
+        return (v[0] & BIT_ISCOLLECTABLE and v[3] == self.pattern) or (k[0] & BIT_ISCOLLECTABLE and
+                                                                       k[3] == self.pattern)
+
+
+def lua_findtables(G, matcher):
+    # yields (Table*, key) of the slots matched in all the tables
+    for obj in lua_gcobjects(G, ("allgc", "finobj", "tobefnz")):
+        if (obj["gc"]["tt"] & 0x0F) != LUA_TTABLE:
+            continue
+        h = obj["h"].address
+        for k, v in lua_tableitems(h):
+            if matcher.match(k, v):
+                yield long(h), k
+
+
+LUA_OBJ_KINDS = (LUA_OBJ_SHORT_STRING, LUA_OBJ_LONG_STRING, LUA_OBJ_USERDATA, LUA_OBJ_TABLE, LUA_OBJ_PROTO,
+                 LUA_OBJ_THREAD, LUA_OBJ_C_CLOSURE, LUA_OBJ_LUA_CLOSURE)
+
+
+class LuaNodeNamer:
+    """Names the gc objects by their type and their class, source or C function, the strings by their content."""
+
+    def __init__(self, G, max_string=256):
+        self.max_string = max_string
+        self.classes = LuaClassNames.get(G)
+        self.functions = {}  # Proto* or lua_CFunction -> name
+
+    def proto(self, p):
+        key = long(p)
+        name = self.functions.get(key)
+        if name is None:
+            src = TStringWrapper(p["source"].dereference()).to_string() if p["source"] else "=?"
+            name = "%s:%d" % (lua_chunkid(src, LUA_IDSIZE), int(p["linedefined"]))
+            self.functions[key] = name
+        return name
+
+    def name(self, obj, kind):
+        if kind == LUA_OBJ_TABLE or kind == LUA_OBJ_USERDATA:
+            mt = long(obj["h"]["metatable"] if kind == LUA_OBJ_TABLE else obj["u"]["metatable"])
+            return "%s %s" % (kind, self.classes.name(mt)) if mt != 0 else kind
+        elif kind == LUA_OBJ_LUA_CLOSURE:
+            return "%s %s" % (kind, self.proto(obj["cl"]["l"]["p"]))
+        elif kind == LUA_OBJ_PROTO:
+            return "%s %s" % (kind, self.proto(obj["p"]))
+        elif kind == LUA_OBJ_C_CLOSURE:
+            f = long(obj["cl"]["c"]["f"])
+            name = self.functions.get(f)
+            if name is None:
+                name = lua_pcsymbol(f)
+                self.functions[f] = name
+            return "%s %s" % (kind, name)
+        elif kind == LUA_OBJ_SHORT_STRING or kind == LUA_OBJ_LONG_STRING:
+            ts = TStringWrapper(obj["ts"])
+            length = int(ts.get_length())
+            data = bytes(gdb.selected_inferior().read_memory(long(ts.get_buffer()), min(length, self.max_string)))
+            return data.decode("utf-8", "replace") + ("..." if length > self.max_string else "")
+        return kind
+
+
+class LuaHeapGraph:
+    """The whole heap as a compact graph: the nodes are numbered in the walking order, their addresses, kinds and
+sizes are kept in arrays, and the edges in the compressed sparse row form, 'offsets[i]:offsets[i + 1]' slices the
+node numbers referred by the node i out of 'edges'. It is built in one pass and kept until the inferior resumes.
+When 'describe' is set, the names of the nodes and the labels of the edges are kept too, as indexes of 'strings'
+except the integer keys of the element edges."""
+
+    cache = StopCache()  # global_State* -> LuaHeapGraph
+
+    def __init__(self, G, describe=False):
+        self.G = G
+        self.describe = describe
+        self.addresses = array.array("Q")
+        self.sizes = array.array("Q")
+        self.kinds = bytearray()  # index of LUA_OBJ_KINDS
+        self.offsets = array.array("Q", [0])
+        self.names = array.array("L")
+        self.edge_types = bytearray()  # index of LUA_EDGE_TYPES
+        self.weak = bytearray()  # 1 for the weak edges, kept without 'describe' too
+        self.labels = array.array("q")
+        self.strings = []
+        self.string_ids = {}
+        targets = array.array("Q")
+        sizer = LuaObjectSizer()
+        walker = LuaHeapEdges(G)
+        namer = LuaNodeNamer(G) if describe else None
+        kinds = dict((kind, i) for i, kind in enumerate(LUA_OBJ_KINDS))
+        for obj in lua_heapobjects(G):  # the strings are linked in the gc lists too
+            kind, sz = sizer.size(obj)
+            if kind is None:
+                continue
+            self.addresses.append(long(obj))
+            self.sizes.append(long(sz))
+            self.kinds.append(kinds[kind])
+            if describe:
+                self.names.append(self.string_id(namer.name(obj, kind)))
+            for target, label in walker.edges(obj, describe):
+                targets.append(target)
+                self.weak.append(1 if label is not None and label[0] == LUA_EDGE_WEAK else 0)
+                if describe:
+                    self.edge_types.append(label[0])
+                    self.labels.append(label[1] if label[0] == LUA_EDGE_ELEMENT else self.string_id(label[1]))
+            self.offsets.append(len(targets))
+
+        # the targets which are not walked are dropped as -1
+        self.order = array.array("L", sorted(range(0, len(self.addresses)), key=self.addresses.__getitem__))
+        self.sorted_addresses = array.array("Q", (self.addresses[i] for i in self.order))
+        for i in range(1, len(self.order)):
+            if self.sorted_addresses[i - 1] == self.sorted_addresses[i]:
+                raise gdb.GdbError("The object at 0x%x is linked twice in the gc lists, the heap may be corrupted."
+                                   % self.sorted_addresses[i])
+        self.edges = array.array("l", (self.node(target) for target in targets))
+
+    @staticmethod
+    def get(G, describe=False):
+        key = long(G)
+        graph = LuaHeapGraph.cache.get(key)
+        if graph is None or (describe and not graph.describe):
+            graph = LuaHeapGraph(G, describe)
+            LuaHeapGraph.cache[key] = graph
+        return graph
+
+    def string_id(self, s):
+        i = self.string_ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.strings.append(s)
+            self.string_ids[s] = i
+        return i
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def node(self, addr):
+        # returns the node number of an address or -1
+        i = bisect.bisect_left(self.sorted_addresses, addr)
+        if i < len(self.sorted_addresses) and self.sorted_addresses[i] == addr:
+            return self.order[i]
+        return -1
+
+    def children(self, i):
+        return self.edges[self.offsets[i]:self.offsets[i + 1]]
+
+
+LUA_MODULE_SHARED = -2
+
+
+def lua_modulememory(G):
+    # returns [(name, exclusive bytes, shared bytes, exclusive objects, reachable objects)] of package.loaded,
+    # the objects reachable from one module only are exclusive, the walk does not go through the other modules,
+    # the globals, package.loaded, the registry, the main thread and the weak references
+    graph = LuaHeapGraph.get(G)
+    registry = G["l_registry"].address
+    loaded = lua_getfield(G, registry, LUA_LOADED_TABLE)
+    if loaded is None:
+        raise gdb.GdbError("package.loaded is not found in the registry.")
+    loaded = TValueWrapper(loaded).get_table_value()
+    roots = [long(TValueWrapper(registry).get_table_value()), long(G["mainthread"]), long(loaded)]
+    globals_table = lua_getfield(G, registry, LUA_RIDX_GLOBALS)
+    if globals_table is not None:
+        roots.append(long(TValueWrapper(globals_table).get_gc_value()))
+
+    tstring_ptr = gdb.lookup_type("TString").pointer()
+    modules = []
+    for k, v in lua_tableitems(loaded):
+        i = graph.node(v[3]) if v[0] & BIT_ISCOLLECTABLE else -1
+        if i >= 0 and (k[0] & 0x0F) == LUA_TSTRING:
+            modules.append((TStringWrapper(gdb.Value(k[3]).cast(tstring_ptr).dereference()).to_string(), i))
+
+    n = len(graph)
+    stop = bytearray(n)
+    for addr in roots:
+        i = graph.node(addr)
+        if i >= 0:
+            stop[i] = 1
+    for _, i in modules:
+        stop[i] = 1
+
+    owner = array.array("l", [-1]) * n
+    visited = array.array("l", [-1]) * n  # the module which visited the node last
+    reach = []
+    for m, (_, root) in enumerate(modules):
+        objects = 0
+        sz = 0
+        visited[root] = m
+        stack = [root]
+        while len(stack) > 0:
+            i = stack.pop()
+            objects += 1
+            sz += graph.sizes[i]
+            if owner[i] == -1:
+                owner[i] = m
+            elif owner[i] != m:
+                owner[i] = LUA_MODULE_SHARED
+            for k in range(graph.offsets[i], graph.offsets[i + 1]):
+                j = graph.edges[k]
+                if j >= 0 and visited[j] != m and not stop[j] and not graph.weak[k]:
+                    visited[j] = m
+                    stack.append(j)
+        reach.append((objects, sz))
+
+    exclusive = [[0, 0] for _ in modules]
+    for i in range(0, n):
+        m = owner[i]
+        if m >= 0:
+            exclusive[m][0] += 1
+            exclusive[m][1] += graph.sizes[i]
+    return [(name, exclusive[m][1], reach[m][1] - exclusive[m][1], exclusive[m][0], reach[m][0])
+            for m, (name, _) in enumerate(modules)]
+
+
+class LuaReferrerIndex:
+    """Reverse adjacency of the heap, the edges are kept in two arrays sorted by the target address so that the
+referrers of an object are found by a binary search. It is built in one pass over the gc lists, which link the
+strings too, and kept until the inferior resumes."""
+
+    cache = StopCache()  # global_State* -> LuaReferrerIndex
+
+    def __init__(self, G):
+        self.G = G
+        targets = array.array("Q")
+        sources = array.array("Q")
+        walker = LuaHeapEdges(G)
+        self.objects = 0
+        for obj in lua_heapobjects(G):
+            self.objects += 1
+            source = long(obj)
+            for target, _ in walker.edges(obj):
+                targets.append(target)
+                sources.append(source)
+        order = sorted(range(0, len(targets)), key=targets.__getitem__)
+        self.targets = array.array("Q", (targets[i] for i in order))
+        self.sources = array.array("Q", (sources[i] for i in order))
+
+    @staticmethod
+    def get(G):
+        key = long(G)
+        index = LuaReferrerIndex.cache.get(key)
+        if index is None:
+            index = LuaReferrerIndex(G)
+            LuaReferrerIndex.cache[key] = index
+        return index
+
+    def referrers(self, addr):
+        # returns the distinct objects referring to 'addr'
+        lo = bisect.bisect_left(self.targets, addr)
+        hi = bisect.bisect_right(self.targets, addr, lo)
+        ret = []
+        seen = set()
+        for source in self.sources[lo:hi]:
+            if source not in seen:
+                seen.add(source)
+                ret.append(source)
+        return ret
+
+
+# Exporters
+
+
+LUA_DUMP_FORMATS = ("json", "lua")
+
+
+def lua_tovalue(v):
+    # returns (tt, integer, float, pointer) of a TValue, TValue* or Table*, as read by lua_readtvalues
+    type_name = str(v.type.strip_typedefs())
+    if re.match(r"^(struct )?(lua_TValue|TValue)$", type_name):
+        v = v.address
+        type_name += " *"
+    if re.match(r"^(struct )?(lua_TValue|TValue)\s*\*$", type_name):
+        return lua_readtvalues(v, 1)[0]
+    elif re.match(r"^(struct )?Table\s*\*$", type_name):
+        return LUA_TTABLE | BIT_ISCOLLECTABLE, 0, 0.0, long(v)
+    raise gdb.GdbError("A TValue, TValue* or Table* is expected.")
+
+
+class LuaValueDumper:
+    """Serializes a value and the tables reachable from it as JSON or a Lua chunk, chunk by chunk.
+A table met again is written as a reference to the id given on its first occurrence, the strings longer than
+'max_string' and the tables with more than 'max_items' entries are truncated, the tables are read 'max_items' slots
+at a time. The Lua chunk registers every table in 't' by its id, the shared tables are written as 't[id]' and the
+references to a table still being written, the cycles, are assigned after the root is built."""
+
+    def __init__(self, G, fmt, depth, max_string, max_items):
+        self.fmt = fmt
+        self.depth = depth
+        self.max_string = max_string
+        self.max_items = max_items
+        self.ids = {}  # Table* -> id
+        self.open = set()  # Table* being written
+        self.fixups = []  # (table id, key, referred table id) of the Lua chunk
+        self.names = LuaClassNames.get(G)
+        self.category = LuaValueCategory(G)
+        self.tstring_ptr = gdb.lookup_type("TString").pointer()
+        self.table_ptr = gdb.lookup_type("Table").pointer()
+
+    def string(self, ptr):
+        ts = TStringWrapper(gdb.Value(ptr).cast(self.tstring_ptr).dereference())
+        length = int(ts.get_length())
+        if length <= self.max_string:
+            return ts.to_bytes(), length
+        return bytes(gdb.selected_inferior().read_memory(long(ts.get_buffer()), self.max_string)), length
+
+    def json_string(self, data, length):
+        # the strings which are not valid UTF-8 are written as {"$bytes": base64}, a truncated string may end in the
+        # middle of a UTF-8 sequence which is dropped
+        try:
+            tag, text = "$string", json.dumps(codecs.getincrementaldecoder("utf-8")().decode(data, length == len(data)))
+        except UnicodeDecodeError:
+            tag, text = "$bytes", json.dumps(base64.b64encode(data).decode("ascii"))
+        if length > len(data):
+            return '{"%s": %s, "$length": %d}' % (tag, text, length)
+        return text if tag == "$string" else '{"$bytes": %s}' % text
+
+    def opaque(self, v):
+        # the values which can not be serialized
+        return "%s: 0x%x" % (self.category.get(v), v[3])
+
+    def scalar(self, v):
+        # returns the text of a non-table value
+        tt = v[0]
+        tnov = tt & 0x0F
+        if tnov == LUA_TNIL:
+            return "null" if self.fmt == "json" else "nil"
+        elif tnov == LUA_TBOOLEAN:
+            return "true" if v[1] & 0xFFFFFFFF else "false"
+        elif tt == LUA_TNUMINT:
+            return str(v[1])
+        elif tt == LUA_TNUMFLT:
+            f = v[2]
+            if f != f or f in (float("inf"), float("-inf")):
+                if self.fmt == "json":
+                    return json.dumps({"$number": repr(f)})
+                return "0/0" if f != f else ("1/0" if f > 0 else "-1/0")
+            text = "%.17g" % f
+            if self.fmt == "lua" and re.match(r"^-?\d+$", text):
+                text += ".0"
+            return text
+        elif tnov == LUA_TSTRING:
+            data, length = self.string(v[3])
+            if self.fmt == "json":
+                return self.json_string(data, length)
+            return lua_quotestring(data) + (" --[[%d bytes]]" % length if length > len(data) else "")
+        if self.fmt == "json":
+            return json.dumps({"$opaque": self.opaque(v)})
+        return "nil --[[%s]]" % self.opaque(v)
+
+    def key(self, k):
+        # returns the JSON member name of a string key or None, the keys which are not valid UTF-8 are left to
+        # '$entries'
+        if (k[0] & 0x0F) != LUA_TSTRING:
+            return None
+        data, length = self.string(k[3])
+        if length != len(data):
+            return None
+        try:
+            return json.dumps(data.decode("utf-8"))
+        except UnicodeDecodeError:
+            return None
+
+    def lua_key(self, k, depth):
+        # a Lua chunk can not write the opaque values and the tables too deep as keys, nil is not a valid key
+        tnov = k[0] & 0x0F
+        if k[0] == LUA_TTABLE | BIT_ISCOLLECTABLE:
+            return k[3] in self.ids or depth < self.depth
+        return tnov in (LUA_TBOOLEAN, LUA_TNUMBER, LUA_TSTRING)
+
+    def value(self, v, depth):
+        # yields the chunks of a value
+        if v[0] != LUA_TTABLE | BIT_ISCOLLECTABLE:
+            yield self.scalar(v)
+            return
+        addr = v[3]
+        if addr in self.ids:
+            yield '{"$ref": %d}' % self.ids[addr] if self.fmt == "json" else "t[%d]" % self.ids[addr]
+            return
+        if depth >= self.depth:
+            yield json.dumps({"$opaque": self.opaque(v), "$truncated": "depth"}) if self.fmt == "json" else \
+                "nil --[[%s, too deep]]" % self.opaque(v)
+            return
+        table_id = len(self.ids) + 1
+        self.ids[addr] = table_id
+        self.open.add(addr)
+        t = gdb.Value(addr).cast(self.table_ptr)
+        items = lua_tableitems(t, self.max_items + 1)
+        indent = "\n" + "  " * (depth + 1)
+        if self.fmt == "json":
+            yield '{"$id": %d' % table_id
+            mt = long(t["metatable"])
+            if mt != 0:
+                yield ', "$class": %s' % json.dumps(self.names.name(mt))
+            entries = []
+            for k, item in items[0:self.max_items]:
+                name = self.key(k)
+                if name is None:
+                    entries.append((k, item))
+                    continue
+                yield ",%s%s: " % (indent, name)
+                for chunk in self.value(item, depth + 1):
+                    yield chunk
+            if len(entries) > 0:
+                yield ',%s"$entries": [' % indent
+                for i, (k, item) in enumerate(entries):
+                    yield "%s[" % ("," if i > 0 else "")
+                    for chunk in self.value(k, depth + 1):
+                        yield chunk
+                    yield ", "
+                    for chunk in self.value(item, depth + 1):
+                        yield chunk
+                    yield "]"
+                yield "]"
+            if len(items) > self.max_items:
+                yield ',%s"$truncated": true' % indent
+            yield "}"
+        else:
+            yield "T(%d, {" % table_id
+            for k, item in items[0:self.max_items]:
+                if k[0] == LUA_TTABLE | BIT_ISCOLLECTABLE and k[3] in self.open:
+                    yield "%s-- an entry is skipped, its key is the table #%d being written" % (indent, self.ids[k[3]])
+                    continue
+                if not self.lua_key(k, depth + 1):
+                    yield "%s-- an entry is skipped, its key is %s" % (indent, self.opaque(k))
+                    continue
+                yield "%s[" % indent
+                for chunk in self.value(k, depth + 1):
+                    yield chunk
+                yield "] = "
+                if item[0] == LUA_TTABLE | BIT_ISCOLLECTABLE and item[3] in self.open:
+                    key = "t[%d]" % self.ids[k[3]] if k[0] == LUA_TTABLE | BIT_ISCOLLECTABLE else self.scalar(k)
+                    self.fixups.append((table_id, key, self.ids[item[3]]))
+                    yield "nil --[[ref #%d]]" % self.ids[item[3]]
+                else:
+                    for chunk in self.value(item, depth + 1):
+                        yield chunk
+                yield ","
+            if len(items) > self.max_items:
+                yield "%s-- more entries truncated" % indent
+            yield "\n" + "  " * depth + "})"
+        self.open.discard(addr)
+
+    def dump(self, v):
+        if self.fmt == "lua":
+            yield "local t = {}\nlocal function T(id, v)\n  t[id] = v\n  return v\nend\nlocal root = "
+        for chunk in self.value(v, 0):
+            yield chunk
+        yield "\n"
+        if self.fmt == "lua":
+            for table_id, key, ref in self.fixups:
+                yield "t[%d][%s] = t[%d]\n" % (table_id, key, ref)
+            yield "return root\n"
+
+
+LUA_SNAPSHOT_NODE_TYPES = ("hidden", "array", "string", "object", "code", "closure", "regexp", "number", "native",
+                           "synthetic", "concatenated string", "sliced string", "symbol", "bigint")
+LUA_SNAPSHOT_KIND_TYPES = {
+    LUA_OBJ_SHORT_STRING: "string",
+    LUA_OBJ_LONG_STRING: "string",
+    LUA_OBJ_USERDATA: "native",
+    LUA_OBJ_TABLE: "object",
+    LUA_OBJ_PROTO: "code",
+    LUA_OBJ_THREAD: "native",
+    LUA_OBJ_C_CLOSURE: "closure",
+    LUA_OBJ_LUA_CLOSURE: "closure",
+}
+LUA_SNAPSHOT_META = {
+    "node_fields": ["type", "name", "id", "self_size", "edge_count", "trace_node_id"],
+    "node_types": [list(LUA_SNAPSHOT_NODE_TYPES), "string", "number", "number", "number", "number"],
+    "edge_fields": ["type", "name_or_index", "to_node"],
+    "edge_types": [list(LUA_EDGE_TYPES), "string_or_number", "node"],
+    "trace_function_info_fields": ["function_id", "name", "script_name", "script_id", "line", "column"],
+    "trace_node_fields": ["id", "function_info_index", "count", "size", "children"],
+    "sample_fields": ["timestamp_us", "last_assigned_id"],
+    "location_fields": ["object_index", "script_id", "line", "column"],
+}
+LUA_SNAPSHOT_BATCH = 10000
+
+
+def lua_heapsnapshot(G):
+    # yields the chunks of a V8 .heapsnapshot of the heap, the node 0 is a synthetic root referring to the registry
+    # and the main thread, the node i of the heap graph is the node i + 1
+    graph = LuaHeapGraph.get(G, True)
+    node_fields = len(LUA_SNAPSHOT_META["node_fields"])
+    node_types = dict((kind, LUA_SNAPSHOT_NODE_TYPES.index(LUA_SNAPSHOT_KIND_TYPES[kind])) for kind in LUA_OBJ_KINDS)
+    roots = [(graph.string_id("registry"), graph.node(long(TValueWrapper(G["l_registry"]).get_table_value()))),
+             (graph.string_id("mainthread"), graph.node(long(G["mainthread"])))]
+    roots = [(name, i) for name, i in roots if i >= 0]
+    root_name = graph.string_id("(GC roots)")
+    n = len(graph)
+    edge_count = len(roots) + sum(1 for j in graph.edges if j >= 0)
+
+    yield '{"snapshot":{"meta":%s,"node_count":%d,"edge_count":%d,"trace_function_count":0},\n"nodes":[' % (
+        json.dumps(LUA_SNAPSHOT_META), n + 1, edge_count)
+    yield "%d,%d,1,0,%d,0" % (LUA_SNAPSHOT_NODE_TYPES.index("synthetic"), root_name, len(roots))
+    for first in range(0, n, LUA_SNAPSHOT_BATCH):
+        rows = []
+        for i in range(first, min(n, first + LUA_SNAPSHOT_BATCH)):
+            edges = sum(1 for j in graph.children(i) if j >= 0)
+            rows.append(",\n%d,%d,%d,%d,%d,0" % (node_types[LUA_OBJ_KINDS[graph.kinds[i]]], graph.names[i],
+                                                 i * 2 + 3, graph.sizes[i], edges))
+        yield "".join(rows)
+
+    yield '],\n"edges":['
+    written = 0  # the separator is written before every edge but the first one
+    rows = []
+    for name, i in roots:
+        rows.append("%s%d,%d,%d" % (",\n" if written > 0 else "", LUA_EDGE_INTERNAL, name, (i + 1) * node_fields))
+        written += 1
+    yield "".join(rows)
+    for first in range(0, n, LUA_SNAPSHOT_BATCH):
+        rows = []
+        for i in range(first, min(n, first + LUA_SNAPSHOT_BATCH)):
+            for k in range(graph.offsets[i], graph.offsets[i + 1]):
+                j = graph.edges[k]
+                if j >= 0:
+                    rows.append("%s%d,%d,%d" % (",\n" if written > 0 else "", graph.edge_types[k], graph.labels[k],
+                                                (j + 1) * node_fields))
+                    written += 1
+        yield "".join(rows)
+
+    yield '],\n"trace_function_infos":[],\n"trace_tree":[],\n"samples":[],\n"locations":[],\n"strings":['
+    for first in range(0, len(graph.strings), LUA_SNAPSHOT_BATCH):
+        batch = graph.strings[first:first + LUA_SNAPSHOT_BATCH]
+        yield ("," if first > 0 else "") + ",\n".join(json.dumps(string) for string in batch)
+    yield "]}\n"
+
+
+LUA_SQLITE_TABLES = (
+    "CREATE TABLE strings (id INTEGER PRIMARY KEY, value TEXT)",
+    "CREATE TABLE objects (id INTEGER PRIMARY KEY, address INTEGER, kind TEXT, size INTEGER, name INTEGER, "
+    "metatable INTEGER, mode TEXT)",
+    "CREATE TABLE edges (source INTEGER, target INTEGER, type TEXT, name INTEGER, idx INTEGER)",
+    "CREATE TABLE protos (id INTEGER PRIMARY KEY, source INTEGER, linedefined INTEGER, lastlinedefined INTEGER, "
+    "numparams INTEGER, is_vararg INTEGER, maxstacksize INTEGER, sizecode INTEGER, sizek INTEGER, sizep INTEGER, "
+    "sizeupvalues INTEGER)",
+)
+LUA_SQLITE_INDEXES = (
+    "CREATE INDEX strings_value ON strings (value)",
+    "CREATE UNIQUE INDEX objects_address ON objects (address)",
+    "CREATE INDEX objects_kind ON objects (kind)",
+    "CREATE INDEX objects_metatable ON objects (metatable)",
+    "CREATE INDEX edges_source ON edges (source)",
+    "CREATE INDEX edges_target ON edges (target)",
+    "CREATE INDEX edges_name ON edges (name)",
+    "CREATE INDEX protos_source ON protos (source, linedefined)",
+)
+LUA_SQLITE_BATCH = 10000
+
+
+def lua_batches(rows, n=LUA_SQLITE_BATCH):
+    # yields the lists of at most n rows
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def lua_exportsqlite(G, conn):
+    # writes the heap graph into the strings, objects, edges and protos tables in one transaction, the objects are
+    # numbered as the nodes of the graph, the names and the sources are ids of strings, returns the number of edges
+    graph = LuaHeapGraph.get(G, True)
+    tu = gdb.lookup_type("union GCUnion").pointer()
+    kinds = dict((kind, i) for i, kind in enumerate(LUA_OBJ_KINDS))
+    metatable_name = graph.string_id("metatable")
+    mode_name = graph.string_id("__mode")
+
+    def labelled(i, edge_type, label):
+        for k in range(graph.offsets[i], graph.offsets[i + 1]):
+            if graph.edge_types[k] == edge_type and graph.labels[k] == label:
+                return graph.edges[k] if graph.edges[k] >= 0 else None
+        return None
+
+    modes = {}  # metatable -> __mode or None
+
+    def mode_of(mt):
+        if mt not in modes:
+            j = labelled(mt, LUA_EDGE_PROPERTY, mode_name)
+            is_string = j is not None and graph.kinds[j] in (kinds[LUA_OBJ_SHORT_STRING], kinds[LUA_OBJ_LONG_STRING])
+            modes[mt] = graph.strings[graph.names[j]] if is_string else None
+        return modes[mt]
+
+    def objects():
+        for i in range(0, len(graph)):
+            kind = LUA_OBJ_KINDS[graph.kinds[i]]
+            mt = None
+            if kind == LUA_OBJ_TABLE or kind == LUA_OBJ_USERDATA:
+                mt = labelled(i, LUA_EDGE_INTERNAL, metatable_name)
+            mode = mode_of(mt) if kind == LUA_OBJ_TABLE and mt is not None else None
+            yield i, long(graph.addresses[i]), kind, long(graph.sizes[i]), graph.names[i], mt, mode
+
+    def edges():
+        for i in range(0, len(graph)):
+            for k in range(graph.offsets[i], graph.offsets[i + 1]):
+                j = graph.edges[k]
+                if j < 0:
+                    continue
+                edge_type = graph.edge_types[k]
+                if edge_type == LUA_EDGE_ELEMENT:
+                    yield i, j, LUA_EDGE_TYPES[edge_type], None, graph.labels[k]
+                else:
+                    yield i, j, LUA_EDGE_TYPES[edge_type], graph.labels[k], None
+
+    def protos():
+        for i in range(0, len(graph)):
+            if graph.kinds[i] != kinds[LUA_OBJ_PROTO]:
+                continue
+            p = gdb.Value(graph.addresses[i]).cast(tu)["p"]
+            src = graph.string_id(TStringWrapper(p["source"].dereference()).to_string()) if p["source"] else None
+            yield (i, src, int(p["linedefined"]), int(p["lastlinedefined"]), int(p["numparams"]),
+                   int(p["is_vararg"]), int(p["maxstacksize"]), int(p["sizecode"]), int(p["sizek"]),
+                   int(p["sizep"]), int(p["sizeupvalues"]))
+
+    count = [0]
+
+    def counted(rows):
+        for row in rows:
+            count[0] += 1
+            yield row
+
+    conn.isolation_level = None  # the transaction is managed here
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("BEGIN")
+    try:
+        for sql in LUA_SQLITE_TABLES:
+            conn.execute(sql)
+        for batch in lua_batches(objects()):
+            conn.executemany("INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        for batch in lua_batches(counted(edges())):
+            conn.executemany("INSERT INTO edges VALUES (?, ?, ?, ?, ?)", batch)
+        for batch in lua_batches(protos()):
+            conn.executemany("INSERT INTO protos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+        for batch in lua_batches(enumerate(graph.strings)):
+            conn.executemany("INSERT INTO strings VALUES (?, ?)", batch)
+        for sql in LUA_SQLITE_INDEXES:
+            conn.execute(sql)
+        conn.execute("COMMIT")
+    except BaseException:  # also roll back on ctrl-c
+        conn.execute("ROLLBACK")
+        raise
+    return count[0]
+
+
 # Pretty printers
 
 
@@ -1754,161 +3380,2084 @@ Returns the metatable of the specific object. Returns 0 if no metatable. C Api:
         return False if ret is None else ret
 
 
-# Commands
+# Sampling
 
 
-class GLuaTraceback(gdb.Command):
-    """glua_traceback [lua_State*]
-Print the stack traceback of the lua_State."""
+LUA_FRAME_LUA = 0
+LUA_FRAME_C = 1
+LUA_FRAME_NATIVE = 2
 
-    def __init__(self):
-        gdb.Command.__init__(self, "glua_traceback", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
 
-    def invoke(self, args, _from_tty):
-        argv = gdb.string_to_argv(args)
-        if len(argv) > 0:
-            t = gdb.lookup_type("lua_State").pointer()
-            L = gdb.parse_and_eval(argv[0]).cast(t)
-        else:
-            L = gdb.parse_and_eval("L")
+def lua_iterframes(frame):
+    while frame is not None:
+        yield frame
+        frame = frame.older()
 
-        idx = 0
-        ci = CallInfoWrapper(L["ci"].dereference())
-        print("stack traceback:")
-        while ci.value.address != L["base_ci"].address:
-            ar = lua_getinfo(L, "nSlt", ci.value)
-            print("\t#%d  %s" % (idx, str(ar)))
-            idx += 1
-            ci = ci.get_prev()
 
+def lua_sampleinferior(seconds, hz):
+    # resumes the inferior and interrupts it 'hz' times per second, yields every time it stops
+    inferior = gdb.selected_inferior()
+    pid = inferior.pid
+    if pid == 0:
+        raise gdb.GdbError("The program is not being run.")
+    thread = gdb.selected_thread()
+    interval = 1.0 / hz
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        timer = threading.Timer(interval, os.kill, (pid, signal.SIGINT))
+        timer.start()
+        try:
+            gdb.execute("continue", to_string=True)
+        finally:
+            timer.cancel()
+        if inferior.pid == 0:  # exited
+            return
+        if thread.is_valid():
+            thread.switch()
+        yield
+
+
+def lua_runinferior(seconds):
+    # resumes the inferior for 'seconds', it is continued again if it stops earlier, returns False if it exited
+    inferior = gdb.selected_inferior()
+    pid = inferior.pid
+    if pid == 0:
+        raise gdb.GdbError("The program is not being run.")
+    thread = gdb.selected_thread()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        timer = threading.Timer(max(0.0, deadline - time.time()), os.kill, (pid, signal.SIGINT))
+        timer.start()
+        try:
+            gdb.execute("continue", to_string=True)
+        finally:
+            timer.cancel()
+        if inferior.pid == 0:  # exited
+            return False
+        if thread.is_valid():
+            thread.switch()
+    return True
+
+
+def lua_pcsymbol(addr):
+    try:
+        block = gdb.block_for_pc(addr)
+    except RuntimeError:
+        block = None
+    while block is not None and block.function is None:
+        block = block.superblock
+    if block is not None:
+        return block.function.print_name
+    return "0x%x" % addr
+
+
+class LuaStackSampler:
+    """Records the Lua stacks as raw addresses, they are decoded only once per (Proto, pc) by symbolize()."""
+
+    def __init__(self, L=None, native=False):
+        self.L = L
+        self.native = native
+        self.lclosure_ptr = gdb.lookup_type("LClosure").pointer()
+        self.cclosure_ptr = gdb.lookup_type("CClosure").pointer()
+        self.lua_state_ptr = gdb.lookup_type("lua_State").pointer()
+        self.instruction_sizeof = gdb.lookup_type("Instruction").sizeof
+        self.last_state = long(L) if L is not None else None
+        self.samples = {}
+        self.count = 0
+
+    def frame_key(self, ci, status):
+        func = ci["func"]
+        tt = int(func["tt_"])
+        if tt == LUA_TLCL | BIT_ISCOLLECTABLE:
+            p = func["value_"]["gc"].cast(self.lclosure_ptr)["p"]
+            pc = (long(ci["u"]["l"]["savedpc"]) - long(p["code"])) // self.instruction_sizeof - 1
+            return LUA_FRAME_LUA, long(p), pc, (status & CIST_TAIL) != 0
+        elif tt == LUA_TLCF:
+            return LUA_FRAME_C, long(func["value_"]["f"])
+        elif tt == LUA_TCCL | BIT_ISCOLLECTABLE:
+            return LUA_FRAME_C, long(func["value_"]["gc"].cast(self.cclosure_ptr)["f"])
+        return LUA_FRAME_C, 0
+
+    def capture(self):
+        # returns the current stack, innermost frame first
+        stack = []
+        if self.L is not None and not self.native:
+            for ci, status in lua_getcallinfochain(self.L):
+                stack.append(self.frame_key(ci, status))
+            return tuple(stack)
+        for frame, L, cis in lua_pairframes(lua_iterframes(gdb.newest_frame()), c_functions=True):
+            for ci, status in cis:
+                stack.append(self.frame_key(ci, status))
+            if L is not None:
+                self.last_state = long(L)
+            if self.native:
+                stack.append((LUA_FRAME_NATIVE, long(frame.pc())))
+        return tuple(stack)
+
+    def capture_lua_top(self):
+        # returns the key of the innermost Lua frame, time spent in a C function goes to the calling instruction
+        if self.L is not None:
+            for ci, status in lua_getcallinfochain(self.L):
+                if (status & CIST_LUA) != 0:
+                    return self.frame_key(ci, status)
+            return None
+        for _, _, cis in lua_pairframes(lua_iterframes(gdb.newest_frame())):
+            for ci, status in cis:
+                if (status & CIST_LUA) != 0:
+                    return self.frame_key(ci, status)
+        return None
+
+    def sample(self):
+        stack = self.capture()
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+        self.count += 1
+        return stack
+
+    def symbolize(self):
+        # yields (frames, count), frames are labels from the outermost to the innermost
+        L = gdb.Value(self.last_state).cast(self.lua_state_ptr) if self.last_state is not None else None
+        proto_ptr = gdb.lookup_type("Proto").pointer()
+        sources = {}  # Proto -> "source:linedefined"
+        names = {}  # (Proto, pc) -> name of the function called at pc
+        symbols = {}  # address -> native symbol
+        for stack, count in self.samples.items():
+            frames = []
+            caller = None
+            for key in reversed(stack):
+                if key[0] == LUA_FRAME_LUA:
+                    _, proto, pc, tailcall = key
+                    source = sources.get(proto)
+                    if source is None:
+                        p = gdb.Value(proto).cast(proto_ptr)
+                        src = TStringWrapper(p["source"].dereference()).to_string() if p["source"] else "=?"
+                        source = "%s:%d" % (lua_chunkid(src, LUA_IDSIZE), int(p["linedefined"]))
+                        sources[proto] = source
+                    name = "?"
+                    if source.endswith(":0"):
+                        name = "[Main chunk]"
+                    elif caller is not None and caller[0] == LUA_FRAME_LUA and not tailcall and L is not None:
+                        name_key = (caller[1], caller[2])
+                        name = names.get(name_key)
+                        if name is None:
+                            name = lua_funcnamefrompc(L, gdb.Value(caller[1]).cast(proto_ptr), caller[2])[0]
+                            names[name_key] = name
+                    frames.append("%s@%s" % (name, source))
+                else:
+                    addr = key[1]
+                    symbol = symbols.get(addr)
+                    if symbol is None:
+                        symbol = lua_pcsymbol(addr)
+                        symbols[addr] = symbol
+                    frames.append(("[C] %s" % symbol) if key[0] == LUA_FRAME_C else symbol)
+                caller = key
+            yield [f.replace(";", ":") for f in frames], count
 
-class GLuaStackInfo(gdb.Command):
-    """glua_stackinfo [lua_State* [index]]
-Print the stack info and all the variables of the current stack frame or the specific stack frame."""
+
+class LuaHotspots:
+    """Samples of the running instruction aggregated by (Proto, pc)."""
+
+    last = None  # result of the last glua_hotspot
 
     def __init__(self):
-        gdb.Command.__init__(self, "glua_stackinfo", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+        self.samples = {}  # (Proto*, pc) -> count
+        self.count = 0
+        self.lua_count = 0
 
-    def invoke(self, args, _from_tty):
-        argv = gdb.string_to_argv(args)
-        idx = 0
-        if len(argv) > 0:
-            t = gdb.lookup_type("lua_State").pointer()
-            L = gdb.parse_and_eval(argv[0]).cast(t)
-            if len(argv) > 1:
-                idx = int(gdb.parse_and_eval(argv[1]))
+    def add(self, key):
+        self.count += 1
+        if key is None:
+            return
+        self.lua_count += 1
+        pc_key = (key[1], key[2])
+        self.samples[pc_key] = self.samples.get(pc_key, 0) + 1
+
+    def by_proto(self):
+        ret = {}
+        for (proto, _), count in self.samples.items():
+            ret[proto] = ret.get(proto, 0) + count
+        return ret
+
+    def report(self, top):
+        # yields the lines of the report of the 'top' hottest functions
+        def percent(n):
+            return "%5.1f%%" % (100.0 * n / self.count) if self.count > 0 else "  0.0%"
+
+        yield "Total %d samples, %d in Lua" % (self.count, self.lua_count)
+        proto_ptr = gdb.lookup_type("Proto").pointer()
+        protos = sorted(self.by_proto().items(), key=lambda item: -item[1])[0:top]
+        for proto, count in protos:
+            p = gdb.Value(proto).cast(proto_ptr)
+            listing = LuaDisassembly.get(p)
+            yield ""
+            yield "%s %s" % (percent(count), listing.header[0])
+
+            lines = {}
+            annotations = {}
+            for pc in range(0, len(listing.rows)):
+                n = self.samples.get((proto, pc), 0)
+                if n > 0:
+                    annotations[pc] = percent(n)
+                    line = listing.rows[pc][0]
+                    lines[line] = lines.get(line, 0) + n
+            yield "Hot lines:"
+            for line, n in sorted(lines.items(), key=lambda item: -item[1]):
+                yield "%s\tline %d" % (percent(n), line)
+            yield "Instructions:"
+            for text in listing.format(annotations=annotations):
+                yield text
+
+
+def lua_findstate():
+    # looks for the variable 'L' in the native frames of all the threads
+    selected = gdb.selected_thread()
+    try:
+        for thread in gdb.selected_inferior().threads():
+            thread.switch()
+            for frame in lua_iterframes(gdb.newest_frame()):
+                try:
+                    L = frame.read_var("L")
+                except (ValueError, RuntimeError, gdb.error):
+                    continue
+                if L.type.strip_typedefs().code == gdb.TYPE_CODE_PTR and L:
+                    return L
+    finally:
+        if selected is not None and selected.is_valid():
+            selected.switch()
+    raise gdb.GdbError("No lua_State found, please specify one")
+
+
+def lua_report_traceback():
+    selected = gdb.selected_thread()
+    threads = []
+    try:
+        for thread in sorted(gdb.selected_inferior().threads(), key=lambda th: th.num):
+            thread.switch()
+            frames = []
+            for frame, L, cis in lua_pairframes(lua_iterframes(gdb.newest_frame())):
+                for ci, _ in cis:
+                    frames.append({"lua": str(lua_getinfo(L, "nSlt", ci.dereference()))})
+                frames.append({"native": frame.name() or lua_pcsymbol(long(frame.pc())), "pc": long(frame.pc())})
+            threads.append({"num": thread.num, "name": thread.name, "frames": frames})
+    finally:
+        if selected is not None and selected.is_valid():
+            selected.switch()
+    return threads
+
+
+def lua_report_objectinfo(G):
+    stat, cnt = lua_objectstatistic(G)
+    return {
+        "objects": dict((k, {"count": v[0], "bytes": v[1]}) for k, v in stat.items()),
+        "total_count": cnt,
+        "total_bytes": sum(v[1] for v in stat.values()),
+    }
+
+
+def lua_report_topobjects(G, n):
+    sizer = LuaObjectSizer()
+
+    def sizes():
+        for obj in lua_gcobjects(G):
+            kind, sz = sizer.size(obj)
+            if kind is not None:
+                yield long(sz), long(obj), kind
+
+    top = heapq.nlargest(n, sizes())
+    return [{"address": addr, "type": kind, "bytes": sz} for sz, addr, kind in top]
+
+
+def lua_report_closures(G, n):
+    census = lua_closurecensus(G)
+    top = heapq.nlargest(n, census.items(), key=lambda item: (item[1][0], item[1][1]))
+    proto_ptr = gdb.lookup_type("Proto").pointer()
+    ret = []
+    for proto, (count, sz, upvalues, upvalue_sz) in top:
+        p = gdb.Value(proto).cast(proto_ptr)
+        source = TStringWrapper(p["source"].dereference()).to_string() if p["source"] else "=?"
+        ret.append({
+            "proto": proto,
+            "source": "%s:%d" % (lua_chunkid(source, LUA_IDSIZE), int(p["linedefined"])),
+            "closures": count,
+            "bytes": sz,
+            "upvalues": upvalues,
+            "upvalue_bytes": upvalue_sz,
+        })
+    return ret
+
+
+def lua_report_classes(G, n):
+    census = lua_classcensus(G)
+    names = LuaClassNames.get(G)
+
+    def total(kinds):
+        return sum(v[0] for v in kinds.values()), sum(v[1] for v in kinds.values())
+
+    top = heapq.nlargest(n, census.items(), key=lambda item: total(item[1])[1])
+    ret = []
+    for mt, kinds in top:
+        count, sz = total(kinds)
+        ret.append({
+            "metatable": mt,
+            "name": names.name(mt),
+            "count": count,
+            "bytes": sz,
+            "tables": kinds.get(LUA_OBJ_TABLE, [0, 0])[0],
+            "userdata": kinds.get(LUA_OBJ_USERDATA, [0, 0])[0],
+        })
+    return ret
+
+
+def lua_report_threads(G, n, running=None):
+    threads = [lua_threadinfo(L, running) for L in lua_threads(G)]
+    statuses = {}
+    for info in threads:
+        statuses[info["status"]] = statuses.get(info["status"], 0) + 1
+    tvalue_sizeof = gdb.lookup_type("TValue").sizeof
+    return {
+        "count": len(threads),
+        "status": statuses,
+        "stack_bytes": sum(info["stacksize"] for info in threads) * tvalue_sizeof,
+        "spare_bytes": sum(info["spare_bytes"] for info in threads),
+        "spare_callinfo_bytes": sum(info["spare_callinfo_bytes"] for info in threads),
+        "threads": heapq.nlargest(n, threads, key=lambda info: info["spare_bytes"] + info["spare_callinfo_bytes"]),
+    }
+
+
+def lua_report_refs(G):
+    refs, free = lua_registryrefs(G)
+    category = LuaValueCategory(G)
+    categories = {}
+    for v in refs.values():
+        name = category.get(v)
+        categories[name] = categories.get(name, 0) + 1
+    return {
+        "refs": len(refs),
+        "free": len(free),
+        "max_ref": max(list(refs.keys()) + free) if len(refs) + len(free) > 0 else 0,
+        "categories": categories,
+    }
+
+
+def lua_report_gcqueues(G, n):
+    lists, weak = lua_gcqueues(G)
+    modes = {}
+    for mode, sz, entries in weak.values():
+        item = modes.setdefault(mode, {"count": 0, "bytes": 0, "entries": 0})
+        item["count"] += 1
+        item["bytes"] += sz
+        item["entries"] += entries
+    names = LuaClassNames.get(G)
+    table_ptr = gdb.lookup_type("Table").pointer()
+    top = heapq.nlargest(n, weak.items(), key=lambda item: item[1][2])
+    return {
+        "gcstate": int(G["gcstate"]),
+        "lists": dict((name, dict((k, {"count": v[0], "bytes": v[1]}) for k, v in stat.items()))
+                      for name, stat in lists.items()),
+        "weak_tables": modes,
+        "top_weak_tables": [{
+            "address": addr,
+            "class": names.name(long(gdb.Value(addr).cast(table_ptr)["metatable"])),
+            "mode": mode,
+            "bytes": sz,
+            "entries": entries,
+        } for addr, (mode, sz, entries) in top],
+    }
+
+
+# Source index
+
+
+class LuaSourceIndex:
+    """Maps the sources to their Protos and the lines to the bytecode addresses where they start.
+It is built once per global state and updated incrementally, only the objects created after the last update
+are visited, since the new objects are always linked at the head of 'allgc'. A Proto which is still filled by the
+parser or the undumper is indexed again at every update until it looks complete or its sizes stop changing between
+two updates. The indexes are dropped when the inferior exits or
+a new objfile is loaded, since the same addresses are reused by the next run."""
+
+    instances = {}  # global_State* -> LuaSourceIndex
+
+    def __init__(self, G):
+        self.G = G
+        self.protos = {}  # Proto* -> (source, linedefined, lastlinedefined, {line: [address]}, code)
+        self.sources = {}  # source -> set(Proto*)
+        self.basenames = {}  # basename -> set(source)
+        self.strings = {}  # TString* -> str
+        self.incomplete = {}  # Proto* still filled by the parser -> (source, code, sizecode, sizelineinfo)
+        self.sourceless = set()  # Proto* completed without a source, they are never indexed
+        self.dirty = True
+        self.instruction_sizeof = gdb.lookup_type("Instruction").sizeof
+
+    @staticmethod
+    def get(G):
+        key = long(G)
+        index = LuaSourceIndex.instances.get(key)
+        if index is None:
+            index = LuaSourceIndex(G)
+            LuaSourceIndex.instances[key] = index
+            LuaProtoWatch.install()
+        index.update()
+        return index
+
+    @staticmethod
+    def reset(_event=None):
+        LuaSourceIndex.instances.clear()
+
+    def update(self):
+        if not self.dirty and len(self.incomplete) == 0 and LuaProtoWatch.is_installed():
+            return
+        tu = gdb.lookup_type("union GCUnion").pointer()
+        pending = self.incomplete
+        self.incomplete = {}
+        # without the watch on luaF_freeproto, an incomplete Proto may have been freed, so the walk goes on until all
+        # of them are seen again, the ones which are not are dropped
+        watched = LuaProtoWatch.is_installed()
+        alive = set(pending.keys()) if watched else set()
+        fresh = True  # before the first object seen by the last update
+        obj = self.G["allgc"].cast(tu)
+        while obj and (fresh or len(alive) < len(pending)):
+            addr = long(obj)
+            is_proto = (obj["gc"]["tt"] & 0x0F) == LUA_TPROTO
+            if addr in pending or addr in self.protos or addr in self.sourceless:  # everything older is indexed
+                fresh = False
+                if is_proto and addr in pending:
+                    alive.add(addr)
+            elif fresh and is_proto:
+                self.add(obj["p"])
+            obj = obj["gc"]["next"].cast(tu)
+        for addr, sizes in pending.items():
+            self.remove(addr)
+            if addr in alive:
+                self.add(gdb.Value(addr).cast(tu)["p"], sizes)
+        self.dirty = False
+
+    def get_string(self, ts):
+        key = long(ts)
+        s = self.strings.get(key)
+        if s is None:
+            s = TStringWrapper(ts.dereference()).to_string() if key != 0 else "=?"
+            self.strings[key] = s
+        return s
+
+    @staticmethod
+    def is_complete(p):
+        # the parser sets the source first, 'lastlinedefined' of a function after its body, and close_func shrinks
+        # the code and the line info to the same size, ending with OP_RETURN. A slot past the end of a growing
+        # vector is not initialized, so OP_RETURN alone tells nothing
+        n = int(p["sizecode"])
+        if not p["source"] or n == 0 or not p["code"] or n != int(p["sizelineinfo"]):
+            return False
+        if int(p["linedefined"]) != 0 and int(p["lastlinedefined"]) == 0:
+            return False
+        return lua_op_getcode(int((p["code"] + (n - 1)).dereference())) == OP_RETURN
+
+    def add(self, p, last=None):
+        # 'last' are the sizes read by the previous update of an incomplete Proto
+        addr = long(p)
+        sizes = (long(p["source"]), long(p["code"]), int(p["sizecode"]), int(p["sizelineinfo"]))
+        if not self.is_complete(p) and sizes != last:
+            self.incomplete[addr] = sizes
+        elif not p["source"]:
+            self.sourceless.add(addr)
+        if not p["source"]:
+            return  # not in any source yet
+        source = self.get_string(p["source"])
+        lines = {}
+        n = min(int(p["sizelineinfo"]), int(p["sizecode"]))
+        if n > 0 and p["lineinfo"]:
+            code = long(p["code"])
+            last = None
+            for pc, line in enumerate(lua_readarray(p["lineinfo"], n, "i")):
+                if line != last:
+                    lines.setdefault(line, []).append(code + pc * self.instruction_sizeof)
+                    last = line
+        self.protos[addr] = (source, int(p["linedefined"]), int(p["lastlinedefined"]), lines, long(p["code"]))
+        self.sources.setdefault(source, set()).add(addr)
+        if source.startswith("@"):
+            self.basenames.setdefault(os.path.basename(source[1:]), set()).add(source)
+
+    def remove(self, addr):
+        self.incomplete.pop(addr, None)
+        self.sourceless.discard(addr)
+        info = self.protos.pop(addr, None)
+        if info is None:
+            return
+        source = info[0]
+        protos = self.sources[source]
+        protos.discard(addr)
+        if len(protos) == 0:
+            del self.sources[source]
+            if source.startswith("@"):
+                basename = os.path.basename(source[1:])
+                self.basenames[basename].discard(source)
+                if len(self.basenames[basename]) == 0:
+                    del self.basenames[basename]
+
+    def match_file(self, filename):
+        # sources whose basename or full path is 'filename'
+        ret = set(self.basenames.get(filename, ()))
+        if ("@" + filename) in self.sources:
+            ret.add("@" + filename)
+        return sorted(ret)
+
+    def match_regex(self, regex):
+        return sorted(s for s in self.sources.keys() if regex.match(s))
+
+    def find_function(self, sources, linedefined):
+        # returns [(Proto*, source, code)] for the Protos defined at 'linedefined'
+        ret = []
+        for source in sources:
+            for addr in sorted(self.sources.get(source, ())):
+                info = self.protos[addr]
+                if info[1] == linedefined:
+                    ret.append((addr, source, info[4]))
+        return ret
+
+    def find_line(self, sources, line):
+        # returns [(Proto*, source, [address])] for the Protos having code at 'line'
+        ret = []
+        for source in sources:
+            for addr in sorted(self.sources.get(source, ())):
+                addresses = self.protos[addr][3].get(line)
+                if addresses is not None:
+                    ret.append((addr, source, addresses))
+        return ret
+
+
+class LuaProtoWatch(gdb.Breakpoint):
+    """Tells the source indexes about the created and freed Protos, never stops the inferior."""
+
+    instances = []
+
+    def __init__(self, spec):
+        gdb.Breakpoint.__init__(self, spec, internal=True)
+        self.silent = True
+        self.spec = spec
+
+    def stop(self):
+        if self.spec == "luaF_newproto":
+            # the Proto is not filled yet, it is indexed at the next update
+            for index in LuaSourceIndex.instances.values():
+                index.dirty = True
         else:
-            L = gdb.parse_and_eval("L")
+            try:
+                f = long(gdb.selected_frame().read_var("f"))
+            except (ValueError, RuntimeError, gdb.error):
+                for index in LuaSourceIndex.instances.values():
+                    index.dirty = True
+                return False
+            for index in LuaSourceIndex.instances.values():
+                index.remove(f)
+        return False
 
-        i = 0
-        ci = CallInfoWrapper(L["ci"].dereference())
-        while ci.value.address != L["base_ci"].address and i < idx:
-            ci = ci.get_prev()
-            i += 1
-        if ci.value.address == L["base_ci"].address or i != idx:
-            raise RuntimeError("Frame index out of range")
+    @staticmethod
+    def is_installed():
+        return len(LuaProtoWatch.instances) == 2 and all(w.is_valid() for w in LuaProtoWatch.instances)
 
-        ar = lua_getinfo(L, "nSlt", ci.value)
-        print("#%d  %s" % (idx, str(ar)))
+    @staticmethod
+    def install():
+        if LuaProtoWatch.is_installed():
+            return
+        for w in LuaProtoWatch.instances:
+            if w.is_valid():
+                w.delete()
+        LuaProtoWatch.instances = []
+        try:
+            LuaProtoWatch.instances.append(LuaProtoWatch("luaF_newproto"))
+            LuaProtoWatch.instances.append(LuaProtoWatch("luaF_freeproto"))
+        except RuntimeError:
+            pass  # the index is updated on every use instead
 
-        func = ci.get_func()
-        t = TValueWrapper(func.dereference())
 
-        # Native function
-        if t.is_light_c_function() or t.is_c_closure():
-            print("\nNative stack values:")
-            base = ci.get_base()
-            if idx == 0:
-                top = L["top"]
-            else:
-                next = ci.get_next()
-                if next.is_lua():
-                    top = next.get_func() + 1
-                else:
-                    top = next.get_base()
-            p = top - 1
-            while p >= base:
-                print("\t#%d  %s" % (p - base + 1, TValuePointerPrinter(p).to_string(with_address=True, show_string=True)))
-                p = p - 1
+# Disassembler
 
-            if t.is_c_closure():
-                cl = t.get_c_closure_value()
-                nupvalues = cl["nupvalues"]
-                if nupvalues > 0:
-                    print("\nUpvalues:")
-                    for i in range(0, nupvalues):
-                        upval = cl["upvalue"][i]
-                        print("\t#%d  %s" % (i, TValuePointerPrinter(upval.address).to_string(with_address=True, show_string=True)))
-        else:  # Lua function
-            assert ci.is_lua()
 
-            # arguments
-            f = t.get_lua_closure_value()["p"]
-            nparams = f["numparams"]
-            nvarparams = ((ci.get_lua_base() - 1) - ci.get_func()) - nparams
+luaP_opnames = [
+    "MOVE", "LOADK", "LOADKX", "LOADBOOL", "LOADNIL", "GETUPVAL", "GETTABUP", "GETTABLE", "SETTABUP", "SETUPVAL",
+    "SETTABLE", "NEWTABLE", "SELF", "ADD", "SUB", "MUL", "MOD", "POW", "DIV", "IDIV", "BAND", "BOR", "BXOR", "SHL",
+    "SHR", "UNM", "BNOT", "NOT", "LEN", "CONCAT", "JMP", "EQ", "LT", "LE", "TEST", "TESTSET", "CALL", "TAILCALL",
+    "RETURN", "FORLOOP", "FORPREP", "TFORCALL", "TFORLOOP", "SETLIST", "CLOSURE", "VARARG", "EXTRAARG",
+]
 
-            if not (nparams == 0 and nvarparams == 0):
-                print("\nParameters:")
-                for i in range(0, nparams):
-                    val = ci.get_lua_base() + i
-                    name = lua_getlocalname(f, i + 1, ci.get_current_pc())
-                    if name is None:
-                        limit = L["top"] if ci.value.address == L["ci"] else ci.get_next().get_func()
-                        if limit - ci.get_lua_base() >= i + 1 > 0:
-                            name = "(*temporary)"
-                        else:
-                            name = "(?)"
-                    print("\t#%d  %s = %s" % (i + 1, name, TValuePointerPrinter(val).to_string(with_address=True, show_string=True)))
+BITRK = 1 << (SIZE_B - 1)
 
-                for i in range(-nvarparams, 0):
-                    val = ci.get_lua_base() + i
-                    print("\t#%d  (*vararg) = %s" % (i, TValuePointerPrinter(val).to_string(with_address=True, show_string=True)))
 
-            # local variables
-            if idx == 0:
-                top = L["top"]
+def lua_op_getopmode(m):
+    return luaP_opmodes[m] & 3
+
+
+def lua_op_getbmode(m):
+    return (luaP_opmodes[m] >> 4) & 3
+
+
+def lua_op_getcmode(m):
+    return (luaP_opmodes[m] >> 2) & 3
+
+
+def lua_op_isk(x):
+    return (x & BITRK) != 0
+
+
+def lua_op_indexk(x):
+    return x & ~BITRK
+
+
+def lua_op_myk(x):
+    return -1 - x
+
+
+LUA_STRING_ESCAPES = {7: "\\a", 8: "\\b", 12: "\\f", 10: "\\n", 13: "\\r", 9: "\\t", 11: "\\v"}
+
+
+def lua_quotestring(s):
+    # same as luac PrintString
+    ret = ['"']
+    for c in bytearray(s):
+        if c == ord('"'):
+            ret.append('\\"')
+        elif c == ord('\\'):
+            ret.append('\\\\')
+        elif c in LUA_STRING_ESCAPES:
+            ret.append(LUA_STRING_ESCAPES[c])
+        elif 32 <= c < 127:
+            ret.append(chr(c))
+        else:
+            ret.append("\\%03d" % c)
+    ret.append('"')
+    return "".join(ret)
+
+
+def lua_formatconstant(k):
+    # k: (tt, integer, float, pointer) read by lua_readtvalues
+    tt, i, n, ptr = k
+    if tt == LUA_TNIL:
+        return "nil"
+    elif tt == LUA_TBOOLEAN:
+        return "true" if i & 0xFFFFFFFF != 0 else "false"
+    elif tt == LUA_TNUMFLT:
+        s = "%.14g" % n
+        if re.match(r"^[-0-9]*$", s):
+            s += ".0"
+        return s
+    elif tt == LUA_TNUMINT:
+        return "%d" % i
+    elif (tt & 0x0F) == LUA_TSTRING:
+        ts = gdb.Value(ptr).cast(gdb.lookup_type("TString").pointer())
+        return lua_quotestring(TStringWrapper(ts.dereference()).to_bytes())
+    return "?"
+
+
+LUA_DISASSEMBLY_CACHE_SIZE = 256  # listings kept across stops
+
+
+class LuaDisassembly:
+    """A luac style listing of a Proto, decoded once and cached by the address of the Proto and its code, so that
+stepping does not decode it again. 'rows' are (line, text) of each instruction."""
+
+    cache = {}  # (Proto*, code, sizecode, sizek) -> LuaDisassembly
+
+    def __init__(self, p):
+        self.proto = long(p)
+        source = TStringWrapper(p["source"].dereference()).to_string() if p["source"] else "=?"
+        source = source[1:] if source[0] in "@=" else "(string)"
+        linedefined = int(p["linedefined"])
+        sizecode = int(p["sizecode"])
+        code = lua_readarray(p["code"], sizecode, "I") if sizecode > 0 else ()
+        sizelineinfo = int(p["sizelineinfo"])
+        lineinfo = lua_readarray(p["lineinfo"], sizelineinfo, "i") if sizelineinfo > 0 and p["lineinfo"] else ()
+        k = lua_readtvalues(p["k"], int(p["sizek"])) if int(p["sizek"]) > 0 else []
+        upvalues = [lua_upvalname(p, i) for i in range(0, int(p["sizeupvalues"]))]
+        sizep = int(p["sizep"])
+        protos = lua_readarray(p["p"], sizep, lua_ptrformat()) if sizep > 0 else ()
+
+        def plural(n):
+            return "" if n == 1 else "s"
+
+        nparams = int(p["numparams"])
+        self.header = [
+            "%s <%s:%d,%d> (%d instruction%s at 0x%x)" % (
+                "main" if linedefined == 0 else "function", source, linedefined, int(p["lastlinedefined"]),
+                sizecode, plural(sizecode), self.proto),
+            "%d%s param%s, %d slot%s, %d upvalue%s, %d local%s, %d constant%s, %d function%s" % (
+                nparams, "+" if p["is_vararg"] else "", plural(nparams), int(p["maxstacksize"]),
+                plural(int(p["maxstacksize"])), len(upvalues), plural(len(upvalues)), int(p["sizelocvars"]),
+                plural(int(p["sizelocvars"])), len(k), plural(len(k)), sizep, plural(sizep)),
+        ]
+
+        def constant(x):
+            return lua_formatconstant(k[x]) if 0 <= x < len(k) else "?"
+
+        def upvalue(x):
+            return upvalues[x] if 0 <= x < len(upvalues) else "-"
+
+        self.rows = []
+        for pc in range(0, sizecode):
+            i = code[pc]
+            o = lua_op_getcode(i)
+            a = lua_op_getarga(i)
+            b = lua_op_getargb(i)
+            c = lua_op_getargc(i)
+            ax = lua_op_getargax(i)
+            bx = lua_op_getargbx(i)
+            sbx = lua_op_getargsbx(i)
+            line = lineinfo[pc] if pc < len(lineinfo) else 0
+            if o >= len(luaP_opnames):
+                self.rows.append((line, "?\t0x%08x" % i))
+                continue
+
+            mode = lua_op_getopmode(o)
+            if mode == OP_MODE_iABC:
+                args = "%d" % a
+                if lua_op_getbmode(o) != OP_MASK_ARG_N:
+                    args += " %d" % (lua_op_myk(lua_op_indexk(b)) if lua_op_isk(b) else b)
+                if lua_op_getcmode(o) != OP_MASK_ARG_N:
+                    args += " %d" % (lua_op_myk(lua_op_indexk(c)) if lua_op_isk(c) else c)
+            elif mode == OP_MODE_iABx:
+                args = "%d" % a
+                if lua_op_getbmode(o) == OP_MASK_ARG_K:
+                    args += " %d" % lua_op_myk(bx)
+                if lua_op_getbmode(o) == OP_MASK_ARG_U:
+                    args += " %d" % bx
+            elif mode == OP_MODE_iAsBx:
+                args = "%d %d" % (a, sbx)
+            else:
+                args = "%d" % lua_op_myk(ax)
+
+            comment = None
+            if o == OP_LOADK:
+                comment = constant(bx)
+            elif o == OP_GETUPVAL or o == OP_SETUPVAL:
+                comment = upvalue(b)
+            elif o == OP_GETTABUP:
+                comment = upvalue(b)
+                if lua_op_isk(c):
+                    comment += " " + constant(lua_op_indexk(c))
+            elif o == OP_SETTABUP:
+                comment = upvalue(a)
+                if lua_op_isk(b):
+                    comment += " " + constant(lua_op_indexk(b))
+                if lua_op_isk(c):
+                    comment += " " + constant(lua_op_indexk(c))
+            elif o == OP_GETTABLE or o == OP_SELF:
+                if lua_op_isk(c):
+                    comment = constant(lua_op_indexk(c))
+            elif o in (OP_SETTABLE, OP_ADD, OP_SUB, OP_MUL, OP_MOD, OP_POW, OP_DIV, OP_IDIV, OP_BAND, OP_BOR, OP_BXOR,
+                       OP_SHL, OP_SHR, OP_EQ, OP_LT, OP_LE):
+                if lua_op_isk(b) or lua_op_isk(c):
+                    comment = "%s %s" % (constant(lua_op_indexk(b)) if lua_op_isk(b) else "-",
+                                         constant(lua_op_indexk(c)) if lua_op_isk(c) else "-")
+            elif o in (OP_JMP, OP_FORLOOP, OP_FORPREP, OP_TFORLOOP):
+                comment = "to %d" % (sbx + pc + 2)
+            elif o == OP_CLOSURE:
+                comment = "0x%x" % protos[bx] if bx < len(protos) else "?"
+            elif o == OP_SETLIST:
+                if c == 0:
+                    comment = "%d" % (code[pc + 1] if pc + 1 < sizecode else 0)
+                else:
+                    comment = "%d" % c
+            elif o == OP_EXTRAARG:
+                comment = constant(ax)
+
+            text = "%-9s\t%s" % (luaP_opnames[o], args)
+            if comment is not None:
+                text += "\t; " + comment
+            self.rows.append((line, text))
+
+    @staticmethod
+    def get(p):
+        key = (long(p), long(p["code"]), int(p["sizecode"]), int(p["sizek"]))
+        ret = LuaDisassembly.cache.get(key)
+        if ret is None:
+            if len(LuaDisassembly.cache) >= LUA_DISASSEMBLY_CACHE_SIZE:
+                LuaDisassembly.cache.clear()
+            ret = LuaDisassembly(p)
+            LuaDisassembly.cache[key] = ret
+        return ret
+
+    @staticmethod
+    def reset(_event=None):
+        LuaDisassembly.cache.clear()
+
+    def format(self, first=0, last=None, current=None, annotations=None):
+        # yields the lines of the listing, 'annotations' maps pc to a prefix
+        if last is None:
+            last = len(self.rows) - 1
+        for pc in range(max(0, first), min(last + 1, len(self.rows))):
+            line, text = self.rows[pc]
+            mark = "=>" if pc == current else ""
+            if annotations is not None:
+                mark = annotations.get(pc, "") + mark
+            yield "%s\t%d\t[%s]\t%s" % (mark, pc + 1, line if line > 0 else "-", text)
+
+
+def lua_toproto(v):
+    # returns (Proto*, CallInfo* or None) from a Proto*, LClosure*, Closure*, TValue* or CallInfo*
+    t = v.type.strip_typedefs()
+    if t.code != gdb.TYPE_CODE_PTR:
+        raise gdb.GdbError("A pointer is required")
+    tag = t.target().strip_typedefs().tag
+    if tag == "Proto":
+        return v, None
+    elif tag == "LClosure":
+        return v["p"], None
+    elif tag == "Closure":
+        return v["l"]["p"], None
+    elif tag == "lua_TValue" or tag == "TValue":
+        tv = TValueWrapper(v.dereference())
+        if not tv.is_lua_closure():
+            raise gdb.GdbError("Not a Lua function")
+        return tv.get_lua_closure_value()["p"], None
+    elif tag == "CallInfo":
+        ci = CallInfoWrapper(v.dereference())
+        if not ci.is_lua():
+            raise gdb.GdbError("Not a Lua call")
+        return TValueWrapper(ci.get_func().dereference()).get_lua_closure_value()["p"], ci
+    raise gdb.GdbError("Unsupported type %s" % str(v.type))
+
+
+# Static analysis
+
+
+LUA_SMELL_GLOBAL = "global"
+LUA_SMELL_NEWTABLE = "table constructor"
+LUA_SMELL_CLOSURE = "closure"
+LUA_SMELL_CONCAT = "concatenation"
+
+
+def lua_findloops(code):
+    # returns [(first, last, kind)], the pc ranges of the loop bodies closed by a backward jump
+    loops = []
+    for pc in range(0, len(code)):
+        i = code[pc]
+        o = lua_op_getcode(i)
+        if o == OP_FORLOOP or o == OP_TFORLOOP or o == OP_JMP:
+            dest = pc + 1 + lua_op_getargsbx(i)
+            if dest <= pc:
+                kind = "for" if o == OP_FORLOOP else ("for in" if o == OP_TFORLOOP else "while")
+                loops.append((dest, pc, kind))
+    return loops
+
+
+def lua_findloopsmells(p):
+    # returns [(pc, depth, smell, detail)] of the global lookups and allocations inside loops
+    sizecode = int(p["sizecode"])
+    if sizecode == 0:
+        return []
+    code = lua_readarray(p["code"], sizecode, "I")
+    loops = lua_findloops(code)
+    if len(loops) == 0:
+        return []
+    first = min(loop[0] for loop in loops)
+    last = max(loop[1] for loop in loops)
+    upvalues = {}
+    ret = []
+    for pc in range(first, last + 1):
+        i = code[pc]
+        o = lua_op_getcode(i)
+        if o == OP_GETTABUP:
+            b = lua_op_getargb(i)
+            if b not in upvalues:
+                upvalues[b] = lua_upvalname(p, b)
+            if upvalues[b] != "_ENV":
+                continue
+            smell = LUA_SMELL_GLOBAL
+        elif o == OP_NEWTABLE:
+            smell = LUA_SMELL_NEWTABLE
+        elif o == OP_CLOSURE:
+            smell = LUA_SMELL_CLOSURE
+        elif o == OP_CONCAT:
+            smell = LUA_SMELL_CONCAT
+        else:
+            continue
+        depth = sum(1 for loop in loops if loop[0] <= pc <= loop[1])
+        if depth == 0:
+            continue
+        detail = "'%s'" % lua_kname(p, pc, lua_op_getargc(i)) if smell == LUA_SMELL_GLOBAL else ""
+        ret.append((pc, depth, smell, detail))
+    return ret
+
+
+# Breakpoints
+
+
+class LuaBreakpoint:
+    """A Lua breakpoint checked by the breakpoint engine, it may cover the bytecode of several prototypes."""
+
+    next_number = 1
+
+    def __init__(self, location, addresses):
+        self.number = LuaBreakpoint.next_number
+        LuaBreakpoint.next_number += 1
+        self.location = location
+        self.addresses = addresses
+        self.enabled = True
+        self.hit_count = 0
+        self.ignore_count = 0
+        self.condition = None
+
+    def should_stop(self, L, pc):
+        if self.condition is not None:
+            try:
+                if not self.condition.evaluate(L, pc):
+                    return False
+            except (RuntimeError, gdb.error, ValueError) as e:
+                print("Error in testing condition for Lua breakpoint %d: %s" % (self.number, str(e)))
+                return True
+        self.hit_count += 1
+        if self.ignore_count > 0:
+            self.ignore_count -= 1
+            return False
+        return True
+
+
+def lua_topython(v):
+    # converts a TValue to a python value for comparisons, gc objects other than strings become ("gc", address)
+    if v is None:
+        return None
+    t = TValueWrapper(v)
+    if t.is_nil():
+        return None
+    elif t.is_boolean():
+        return t.get_boolean()
+    elif t.is_number():
+        return t.get_number()
+    elif t.is_string():
+        return TStringWrapper(t.get_tstring_value().dereference()).to_bytes().decode("utf-8", "replace")
+    elif t.is_light_userdata():
+        return "lightuserdata", long(t.get_light_userdata())
+    elif t.is_light_c_function():
+        return "cfunction", long(t.get_light_c_function())
+    return "gc", long(t.get_gc_value())
+
+
+LUA_ESCAPES = {"a": 7, "b": 8, "f": 12, "n": 10, "r": 13, "t": 9, "v": 11, "\\": 92, '"': 34, "'": 39, "\n": 10}
+
+
+def lua_unescape(s):
+    # decodes the escape sequences of the body of a Lua string literal
+    ret = bytearray()
+    i = 0
+    while i < len(s):
+        c = s[i]
+        i += 1
+        if c != "\\":
+            ret += c.encode("utf-8")
+            continue
+        c = s[i] if i < len(s) else ""
+        if c in LUA_ESCAPES:
+            ret.append(LUA_ESCAPES[c])
+            i += 1
+        elif c == "x" and re.match(r"[0-9A-Fa-f]{2}$", s[i + 1:i + 3]):
+            ret.append(int(s[i + 1:i + 3], 16))
+            i += 3
+        elif c == "z":
+            i += 1
+            while i < len(s) and s[i].isspace():
+                i += 1
+        elif "0" <= c <= "9":
+            m = re.match(r"[0-9]{1,3}", s[i:])
+            if int(m.group(0)) > 255:
+                raise gdb.GdbError("Decimal escape too large near '\\%s'" % m.group(0))
+            ret.append(int(m.group(0)))
+            i += len(m.group(0))
+        elif c == "u" and re.match(r"\{[0-9A-Fa-f]+\}", s[i + 1:]):
+            m = re.match(r"\{([0-9A-Fa-f]+)\}", s[i + 1:])
+            if int(m.group(1), 16) > 0x10FFFF:
+                raise gdb.GdbError("UTF-8 value too large near '\\u%s'" % m.group(0))
+            ret += chr(int(m.group(1), 16)).encode("utf-8", "surrogatepass")
+            i += 1 + len(m.group(0))
+        else:
+            raise gdb.GdbError("Invalid escape sequence '\\%s'" % c)
+    return ret.decode("utf-8", "replace")
+
+
+class LuaCondition:
+    """A condition of a Lua breakpoint, it is a path of a local, upvalue or global variable and its fields,
+optionally compared with a literal, e.g. 'req.headers["host"] == "example.com"' or 'count >= 100'.
+Everything is read with the table lookups of this script, no gdb expression is evaluated."""
+
+    TOKEN = re.compile(r'\s*(?:(?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)|(?P<string>"(?:[^"\\]|\\.)*"|'
+                       r"'(?:[^'\\]|\\.)*')|(?P<name>[A-Za-z_]\w*)|(?P<op>==|~=|<=|>=|<|>|\.|\[|\]))")
+    OPS = {
+        "==": lambda a, b: a == b,
+        "~=": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+    }
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            m = LuaCondition.TOKEN.match(text, pos)
+            if m is None:
+                raise gdb.GdbError("Invalid condition near '%s'" % text[pos:])
+            self.tokens.append((m.lastgroup, m.group(m.lastgroup)))
+            pos = m.end()
+
+        # path [op literal]
+        kind, value = self.next_token()
+        if kind != "name":
+            raise gdb.GdbError("Condition must start with a variable name")
+        self.path = [value]
+        while len(self.tokens) > 0 and self.tokens[0][1] in (".", "["):
+            _, value = self.next_token()
+            if value == ".":
+                kind, value = self.next_token()
+                if kind != "name":
+                    raise gdb.GdbError("Field name expected after '.'")
+                self.path.append(value)
+            else:
+                self.path.append(self.next_literal())
+                if self.next_token()[1] != "]":
+                    raise gdb.GdbError("']' expected")
+        self.op = None
+        self.operand = None
+        if len(self.tokens) > 0:
+            kind, self.op = self.next_token()
+            if self.op not in LuaCondition.OPS:
+                raise gdb.GdbError("Comparison operator expected")
+            self.operand = self.next_literal()
+        if len(self.tokens) > 0:
+            raise gdb.GdbError("Unexpected '%s' in condition" % self.tokens[0][1])
+
+    def next_token(self):
+        if len(self.tokens) == 0:
+            raise gdb.GdbError("Unexpected end of condition")
+        return self.tokens.pop(0)
+
+    def next_literal(self):
+        kind, value = self.next_token()
+        if kind == "number":
+            return long(value) if re.match(r"^-?\d+$", value) else float(value)
+        elif kind == "string":
+            return lua_unescape(value[1:-1])
+        elif kind == "name" and value in ("true", "false", "nil"):
+            return {"true": True, "false": False, "nil": None}[value]
+        raise gdb.GdbError("Literal expected instead of '%s'" % value)
+
+    def get_variable(self, L, name, pc):
+        # 'pc' is the address of the instruction where the breakpoint stops, the locals are the ones active there,
+        # savedpc may not be advanced to it yet, e.g. the parameters at the first instruction of a function
+        ci = L["ci"]
+        func = TValueWrapper(ci["func"].dereference())
+        if func.is_lua_closure():
+            cl = func.get_lua_closure_value()
+            p = cl["p"]
+            pc = (pc - long(p["code"])) // gdb.lookup_type("Instruction").sizeof
+            base = ci["u"]["l"]["base"]
+            ret = None
+            n = 1
+            while True:  # the last active local shadows the others
+                local = lua_getlocalname(p, n, pc)
+                if local is None:
+                    break
+                if local == name:
+                    ret = (base + (n - 1)).dereference()
+                n += 1
+            if ret is not None:
+                return ret
+            for i in range(0, int(cl["nupvalues"])):
+                if lua_upvalname(p, i) == name:
+                    return cl["upvals"][i]["v"].dereference()
+
+        G = lua_getglobalstate(L)
+        return lua_getfield(G, lua_getglobaltable(L), name)
+
+    def evaluate(self, L, pc):
+        G = lua_getglobalstate(L)
+        v = self.get_variable(L, self.path[0], pc)
+        for key in self.path[1:]:
+            v = lua_getfield(G, v, key)
+        value = lua_topython(v)
+        if self.op is None:
+            return value is not None and value is not False
+        try:
+            return LuaCondition.OPS[self.op](value, self.operand)
+        except TypeError:  # ordering between different types
+            return False
+
+
+class LuaBreakpointEngine(gdb.Breakpoint):
+    """A single breakpoint in the VM dispatch loop, it stops only when savedpc is one of the target addresses.
+Any number of Lua breakpoints share it, non-matching hits are rejected by a set lookup."""
+
+    instance = None
+    breakpoints = {}  # number -> LuaBreakpoint
+
+    def __init__(self, spec, pc_offset):
+        gdb.Breakpoint.__init__(self, spec, internal=True)
+        self.silent = True
+        self.pc_offset = pc_offset
+        self.targets = {}  # address -> [LuaBreakpoint]
+
+    def stop(self):
+        try:
+            L = gdb.selected_frame().read_var("L")
+            pc = long(L["ci"]["u"]["l"]["savedpc"]) + self.pc_offset
+        except (ValueError, RuntimeError, gdb.error):
+            return False
+        bps = self.targets.get(pc)
+        if bps is None:
+            return False
+        stop = False
+        for bp in bps:
+            if bp.enabled and bp.should_stop(L, pc):
+                print("Lua breakpoint %d, %s" % (bp.number, bp.location))
+                stop = True
+        return stop
+
+    def add(self, bp):
+        for addr in bp.addresses:
+            self.targets.setdefault(addr, []).append(bp)
+
+    def remove(self, bp):
+        for addr in bp.addresses:
+            bps = self.targets.get(addr)
+            if bps is not None and bp in bps:
+                bps.remove(bp)
+                if len(bps) == 0:
+                    del self.targets[addr]
+
+
+def lua_findvmfetch():
+    # returns (location, savedpc offset) of the instruction fetch in the VM dispatch loop
+    sym = gdb.lookup_global_symbol("luaV_execute")
+    if sym is not None and sym.symtab is not None:
+        try:
+            with open(sym.symtab.fullname(), "r") as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            lines = []
+        for i in range(sym.line, len(lines)):
+            if "vmfetch();" in lines[i]:
+                return "%s:%d" % (sym.symtab.filename, i + 1), 0
+    # savedpc is already increased when the line hook is called
+    print("Source of luaV_execute not found, using luaG_traceexec which is called only when a line hook is set")
+    return "luaG_traceexec", -gdb.lookup_type("Instruction").sizeof
+
+
+def lua_addbreakpoint(location, addresses):
+    engine = LuaBreakpointEngine.instance
+    if engine is None or not engine.is_valid():
+        spec, pc_offset = lua_findvmfetch()
+        engine = LuaBreakpointEngine(spec, pc_offset)
+        LuaBreakpointEngine.instance = engine
+    bp = LuaBreakpoint(location, addresses)
+    LuaBreakpointEngine.breakpoints[bp.number] = bp
+    engine.add(bp)
+    return bp
+
+
+def lua_deletebreakpoint(number):
+    bp = LuaBreakpointEngine.breakpoints.pop(number)
+    engine = LuaBreakpointEngine.instance
+    if engine is not None and engine.is_valid():
+        engine.remove(bp)
+        if len(LuaBreakpointEngine.breakpoints) == 0:  # no overhead when there is no Lua breakpoint
+            engine.delete()
+            LuaBreakpointEngine.instance = None
+
+
+def lua_indexedlocations(index, sources, line, software):
+    # returns [(address, source id)], hardware breakpoints only watch the first instruction of each Proto
+    found = []
+    for _, source, addresses in index.find_line(sources, line):
+        src_id = "%s:%d" % (lua_chunkid(source, LUA_IDSIZE), line)
+        for addr in (addresses if software else addresses[:1]):
+            found.append((addr, src_id))
+    return found
+
+
+def lua_loopstoentry(p):
+    # tells whether a loop of the Proto jumps back to its first instruction, which a breakpoint there can not tell
+    # from a call
+    n = int(p["sizecode"])
+    if n == 0 or not p["code"]:
+        return False
+    for pc, i in enumerate(lua_readarray(p["code"], n, "I")):
+        op = lua_op_getcode(i)
+        if (op == OP_JMP or op == OP_FORLOOP or op == OP_TFORLOOP) and pc + 1 + lua_op_getargsbx(i) == 0:
+            return True
+    return False
+
+
+def lua_setbreakpoints(location, found, software, condition=None):
+    # found: [(address, source id)]
+    if software:
+        if len(found) == 0:
+            print("No bytecode found at %s" % location)
+            return
+        for addr, src_id in found:
+            print("Breakpoint at 0x%x: %s" % (addr, src_id))
+        bp = lua_addbreakpoint(location, [addr for addr, _ in found])
+        bp.condition = condition
+        print("Lua breakpoint %d at %s (%d locations)" % (bp.number, location, len(found)))
+        return
+    cnt = 0
+    for addr, src_id in found:
+        cnt += 1
+        if cnt >= 4:
+            print("Too many breakpoint found, abort")
+            return
+        print("Breakpoint at 0x%x: %s" % (addr, src_id))
+        gdb.execute("rwatch *(int*)0x%x" % addr)
+
+
+# Tracers
+
+
+LUA_GC_TRACE_POINTS = ("luaC_step", "luaC_fullgc", "singlestep")
+LUA_GC_TRACE_FIELDS = ("time", "event", "gcstate", "previous", "totalbytes", "GCdebt")
+
+
+class LuaGCTracePoint(gdb.Breakpoint):
+    """Records the collector state at an entry point of lgc.c, never stops the inferior."""
+
+    def __init__(self, spec, tracer):
+        gdb.Breakpoint.__init__(self, spec, internal=True)
+        self.silent = True
+        self.spec = spec
+        self.tracer = tracer
+
+    def stop(self):
+        try:
+            G = gdb.selected_frame().read_var("L")["l_G"]
+            self.tracer.record(self.spec, G)
+        except (ValueError, RuntimeError, gdb.error):
+            pass
+        return False
+
+
+class LuaGCTracer:
+    """Writes a row per hit of the collector entry points to a CSV or JSONL file, as they happen."""
+
+    instance = None
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self.file = open(path, "w", 1)  # line buffered, the file can be followed while tracing
+        self.count = 0
+        self.states = {}  # global_State* -> gcstate of the last hit
+        self.points = []
+        if fmt == "csv":
+            self.file.write(",".join(LUA_GC_TRACE_FIELDS) + "\n")
+        for spec in LUA_GC_TRACE_POINTS:
+            try:
+                self.points.append(LuaGCTracePoint(spec, self))
+            except RuntimeError:
+                pass  # 'singlestep' may be inlined
+        if len(self.points) == 0:
+            self.file.close()
+            raise gdb.GdbError("No collector entry point is found.")
+
+    def record(self, event, G):
+        state = int(G["gcstate"])
+        name = LUA_GCS_NAMES[state] if 0 <= state < len(LUA_GCS_NAMES) else str(state)
+        previous = self.states.get(long(G))
+        self.states[long(G)] = name
+        row = (time.time(), event, name, previous if previous != name else "", long(G["totalbytes"]),
+               long(G["GCdebt"]))
+        if self.fmt == "csv":
+            self.file.write("%.6f,%s,%s,%s,%d,%d\n" % row)
+        else:
+            self.file.write(json.dumps(dict(zip(LUA_GC_TRACE_FIELDS, row))) + "\n")
+        self.count += 1
+
+    def close(self):
+        for point in self.points:
+            if point.is_valid():
+                point.delete()
+        self.points = []
+        self.file.close()
+
+    @staticmethod
+    def start(path, fmt):
+        LuaGCTracer.stop()
+        LuaGCTracer.instance = LuaGCTracer(path, fmt)
+        return LuaGCTracer.instance
+
+    @staticmethod
+    def stop(_event=None):
+        tracer = LuaGCTracer.instance
+        if tracer is not None:
+            tracer.close()
+            LuaGCTracer.instance = None
+        return tracer
+
+
+LUA_ALLOC_REGISTERS = {"i386:x86-64": ("rsi", "rdx", "rcx")}  # (ptr, osize, nsize) of a lua_Alloc without debug info
+
+
+class LuaAllocProfiler(gdb.Breakpoint):
+    """Attributes the size deltas of the lua_Alloc function to the running Lua instruction, never stops the inferior.
+Only every 'every'-th call is recorded, the (Proto, pc) are decoded to lines only by report()."""
+
+    def __init__(self, spec, every, registers=None):
+        gdb.Breakpoint.__init__(self, spec, internal=True)
+        self.silent = True
+        self.every = every
+        self.registers = registers  # the arguments are read from the registers instead of the variables
+        self.calls = 0
+        self.samples = {}  # (Proto*, pc) or None -> [count, allocated bytes, freed bytes]
+        self.lclosure_ptr = gdb.lookup_type("LClosure").pointer()
+        self.instruction_sizeof = gdb.lookup_type("Instruction").sizeof
+
+    def arguments(self, frame):
+        if self.registers is None:
+            return frame.read_var("ptr"), frame.read_var("osize"), frame.read_var("nsize")
+        return tuple(frame.read_register(r) for r in self.registers)
+
+    def lua_top(self, frame):
+        # finds 'L' in the callers, e.g. luaM_realloc_, returns the (Proto*, pc) of its innermost Lua frame
+        caller = frame.older()
+        depth = 0
+        L = None
+        while caller is not None and depth < 4 and L is None:
+            try:
+                L = caller.read_var("L")
+            except (ValueError, RuntimeError, gdb.error):
+                caller = caller.older()
+                depth += 1
+        if L is None:
+            return None
+        base = L["base_ci"].address
+        ci = L["ci"]
+        while ci and ci != base:  # not cached, the stop cache is not cleared between the hits
+            if (int(ci["callstatus"]) & CIST_LUA) != 0:
+                p = ci["func"]["value_"]["gc"].cast(self.lclosure_ptr)["p"]
+                return long(p), (long(ci["u"]["l"]["savedpc"]) - long(p["code"])) // self.instruction_sizeof - 1
+            ci = ci["previous"]
+        return None
+
+    def stop(self):
+        self.calls += 1
+        if self.calls % self.every != 0:
+            return False
+        try:
+            frame = gdb.selected_frame()
+            ptr, osize, nsize = self.arguments(frame)
+            delta = long(nsize) - (long(osize) if long(ptr) != 0 else 0)  # osize is the object type for new blocks
+            key = self.lua_top(frame)
+        except (ValueError, RuntimeError, gdb.error):
+            return False
+        item = self.samples.setdefault(key, [0, 0, 0])
+        item[0] += 1
+        if delta > 0:
+            item[1] += delta
+        else:
+            item[2] -= delta
+        return False
+
+    def report(self):
+        # returns [(location, count, allocated bytes, freed bytes)] by line, scaled by the sampling interval
+        proto_ptr = gdb.lookup_type("Proto").pointer()
+        functions = {}  # Proto -> (source, linedefined, lineinfo)
+        lines = {}
+        for key, (count, allocated, freed) in self.samples.items():
+            if key is None:
+                location = "[no Lua frame]"
+            else:
+                proto, pc = key
+                info = functions.get(proto)
+                if info is None:
+                    p = gdb.Value(proto).cast(proto_ptr)
+                    src = TStringWrapper(p["source"].dereference()).to_string() if p["source"] else "=?"
+                    n = min(int(p["sizelineinfo"]), int(p["sizecode"]))
+                    info = (lua_chunkid(src, LUA_IDSIZE), int(p["linedefined"]),
+                            lua_readarray(p["lineinfo"], n, "i") if n > 0 and p["lineinfo"] else ())
+                    functions[proto] = info
+                line = info[2][pc] if 0 <= pc < len(info[2]) else -1
+                location = "%s:%d (function at line %d)" % (info[0], line, info[1])
+            item = lines.setdefault(location, [0, 0, 0])
+            item[0] += count * self.every
+            item[1] += allocated * self.every
+            item[2] += freed * self.every
+        return [(location, item[0], item[1], item[2]) for location, item in lines.items()]
+
+
+# Commands
+
+
+class GLuaTraceback(gdb.Command):
+    """glua_traceback [lua_State*]
+Print the stack traceback of the lua_State."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_traceback", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+        else:
+            L = gdb.parse_and_eval("L")
+
+        idx = 0
+        ci = CallInfoWrapper(L["ci"].dereference())
+        print("stack traceback:")
+        while ci.value.address != L["base_ci"].address:
+            ar = lua_getinfo(L, "nSlt", ci.value)
+            print("\t#%d  %s" % (idx, str(ar)))
+            idx += 1
+            ci = ci.get_prev()
+
+
+class GLuaStackInfo(gdb.Command):
+    """glua_stackinfo [lua_State* [index]]
+Print the stack info and all the variables of the current stack frame or the specific stack frame."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_stackinfo", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        idx = 0
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            if len(argv) > 1:
+                idx = int(gdb.parse_and_eval(argv[1]))
+        else:
+            L = gdb.parse_and_eval("L")
+
+        i = 0
+        ci = CallInfoWrapper(L["ci"].dereference())
+        while ci.value.address != L["base_ci"].address and i < idx:
+            ci = ci.get_prev()
+            i += 1
+        if ci.value.address == L["base_ci"].address or i != idx:
+            raise RuntimeError("Frame index out of range")
+
+        ar = lua_getinfo(L, "nSlt", ci.value)
+        print("#%d  %s" % (idx, str(ar)))
+
+        func = ci.get_func()
+        t = TValueWrapper(func.dereference())
+
+        # Native function
+        if t.is_light_c_function() or t.is_c_closure():
+            print("\nNative stack values:")
+            base = ci.get_base()
+            if idx == 0:
+                top = L["top"]
+            else:
+                next = ci.get_next()
+                if next.is_lua():
+                    top = next.get_func() + 1
+                else:
+                    top = next.get_base()
+            p = top - 1
+            while p >= base:
+                print("\t#%d  %s" % (p - base + 1, TValuePointerPrinter(p).to_string(with_address=True, show_string=True)))
+                p = p - 1
+
+            if t.is_c_closure():
+                cl = t.get_c_closure_value()
+                nupvalues = cl["nupvalues"]
+                if nupvalues > 0:
+                    print("\nUpvalues:")
+                    for i in range(0, nupvalues):
+                        upval = cl["upvalue"][i]
+                        print("\t#%d  %s" % (i, TValuePointerPrinter(upval.address).to_string(with_address=True, show_string=True)))
+        else:  # Lua function
+            assert ci.is_lua()
+
+            # arguments
+            f = t.get_lua_closure_value()["p"]
+            nparams = f["numparams"]
+            nvarparams = ((ci.get_lua_base() - 1) - ci.get_func()) - nparams
+
+            if not (nparams == 0 and nvarparams == 0):
+                print("\nParameters:")
+                for i in range(0, nparams):
+                    val = ci.get_lua_base() + i
+                    name = lua_getlocalname(f, i + 1, ci.get_current_pc())
+                    if name is None:
+                        limit = L["top"] if ci.value.address == L["ci"] else ci.get_next().get_func()
+                        if limit - ci.get_lua_base() >= i + 1 > 0:
+                            name = "(*temporary)"
+                        else:
+                            name = "(?)"
+                    print("\t#%d  %s = %s" % (i + 1, name, TValuePointerPrinter(val).to_string(with_address=True, show_string=True)))
+
+                for i in range(-nvarparams, 0):
+                    val = ci.get_lua_base() + i
+                    print("\t#%d  (*vararg) = %s" % (i, TValuePointerPrinter(val).to_string(with_address=True, show_string=True)))
+
+            # local variables
+            if idx == 0:
+                top = L["top"]
+            else:
+                next = ci.get_next()
+                if next.is_lua():
+                    top = next.get_func()
+                else:
+                    top = next.get_base() - 1
+            loc_base = ci.get_lua_base() + nparams
+
+            if top - loc_base > 1:
+                print("\nLocals:")
+                for i in range(0, top - loc_base):
+                    val = ci.get_lua_base() + nparams + i
+                    name = lua_getlocalname(f, i + 1 + nparams, ci.get_current_pc())
+                    if name is None:
+                        limit = L["top"] if ci.value.address == L["ci"] else ci.get_next().get_func()
+                        if limit - ci.get_lua_base() >= i + 1 > 0:
+                            name = "(*temporary)"
+                        else:
+                            name = "(?)"
+                    print("\t#%d  %s = %s" % (i + 1 + nparams, name, TValuePointerPrinter(val).to_string(with_address=True,
+                                                                                                         show_string=True)))
+
+            # upvalues
+            cl = t.get_lua_closure_value()
+            nupvalues = cl["nupvalues"]
+            if nupvalues > 0:
+                print("\nUpvalues:")
+                for i in range(0, nupvalues):
+                    upval = cl["upvals"][i]["v"]
+                    name = lua_upvalname(f, i)
+                    print("\t#%d  %s = %s" % (i + 1, name, TValuePointerPrinter(upval).to_string(with_address=True, show_string=True)))
+
+
+class GLuaObjectInfo(gdb.Command):
+    """glua_objectinfo [lua_State*]
+Print the memory usage of all the gc objects."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_objectinfo", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+        else:
+            L = gdb.parse_and_eval("L")
+
+        G = lua_getglobalstate(L)
+        stat, cnt = lua_objectstatistic(G)
+
+        def item(*kinds):
+            return sum(stat.get(k, [0, 0])[0] for k in kinds), sum(stat.get(k, [0, 0])[1] for k in kinds)
+
+        print("GC Object Statistic:")
+        print("\tUserdata:      \t%d (%d bytes)" % item(LUA_OBJ_USERDATA))
+        print("\tTable:         \t%d (%d bytes)" % item(LUA_OBJ_TABLE))
+        print("\tPrototype:     \t%d (%d bytes)" % item(LUA_OBJ_PROTO))
+        print("\tCoroutine:     \t%d (%d bytes)" % item(LUA_OBJ_THREAD))
+        print("\tString:        \t%d (%d bytes)" % item(LUA_OBJ_SHORT_STRING, LUA_OBJ_LONG_STRING))
+        print("\t  Short String:\t%d (%d bytes)" % item(LUA_OBJ_SHORT_STRING))
+        print("\t  Long String: \t%d (%d bytes)" % item(LUA_OBJ_LONG_STRING))
+        print("\tClosure:       \t%d (%d bytes)" % item(LUA_OBJ_C_CLOSURE, LUA_OBJ_LUA_CLOSURE))
+        print("\t  C Closure:   \t%d (%d bytes)" % item(LUA_OBJ_C_CLOSURE))
+        print("\t  Lua Closure: \t%d (%d bytes)" % item(LUA_OBJ_LUA_CLOSURE))
+        print("Total %d objects" % cnt)
+        print("      %d bytes" % sum(v[1] for v in stat.values()))
+
+
+class GLuaClosures(gdb.Command):
+    """glua_closures [-n top] [lua_State*]
+Count the live Lua closures of each prototype, with the memory used by the closures and their upvalues."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_closures", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        top = 20
+        if len(argv) > 1 and argv[0] == "-n":
+            top = int(argv[1])
+            argv = argv[2:]
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+        else:
+            L = gdb.parse_and_eval("L")
+
+        items = lua_report_closures(lua_getglobalstate(L), top)
+        print("%-10s %-12s %-10s %-12s %s" % ("Closures", "Bytes", "Upvalues", "Bytes", "Prototype"))
+        for item in items:
+            print("%-10d %-12d %-10d %-12d (Proto *) 0x%x %s" % (
+                item["closures"], item["bytes"], item["upvalues"], item["upvalue_bytes"], item["proto"],
+                item["source"]))
+
+
+class GLuaClasses(gdb.Command):
+    """glua_classes [-n top] [lua_State*]
+Group the tables and the full userdata by their metatables, print the instance count and the memory of each class."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_classes", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        top = 20
+        if len(argv) > 1 and argv[0] == "-n":
+            top = int(argv[1])
+            argv = argv[2:]
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+        else:
+            L = gdb.parse_and_eval("L")
+
+        items = lua_report_classes(lua_getglobalstate(L), top)
+        print("%-10s %-12s %-10s %-10s %s" % ("Count", "Bytes", "Tables", "Userdata", "Class"))
+        for item in items:
+            print("%-10d %-12d %-10d %-10d %s" % (
+                item["count"], item["bytes"], item["tables"], item["userdata"], item["name"]))
+
+
+class GLuaThreads(gdb.Command):
+    """glua_threads [-n top] [lua_State*]
+List the main thread and the coroutines with their status, stack and CallInfo usage, open upvalues and current function.
+The threads are sorted by the memory luaD_shrinkstack and luaE_shrinkCI could give back."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_threads", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        top = 20
+        if len(argv) > 1 and argv[0] == "-n":
+            top = int(argv[1])
+            argv = argv[2:]
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+        else:
+            L = gdb.parse_and_eval("L")
+
+        report = lua_report_threads(lua_getglobalstate(L), top, L)
+        print("%-20s %-10s %-12s %-10s %-8s %s" % ("Thread", "Status", "Stack", "CallInfo", "Upvals", "Function"))
+        for info in report["threads"]:
+            print("0x%-18x %-10s %-12s %-10s %-8d %s" % (
+                info["address"], info["status"], "%d/%d" % (info["used"], info["stacksize"]),
+                "%d/%d" % (info["depth"], info["callinfo"]), info["open_upvalues"], info["function"]))
+        print("Total %d threads (%s)" % (report["count"], ", ".join(
+            "%d %s" % (v, k) for k, v in sorted(report["status"].items()))))
+        print("      %d bytes of stack, %d bytes over-allocated" % (report["stack_bytes"], report["spare_bytes"]))
+        print("      %d bytes of unused CallInfo" % report["spare_callinfo_bytes"])
+
+
+class GLuaRefs(gdb.Command):
+    """glua_refs [-n top] [-s file] [-c file] [lua_State*]
+Analyse the luaL_ref references in the registry: the count of references, the length of the freelist and the
+distribution of the referenced values by type, class and function.
+Use -s to save the result into a file, and -c to compare with a result saved before."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_refs", gdb.COMMAND_DATA, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        top = 20
+        save = None
+        compare = None
+        while len(argv) > 0 and argv[0].startswith("-"):
+            opt = argv.pop(0)
+            if opt == "-n" and len(argv) > 0:
+                top = int(argv.pop(0))
+            elif opt == "-s" and len(argv) > 0:
+                save = argv.pop(0)
+            elif opt == "-c" and len(argv) > 0:
+                compare = argv.pop(0)
+            else:
+                raise gdb.GdbError("Unknown option %s" % opt)
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+        else:
+            L = gdb.parse_and_eval("L")
+
+        previous = None
+        if compare is not None:
+            with open(compare, "r") as f:
+                previous = json.load(f)
+        report = lua_report_refs(lua_getglobalstate(L))
+        if save is not None:
+            with open(save, "w") as f:
+                json.dump(report, f)
+
+        def delta(current, key):
+            return " (%+d)" % (current - previous.get(key, 0)) if previous is not None else ""
+
+        print("Registry: %d references%s, %d free slots%s, max reference %d" % (
+            report["refs"], delta(report["refs"], "refs"), report["free"], delta(report["free"], "free"),
+            report["max_ref"]))
+        categories = report["categories"]
+        if previous is not None:
+            before = previous.get("categories", {})
+            names = set(categories.keys()) | set(before.keys())
+            rows = [(name, categories.get(name, 0), categories.get(name, 0) - before.get(name, 0)) for name in names]
+            rows.sort(key=lambda row: (-row[2], -row[1]))
+        else:
+            rows = sorted(((name, count, 0) for name, count in categories.items()), key=lambda row: -row[1])
+        print("%-10s %-10s %s" % ("Count", "Delta" if previous is not None else "", "Value"))
+        for name, count, diff in rows[0:top]:
+            print("%-10d %-10s %s" % (count, ("%+d" % diff) if previous is not None else "", name))
+
+
+class GLuaGCQueues(gdb.Command):
+    """glua_gcqueues [-n top] [lua_State*]
+Print the objects on the weak, ephemeron and allweak lists, the objects waiting for their finalizers on the finobj and
+tobefnz lists, and the tables with a weak mode."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_gcqueues", gdb.COMMAND_DATA, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        top = 20
+        if len(argv) > 1 and argv[0] == "-n":
+            top = int(argv[1])
+            argv = argv[2:]
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+        else:
+            L = gdb.parse_and_eval("L")
+
+        report = lua_report_gcqueues(lua_getglobalstate(L), top)
+        print("GC Lists:")
+        for name in LUA_GRAY_LISTS + LUA_FINALIZER_LISTS:
+            stat = report["lists"][name]
+            print("\t%-10s\t%d (%d bytes)" % (
+                name + ":", sum(v["count"] for v in stat.values()), sum(v["bytes"] for v in stat.values())))
+            for kind, v in sorted(stat.items()):
+                print("\t  %-10s\t%d (%d bytes)" % (kind + ":", v["count"], v["bytes"]))
+        if report["gcstate"] not in (LUA_GCS_PROPAGATE, LUA_GCS_ATOMIC):
+            print("\t(the weak lists are only filled during the propagate and atomic states)")
+        print("Weak Tables:")
+        for mode, v in sorted(report["weak_tables"].items()):
+            print("\t__mode=%-4s\t%d (%d bytes, %d entries)" % (mode, v["count"], v["bytes"], v["entries"]))
+        for item in report["top_weak_tables"]:
+            print("\t(Table *) 0x%x\t__mode=%s\t%d entries (%d bytes)\t%s" % (
+                item["address"], item["mode"], item["entries"], item["bytes"], item["class"]))
+
+
+class GLuaGCState(gdb.Command):
+    """glua_gcstate [lua_State*]
+Print the state of the garbage collector and predict the allocation left before the current cycle completes."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_gcstate", gdb.COMMAND_DATA, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+        else:
+            L = gdb.parse_and_eval("L")
+
+        state = lua_gcstate(lua_getglobalstate(L))
+        print("GC State:")
+        print("\tgcstate:    \t%s" % state["gcstate"])
+        print("\tgckind:     \t%s%s" % (state["gckind"], "" if state["gcrunning"] else " (stopped)"))
+        print("\ttotalbytes: \t%d" % state["totalbytes"])
+        print("\tGCdebt:     \t%d" % state["GCdebt"])
+        print("\tGCestimate: \t%d" % state["GCestimate"])
+        print("\tgcpause:    \t%d%%" % state["gcpause"])
+        print("\tgcstepmul:  \t%d%%" % state["gcstepmul"])
+        if "sweep_list" in state:
+            print("\tsweepgc:    \t%s, %d objects left" % (state["sweep_list"], state["sweep_left"]))
+        print("Heap size %d bytes" % state["heap_bytes"])
+        if state["gcstate"] == LUA_GCS_NAMES[LUA_GCS_PAUSE]:
+            print("Next cycle starts at %d bytes, in %d bytes" % (state["pause_threshold"], state["next_step_bytes"]))
+        else:
+            print("Next step in %d bytes" % state["next_step_bytes"])
+        if state["cycle_bytes"] is not None:
+            print("Cycle completes in about %d bytes" % state["cycle_bytes"])
+
+
+class GLuaGCTrace(gdb.Command):
+    """glua_gctrace start [-f csv|jsonl] file | stop
+Record the time, the gcstate transitions and totalbytes at every hit of luaC_step, luaC_fullgc and singlestep into a
+file, the inferior is continued automatically. The format is guessed from the file extension by default."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_gctrace", gdb.COMMAND_RUNNING, gdb.COMPLETE_FILENAME)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        if len(argv) == 1 and argv[0] == "stop":
+            tracer = LuaGCTracer.stop()
+            if tracer is None:
+                raise gdb.GdbError("The GC tracer is not started.")
+            print("%d GC events written to %s" % (tracer.count, tracer.path))
+            return
+        if len(argv) == 0 or argv[0] != "start":
+            raise gdb.GdbError("Usage: glua_gctrace start [-f csv|jsonl] file | stop")
+        argv = argv[1:]
+        fmt = None
+        if len(argv) > 1 and argv[0] == "-f":
+            fmt = argv[1]
+            argv = argv[2:]
+        if len(argv) != 1:
+            raise gdb.GdbError("Usage: glua_gctrace start [-f csv|jsonl] file | stop")
+        if fmt is None:
+            fmt = "csv" if argv[0].endswith(".csv") else "jsonl"
+        elif fmt not in ("csv", "jsonl"):
+            raise gdb.GdbError("Unknown format %s" % fmt)
+        tracer = LuaGCTracer.start(argv[0], fmt)
+        print("Tracing %s into %s" % (", ".join(p.spec for p in tracer.points), tracer.path))
+
+
+class GLuaAllocProf(gdb.Command):
+    """glua_allocprof [-n top] [-e every] [-o file] [lua_State*] seconds
+Break on the lua_Alloc function of the state for 'seconds' and attribute the allocated and freed bytes of every
+'every'-th call to the running Lua line, the inferior is continued automatically."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_allocprof", gdb.COMMAND_RUNNING, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        top = 20
+        every = 1
+        output = None
+        while len(argv) > 0 and argv[0].startswith("-"):
+            opt = argv.pop(0)
+            if opt == "-n" and len(argv) > 0:
+                top = int(argv.pop(0))
+            elif opt == "-e" and len(argv) > 0:
+                every = max(1, int(argv.pop(0)))
+            elif opt == "-o" and len(argv) > 0:
+                output = argv.pop(0)
+            else:
+                raise gdb.GdbError("Unknown option %s" % opt)
+        if len(argv) > 1:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            argv = argv[1:]
+        elif len(argv) == 1:
+            L = gdb.parse_and_eval("L")
+        else:
+            raise gdb.GdbError("Usage: glua_allocprof [-n top] [-e every] [-o file] [lua_State*] seconds")
+        seconds = float(argv[0])
+
+        addr = long(lua_getglobalstate(L)["frealloc"])
+        try:
+            block = gdb.block_for_pc(addr)
+        except RuntimeError:
+            block = None
+        if block is not None and block.function is not None:
+            profiler = LuaAllocProfiler(block.function.print_name, every)
+        else:
+            registers = LUA_ALLOC_REGISTERS.get(gdb.selected_frame().architecture().name())
+            if registers is None:
+                raise gdb.GdbError("No debug info for the lua_Alloc function at 0x%x." % addr)
+            profiler = LuaAllocProfiler("*0x%x" % addr, every, registers)
+        try:
+            lua_runinferior(seconds)
+        finally:
+            profiler.delete()
+
+        rows = sorted(profiler.report(), key=lambda row: -row[2])[0:top]
+        lines = ["%-12s %-12s %-10s %s" % ("Allocated", "Freed", "Calls", "Location")]
+        lines += ["%-12d %-12d %-10d %s" % (allocated, freed, count, location)
+                  for location, count, allocated, freed in rows]
+        lines.append("Total %d calls of %s, %d recorded" % (
+            profiler.calls, lua_pcsymbol(addr), sum(v[0] for v in profiler.samples.values())))
+        if output is not None:
+            with open(output, "w") as f:
+                for line in lines:
+                    f.write(line + "\n")
+            print("Report written to %s" % output)
+        else:
+            for line in lines:
+                print(line)
+
+
+class GLuaWatchMem(gdb.Command):
+    """glua_watchmem [-k ticks] [-s every] [-n top] [-o file] [lua_State*] interval duration
+Interrupt the inferior every 'interval' seconds during 'duration' seconds and print the heap size as a time series.
+Every 'ticks'-th tick a census by type and metatable is taken from every 'every'-th object."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_watchmem", gdb.COMMAND_RUNNING, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        ticks = 10
+        every = 16
+        top = 5
+        output = None
+        while len(argv) > 0 and argv[0].startswith("-"):
+            opt = argv.pop(0)
+            if opt == "-k" and len(argv) > 0:
+                ticks = int(argv.pop(0))
+            elif opt == "-s" and len(argv) > 0:
+                every = max(1, int(argv.pop(0)))
+            elif opt == "-n" and len(argv) > 0:
+                top = int(argv.pop(0))
+            elif opt == "-o" and len(argv) > 0:
+                output = argv.pop(0)
             else:
-                next = ci.get_next()
-                if next.is_lua():
-                    top = next.get_func()
-                else:
-                    top = next.get_base() - 1
-            loc_base = ci.get_lua_base() + nparams
+                raise gdb.GdbError("Unknown option %s" % opt)
+        if len(argv) > 2:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            argv = argv[1:]
+        elif len(argv) == 2:
+            L = gdb.parse_and_eval("L")
+        else:
+            raise gdb.GdbError("Usage: glua_watchmem [-k ticks] [-s every] [-n top] [-o file] [lua_State*] "
+                               "interval duration")
+        interval = float(argv[0])
+        duration = float(argv[1])
+
+        state_address = long(L)  # the values read before are stale once the inferior resumes
+        state_ptr = L.type
+        f = open(output, "w") if output is not None else None
+        try:
+            start = time.time()
+            first = None
+            tick = 0
+            for _ in lua_sampleinferior(duration, 1.0 / interval):
+                G = lua_getglobalstate(gdb.Value(state_address).cast(state_ptr))
+                heap = long(G["totalbytes"]) + long(G["GCdebt"])
+                first = heap if first is None else first
+                state = int(G["gcstate"])
+                row = {
+                    "time": time.time() - start,
+                    "heap_bytes": heap,
+                    "gcstate": LUA_GCS_NAMES[state] if 0 <= state < len(LUA_GCS_NAMES) else str(state),
+                }
+                tick += 1
+                if ticks > 0 and tick % ticks == 0:
+                    census, cnt = lua_sampledcensus(G, every)
+                    names = LuaClassNames.get(G)
+                    row["objects"] = cnt
+                    row["census"] = [{
+                        "type": kind,
+                        "class": names.name(mt) if kind in (LUA_OBJ_TABLE, LUA_OBJ_USERDATA) else None,
+                        "count": v[0],
+                        "bytes": v[1],
+                    } for (kind, mt), v in heapq.nlargest(top, census.items(), key=lambda item: item[1][1])]
+                if f is not None:
+                    f.write(json.dumps(row) + "\n")
+                    continue
+                print("%8.1fs\t%d bytes\t%+d\t%s" % (row["time"], heap, heap - first, row["gcstate"]))
+                for item in row.get("census", []):
+                    name = item["type"] if item["class"] is None else "%s %s" % (item["type"], item["class"])
+                    print("\t\t~%d objects, ~%d bytes\t%s" % (item["count"], item["bytes"], name))
+        finally:
+            if f is not None:
+                f.close()
+                print("%d ticks written to %s" % (tick, output))
 
-            if top - loc_base > 1:
-                print("\nLocals:")
-                for i in range(0, top - loc_base):
-                    val = ci.get_lua_base() + nparams + i
-                    name = lua_getlocalname(f, i + 1 + nparams, ci.get_current_pc())
-                    if name is None:
-                        limit = L["top"] if ci.value.address == L["ci"] else ci.get_next().get_func()
-                        if limit - ci.get_lua_base() >= i + 1 > 0:
-                            name = "(*temporary)"
-                        else:
-                            name = "(?)"
-                    print("\t#%d  %s = %s" % (i + 1 + nparams, name, TValuePointerPrinter(val).to_string(with_address=True,
-                                                                                                         show_string=True)))
 
-            # upvalues
-            cl = t.get_lua_closure_value()
-            nupvalues = cl["nupvalues"]
-            if nupvalues > 0:
-                print("\nUpvalues:")
-                for i in range(0, nupvalues):
-                    upval = cl["upvals"][i]["v"]
-                    name = lua_upvalname(f, i)
-                    print("\t#%d  %s = %s" % (i + 1, name, TValuePointerPrinter(upval).to_string(with_address=True, show_string=True)))
+class GLuaReferrers(gdb.Command):
+    """glua_referrers [-n max] [lua_State*] address
+Print every gc object referring to the object at the address, and how it refers to it.
+The reverse index is built in one heap pass and reused until the inferior resumes."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_referrers", gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
 
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        limit = 100
+        if len(argv) > 1 and argv[0] == "-n":
+            limit = int(argv[1])
+            argv = argv[2:]
+        if len(argv) > 1:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            argv = argv[1:]
+        elif len(argv) == 1:
+            L = gdb.parse_and_eval("L")
+        else:
+            raise gdb.GdbError("Usage: glua_referrers [-n max] [lua_State*] address")
+        addr = long(gdb.parse_and_eval(argv[0]))
 
-class GLuaObjectInfo(gdb.Command):
-    """glua_objectinfo [lua_State*]
-Print the memory usage of all the gc objects."""
+        G = lua_getglobalstate(L)
+        index = LuaReferrerIndex.get(G)
+        referrers = index.referrers(addr)
+        print("%d referrers of 0x%x (%d objects, %d references indexed)" % (
+            len(referrers), addr, index.objects, len(index.targets)))
+        tu = gdb.lookup_type("union GCUnion").pointer()
+        sizer = LuaObjectSizer()
+        walker = LuaHeapEdges(G)
+        for source in referrers[0:limit]:
+            obj = gdb.Value(source).cast(tu)
+            kind, _ = sizer.size(obj)
+            labels = [walker.label_text(label) for target, label in walker.edges(obj, True) if target == addr]
+            print("\t(%s *) 0x%x\t%s" % (LUA_OBJ_CTYPES.get(kind, "GCObject"), source, ", ".join(labels)))
+        if len(referrers) > limit:
+            print("\t... %d more" % (len(referrers) - limit))
+
+
+class GLuaFind(gdb.Command):
+    """glua_find [-n max] [lua_State*] key|keyre|string|number|address pattern
+Search all the tables for a string key, a key matching a regular expression, or a string, number or gc object value.
+Gc object addresses are also searched in the keys."""
 
     def __init__(self):
-        gdb.Command.__init__(self, "glua_objectinfo", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+        gdb.Command.__init__(self, "glua_find", gdb.COMMAND_DATA, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        limit = 100
+        if len(argv) > 1 and argv[0] == "-n":
+            limit = int(argv[1])
+            argv = argv[2:]
+        if len(argv) > 2:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            argv = argv[1:]
+        elif len(argv) == 2:
+            L = gdb.parse_and_eval("L")
+        else:
+            raise gdb.GdbError("Usage: glua_find [-n max] [lua_State*] %s pattern" % "|".join(LUA_FIND_MODES))
+
+        G = lua_getglobalstate(L)
+        matcher = LuaTableMatcher(G, argv[0], argv[1])
+        names = LuaClassNames.get(G)
+        walker = LuaHeapEdges(G)
+        table_ptr = gdb.lookup_type("Table").pointer()
+        found = 0
+        for table, k in lua_findtables(G, matcher):
+            found += 1
+            if found <= limit:
+                mt = long(gdb.Value(table).cast(table_ptr)["metatable"])
+                print("(Table *) 0x%x\t%s\t%s" % (table, walker.key_label(k), names.name(mt) if mt != 0 else ""))
+        if found > limit:
+            print("... %d more" % (found - limit))
+        print("%d found" % found)
+
+
+class GLuaModules(gdb.Command):
+    """glua_modules [-n top] [-s] [lua_State*]
+Account the memory of the modules in package.loaded: the memory reachable from a module only is exclusive, the memory
+also reachable from another module is shared, the weak references of the tables are not followed. The modules are
+sorted by the exclusive bytes, or the shared with -s."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_modules", gdb.COMMAND_DATA, gdb.COMPLETE_NONE)
 
     def invoke(self, args, _from_tty):
         argv = gdb.string_to_argv(args)
+        top = 20
+        shared = False
+        while len(argv) > 0 and argv[0].startswith("-"):
+            opt = argv.pop(0)
+            if opt == "-n" and len(argv) > 0:
+                top = int(argv.pop(0))
+            elif opt == "-s":
+                shared = True
+            else:
+                raise gdb.GdbError("Unknown option %s" % opt)
         if len(argv) > 0:
             t = gdb.lookup_type("lua_State").pointer()
             L = gdb.parse_and_eval(argv[0]).cast(t)
@@ -1916,123 +5465,144 @@ Print the memory usage of all the gc objects."""
             L = gdb.parse_and_eval("L")
 
         G = lua_getglobalstate(L)
+        modules = lua_modulememory(G)
+        modules.sort(key=lambda item: -item[2] if shared else -item[1])
+        print("%-14s %-10s %-14s %-10s %s" % ("Exclusive", "Objects", "Shared", "Objects", "Module"))
+        for name, exclusive, shared_sz, exclusive_objects, objects in modules[0:top]:
+            print("%-14d %-10d %-14d %-10d %s" % (exclusive, exclusive_objects, shared_sz,
+                                                  objects - exclusive_objects, name))
+        graph = LuaHeapGraph.get(G)
+        print("%d modules, %d objects (%d bytes) in the heap" % (len(modules), len(graph), sum(graph.sizes)))
+
+
+class GLuaDump(gdb.Command):
+    """glua_dump value file [--depth N] [--format json|lua] [--max-string N] [--max-items N] [--state lua_State*]
+Write a TValue, TValue* or Table* and the tables reachable from it into a file as JSON or a Lua literal.
+The tables met again are written as references to their ids, the strings and the tables larger than the caps are
+truncated. The Lua format is a chunk which rebuilds the shared tables and the cycles."""
 
-        s_string_count = 0
-        s_string_size = 0
-        l_string_count = 0
-        l_string_size = 0
-        table_count = 0
-        table_size = 0
-        userdata_count = 0
-        userdata_size = 0
-        proto_count = 0
-        proto_size = 0
-        coroutine_count = 0
-        coroutine_size = 0
-        c_closure_count = 0
-        c_closure_size = 0
-        l_closure_count = 0
-        l_closure_size = 0
-
-        tvalue_sizeof = gdb.lookup_type("TValue").sizeof
-        tstring_sizeof = gdb.lookup_type("TString").sizeof
-        table_sizeof = gdb.lookup_type("Table").sizeof
-        userdata_sizeof = gdb.lookup_type("Udata").sizeof
-        proto_sizeof = gdb.lookup_type("Proto").sizeof
-        coroutine_sizeof = gdb.lookup_type("lua_State").sizeof
-        c_closure_sizeof = gdb.lookup_type("CClosure").sizeof
-        l_closure_sizeof = gdb.lookup_type("LClosure").sizeof
-        upval_sizeof = gdb.lookup_type("UpVal").sizeof
-        node_sizeof = gdb.lookup_type("Node").sizeof
-        instruction_sizeof = gdb.lookup_type("Instruction").sizeof
-        proto_ptr_sizeof = gdb.lookup_type("Proto").pointer().sizeof
-        int_sizeof = gdb.lookup_type("int").sizeof
-        locvar_sizeof = gdb.lookup_type("LocVar").sizeof
-        upvaldesc_sizeof = gdb.lookup_type("Upvaldesc").sizeof
-        callinfo_sizeof = gdb.lookup_type("CallInfo").sizeof
-
-        cnt = 0
-        tu = gdb.lookup_type("union GCUnion").pointer()
-        obj = G["allgc"].cast(tu)
-        while obj:
-            tag = obj["gc"]["tt"]
-            tnov = tag & 0x0F
-            if tnov == LUA_TSTRING:
-                ts = TStringWrapper(obj["ts"])
-                if tag == LUA_TSHRSTR:
-                    s_string_size += ts.get_length() + tstring_sizeof
-                    s_string_count += 1
-                else:
-                    l_string_size += ts.get_length() + tstring_sizeof
-                    l_string_count += 1
-            elif tnov == LUA_TUSERDATA:
-                us = UDataWrapper(obj["u"])
-                userdata_size += us.get_length() + userdata_sizeof
-                userdata_count += 1
-            elif tnov == LUA_TFUNCTION:
-                cl = obj["cl"]
-                if tag == LUA_TCCL:
-                    upvalues = max(1, int(cl["c"]["nupvalues"]))
-                    c_closure_size += tvalue_sizeof * (upvalues - 1) + c_closure_sizeof
-                    c_closure_count += 1
-                else:
-                    upvalues = max(1, int(cl["l"]["nupvalues"]))
-                    l_closure_size += upval_sizeof * (upvalues - 1) + l_closure_sizeof
-                    l_closure_count += 1
-            elif tnov == LUA_TTABLE:
-                table = obj["h"]
-                array_count = table["sizearray"]
-                node_count = (1 << int(table["lsizenode"]))
-                table_size += tvalue_sizeof * array_count + table_sizeof
-                if table["lastfree"]:
-                    table_size += node_sizeof * node_count
-                table_count += 1
-            elif tnov == LUA_TPROTO:
-                f = obj["p"]
-                sz = f["sizecode"] * instruction_sizeof + f["sizep"] * proto_ptr_sizeof + f["sizek"] * tvalue_sizeof +\
-                     f["sizelineinfo"] * int_sizeof + f["sizelocvars"] * locvar_sizeof + f["sizeupvalues"] * upvaldesc_sizeof
-                proto_size += sz + proto_sizeof
-                proto_count += 1
-            elif tnov == LUA_TTHREAD:
-                # CallInfo Chain
-                l = obj["th"]
-                ci = l["base_ci"]
-                sz = 0
-                while ci:
-                    sz += callinfo_sizeof
-                    ci = ci["next"]
-                sz += l["stacksize"] * tvalue_sizeof
-                coroutine_size += sz + coroutine_sizeof
-                coroutine_count += 1
-
-            cnt += 1
-            obj = obj["gc"]["next"].cast(tu)
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_dump", gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
 
-        print("GC Object Statistic:")
-        print("\tUserdata:      \t%d (%d bytes)" % (userdata_count, userdata_size))
-        print("\tTable:         \t%d (%d bytes)" % (table_count, table_size))
-        print("\tPrototype:     \t%d (%d bytes)" % (proto_count, proto_size))
-        print("\tCoroutine:     \t%d (%d bytes)" % (coroutine_count, coroutine_size))
-        print("\tString:        \t%d (%d bytes)" % (s_string_count + l_string_count, s_string_size + l_string_size))
-        print("\t  Short String:\t%d (%d bytes)" % (s_string_count, s_string_size))
-        print("\t  Long String: \t%d (%d bytes)" % (l_string_count, l_string_size))
-        print("\tClosure:       \t%d (%d bytes)" % (c_closure_count + l_closure_count, c_closure_size + l_closure_size))
-        print("\t  C Closure:   \t%d (%d bytes)" % (c_closure_count, c_closure_size))
-        print("\t  Lua Closure: \t%d (%d bytes)" % (l_closure_count, l_closure_size))
-        print("Total %d objects" % cnt)
-        print("      %d bytes" % (userdata_size + table_size + proto_size + coroutine_size + s_string_size + l_string_size +\
-                                  c_closure_size + l_closure_size))
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        options = {"--depth": 16, "--max-string": 4096, "--max-items": 100000}
+        fmt = None
+        state = "L"
+        positional = []
+        while len(argv) > 0:
+            arg = argv.pop(0)
+            if arg == "--format" and len(argv) > 0:
+                fmt = argv.pop(0)
+                if fmt not in LUA_DUMP_FORMATS:
+                    raise gdb.GdbError("Unknown format %s" % fmt)
+            elif arg == "--state" and len(argv) > 0:
+                state = argv.pop(0)
+            elif arg in options and len(argv) > 0:
+                try:
+                    options[arg] = int(argv.pop(0))
+                except ValueError:
+                    raise gdb.GdbError("%s expects an integer" % arg)
+            elif arg.startswith("--"):
+                raise gdb.GdbError("Unknown option %s" % arg)
+            else:
+                positional.append(arg)
+        if len(positional) != 2:
+            raise gdb.GdbError("Usage: glua_dump value file [--depth N] [--format json|lua] [--max-string N] "
+                               "[--max-items N] [--state lua_State*]")
+        expr, output = positional
+        if fmt is None:
+            fmt = "lua" if output.endswith(".lua") else "json"
+
+        v = lua_tovalue(gdb.parse_and_eval(expr))
+        G = lua_getglobalstate(gdb.parse_and_eval(state).cast(gdb.lookup_type("lua_State").pointer()))
+        dumper = LuaValueDumper(G, fmt, options["--depth"], options["--max-string"], options["--max-items"])
+        written = 0
+        with open(output, "w") as f:
+            for chunk in dumper.dump(v):
+                f.write(chunk)
+                written += len(chunk)
+        print("%d tables, %d bytes written to %s" % (len(dumper.ids), written, output))
+
+
+class GLuaHeapSnapshot(gdb.Command):
+    """glua_heapsnapshot [lua_State*] file
+Export the heap as a V8 .heapsnapshot file, which can be loaded by the memory panel of the Chrome DevTools.
+The nodes are named by their type and class, source or C function, the edges by the table keys or upvalue names."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_heapsnapshot", gdb.COMMAND_DATA, gdb.COMPLETE_FILENAME)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        if len(argv) > 1:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            argv = argv[1:]
+        elif len(argv) == 1:
+            L = gdb.parse_and_eval("L")
+        else:
+            raise gdb.GdbError("Usage: glua_heapsnapshot [lua_State*] file")
+
+        G = lua_getglobalstate(L)
+        with open(argv[0], "w") as f:
+            for chunk in lua_heapsnapshot(G):
+                f.write(chunk)
+        graph = LuaHeapGraph.get(G, True)
+        print("%d objects, %d strings written to %s" % (len(graph), len(graph.strings), argv[0]))
+
+
+class GLuaExportSqlite(gdb.Command):
+    """glua_export_sqlite [lua_State*] file
+Export the heap graph to a sqlite database for ad-hoc queries. The 'objects' table holds the id, address, kind, size,
+name, metatable and weak mode of the gc objects, 'edges' the references between them named by the table keys or
+upvalue names, or indexed by the integer keys, 'protos' the fields of the function prototypes, and 'strings' the
+names and the sources by id. The file is overwritten."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_export_sqlite", gdb.COMMAND_DATA, gdb.COMPLETE_FILENAME)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        if len(argv) > 1:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            argv = argv[1:]
+        elif len(argv) == 1:
+            L = gdb.parse_and_eval("L")
+        else:
+            raise gdb.GdbError("Usage: glua_export_sqlite [lua_State*] file")
+        if sqlite3 is None:
+            raise gdb.GdbError("The python of gdb is built without sqlite3")
+
+        G = lua_getglobalstate(L)
+        if os.path.exists(argv[0]):
+            os.remove(argv[0])
+        conn = sqlite3.connect(argv[0])
+        try:
+            edges = lua_exportsqlite(G, conn)
+        finally:
+            conn.close()
+        graph = LuaHeapGraph.get(G, True)
+        print("%d objects, %d edges, %d strings written to %s" % (len(graph), edges, len(graph.strings), argv[0]))
 
 
 class GLuaBreak(gdb.Command):
-    """glua_break [lua_State*] filename line
-Create a read watch breakpoint in the bytecode of function prototype at the specific source location."""
+    """glua_break [-s] [lua_State*] filename line [if condition]
+Create a read watch breakpoint in the bytecode of function prototype at the specific source location.
+With -s or a condition a software breakpoint checked in the VM dispatch loop is created instead, which has no count
+limit. The condition is a variable path optionally compared with a literal, e.g. 'if req.method == "GET"'."""
 
     def __init__(self):
         gdb.Command.__init__(self, "glua_break", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
 
     def invoke(self, args, _from_tty):
+        args, _, condition = args.partition(" if ")
+        condition = LuaCondition(condition) if len(condition.strip()) > 0 else None
         argv = gdb.string_to_argv(args)
+        software = (len(argv) > 0 and argv[0] == "-s") or condition is not None
+        if len(argv) > 0 and argv[0] == "-s":
+            argv = argv[1:]
         if len(argv) > 2:
             t = gdb.lookup_type("lua_State").pointer()
             L = gdb.parse_and_eval(argv[0]).cast(t)
@@ -2043,48 +5613,27 @@ Create a read watch breakpoint in the bytecode of function prototype at the spec
             filename = argv[0]
             line = int(argv[1])
 
-        G = lua_getglobalstate(L)
-
-        # iterator all the Proto*
-        cnt = 0
-        tu = gdb.lookup_type("union GCUnion").pointer()
-        obj = G["allgc"].cast(tu)
-        while obj:
-            tag = obj["gc"]["tt"]
-            tnov = tag & 0x0F
-            if tnov == LUA_TPROTO:
-                f = obj["p"]
-                if f["source"]:
-                    ts_src = TStringWrapper(f["source"].dereference())
-                    if int(ts_src.get_buffer()[0]) & 0xFF == ord('@'):
-                        src = ts_src.to_string()
-                        if os.path.basename(src[1:]) == filename:
-                            # looking for lineinfo
-                            if f["lineinfo"]:
-                                for i in range(0, int(f["sizelineinfo"])):
-                                    if f["lineinfo"][i] == line:
-                                        if i < f["sizecode"]:
-                                            cnt += 1
-                                            if cnt >= 4:
-                                                print("Too many breakpoint found, abort")
-                                                return
-                                            addr = f["code"] + i
-                                            src_id = lua_chunkid(src, LUA_IDSIZE)
-                                            print("Breakpoint at 0x%x: %s:%d" % (addr, src_id, line))
-                                            gdb.execute("rwatch *(int*)%s" % addr)
-                                            break
-            obj = obj["gc"]["next"].cast(tu)
+        index = LuaSourceIndex.get(lua_getglobalstate(L))
+        found = lua_indexedlocations(index, index.match_file(filename), line, software)
+        lua_setbreakpoints("%s:%d" % (filename, line), found, software, condition)
 
 
 class GLuaBreakRegex(gdb.Command):
-    """glua_breakr [lua_State*] regex line
-Create a read watch breakpoint in the bytecode of function prototype at the specific source location."""
+    """glua_breakr [-s] [lua_State*] regex line [if condition]
+Create a read watch breakpoint in the bytecode of function prototype at the specific source location.
+With -s or a condition a software breakpoint checked in the VM dispatch loop is created instead, which has no count
+limit. The condition is a variable path optionally compared with a literal, e.g. 'if req.method == "GET"'."""
 
     def __init__(self):
         gdb.Command.__init__(self, "glua_breakr", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
 
     def invoke(self, args, _from_tty):
+        args, _, condition = args.partition(" if ")
+        condition = LuaCondition(condition) if len(condition.strip()) > 0 else None
         argv = gdb.string_to_argv(args)
+        software = (len(argv) > 0 and argv[0] == "-s") or condition is not None
+        if len(argv) > 0 and argv[0] == "-s":
+            argv = argv[1:]
         if len(argv) > 2:
             t = gdb.lookup_type("lua_State").pointer()
             L = gdb.parse_and_eval(argv[0]).cast(t)
@@ -2097,35 +5646,549 @@ Create a read watch breakpoint in the bytecode of function prototype at the spec
 
         regex = re.compile(regex, re.IGNORECASE)
 
-        G = lua_getglobalstate(L)
+        index = LuaSourceIndex.get(lua_getglobalstate(L))
+        found = lua_indexedlocations(index, index.match_regex(regex), line, software)
+        lua_setbreakpoints("%s:%d" % (regex.pattern, line), found, software, condition)
+
+
+class GLuaBreakFunc(gdb.Command):
+    """glua_break_func [lua_State*] name|filename:linedefined [if condition]
+Create a software breakpoint at the first instruction of a Lua function.
+The name like 'module.func' or 'Class:method' is resolved through _G and package.loaded, the anonymous functions
+are found by the source file and the line where they are defined. A native breakpoint is set for C functions, they
+can not have a condition.
+The breakpoint is hit again whenever a loop jumps back to the first instruction, e.g. a function made of a single
+'while' loop, a warning is printed for such functions."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_break_func", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        args, _, condition = args.partition(" if ")
+        condition = LuaCondition(condition) if len(condition.strip()) > 0 else None
+        argv = gdb.string_to_argv(args)
+        if len(argv) > 1:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            target = argv[1]
+        elif len(argv) == 1:
+            L = gdb.parse_and_eval("L")
+            target = argv[0]
+        else:
+            raise gdb.GdbError("Usage: glua_break_func [lua_State*] name|filename:linedefined [if condition]")
+
+        found = []
+        protos = []
+        m = re.match(r"^(.+):(\d+)$", target)
+        if m is not None:
+            index = LuaSourceIndex.get(lua_getglobalstate(L))
+            linedefined = int(m.group(2))
+            proto_ptr = gdb.lookup_type("Proto").pointer()
+            for addr, source, code in index.find_function(index.match_file(m.group(1)), linedefined):
+                found.append((code, "%s:%d" % (lua_chunkid(source, LUA_IDSIZE), linedefined)))
+                protos.append(gdb.Value(addr).cast(proto_ptr))
+        else:
+            v = lua_resolvefunction(L, target)
+            if v is None:
+                raise gdb.GdbError("Function %s not found" % target)
+            t = TValueWrapper(v)
+            if not t.is_lua_closure():
+                if condition is not None:
+                    raise gdb.GdbError("%s is a C function, conditions are only supported on Lua functions" % target)
+                f = t.get_light_c_function() if t.is_light_c_function() else t.get_c_closure_value()["f"]
+                print("%s is a C function" % target)
+                gdb.Breakpoint("*0x%x" % long(f))
+                return
+            p = t.get_lua_closure_value()["p"]
+            src = TStringWrapper(p["source"].dereference()).to_string() if p["source"] else "=?"
+            found.append((long(p["code"]), "%s:%d" % (lua_chunkid(src, LUA_IDSIZE), int(p["linedefined"]))))
+            protos.append(p)
+        lua_setbreakpoints(target, found, True, condition)
+        for p, (_, src_id) in zip(protos, found):
+            if lua_loopstoentry(p):
+                print("Warning: a loop of %s jumps back to its first instruction, it is hit at every iteration too" %
+                      src_id)
+
+
+class GLuaLines(gdb.Command):
+    """glua_lines [lua_State*] filename [line]
+List the Protos defined in the source file and the bytecode addresses where each line starts."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_lines", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        L = None
+        if len(argv) > 2 or (len(argv) == 2 and not argv[1].isdigit()):
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            argv = argv[1:]
+        if len(argv) == 0:
+            raise gdb.GdbError("Usage: glua_lines [lua_State*] filename [line]")
+        if L is None:
+            L = gdb.parse_and_eval("L")
+        filename = argv[0]
+        line = int(argv[1]) if len(argv) > 1 else None
+
+        index = LuaSourceIndex.get(lua_getglobalstate(L))
+        for source in index.match_file(filename):
+            for addr in sorted(index.sources[source], key=lambda a: index.protos[a][1]):
+                _, linedefined, lastlinedefined, lines, _ = index.protos[addr]
+                if line is not None and line not in lines:
+                    continue
+                print("(Proto *) 0x%x %s:%d-%d" % (addr, lua_chunkid(source, LUA_IDSIZE), linedefined, lastlinedefined))
+                for l in ([line] if line is not None else sorted(lines.keys())):
+                    print("\t%d\t%s" % (l, ", ".join("0x%x" % a for a in lines[l])))
+
+
+class GLuaBreakpoints(gdb.Command):
+    """glua_breakpoints
+List the software Lua breakpoints."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_breakpoints", gdb.COMMAND_BREAKPOINTS, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        bps = LuaBreakpointEngine.breakpoints
+        if len(bps) == 0:
+            print("No Lua breakpoints.")
+            return
+        print("Num\tEnb\tHits\tLocations\tWhere")
+        for number in sorted(bps.keys()):
+            bp = bps[number]
+            print("%d\t%s\t%d\t%d\t\t%s" % (number, "y" if bp.enabled else "n", bp.hit_count, len(bp.addresses),
+                                            bp.location))
+            if bp.condition is not None:
+                print("\tstop only if %s" % bp.condition.text)
+            if bp.ignore_count > 0:
+                print("\twill ignore next %d hits" % bp.ignore_count)
+
+
+class GLuaCondition(gdb.Command):
+    """glua_condition number [condition]
+Set the condition of a software Lua breakpoint, or remove it if no condition is given."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_condition", gdb.COMMAND_BREAKPOINTS, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        number, _, condition = args.strip().partition(" ")
+        bp = LuaBreakpointEngine.breakpoints.get(int(number)) if number.isdigit() else None
+        if bp is None:
+            raise gdb.GdbError("No Lua breakpoint number %s." % number)
+        if len(condition.strip()) > 0:
+            bp.condition = LuaCondition(condition)
+        else:
+            bp.condition = None
+            print("Lua breakpoint %d now unconditional." % bp.number)
+
+
+class GLuaIgnore(gdb.Command):
+    """glua_ignore number count
+Ignore the next 'count' hits of a software Lua breakpoint, the hits rejected by its condition are not counted."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_ignore", gdb.COMMAND_BREAKPOINTS, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        if len(argv) != 2:
+            raise gdb.GdbError("Usage: glua_ignore number count")
+        bp = LuaBreakpointEngine.breakpoints.get(int(argv[0]))
+        if bp is None:
+            raise gdb.GdbError("No Lua breakpoint number %s." % argv[0])
+        bp.ignore_count = max(0, int(argv[1]))
+        print("Will ignore next %d crossings of Lua breakpoint %d." % (bp.ignore_count, bp.number))
+
+
+class GLuaDelete(gdb.Command):
+    """glua_delete [number...]
+Delete the software Lua breakpoints, or all of them if no number is given."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_delete", gdb.COMMAND_BREAKPOINTS, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        numbers = [int(a) for a in argv] if len(argv) > 0 else list(LuaBreakpointEngine.breakpoints.keys())
+        for number in numbers:
+            if number not in LuaBreakpointEngine.breakpoints:
+                raise gdb.GdbError("No Lua breakpoint number %d." % number)
+            lua_deletebreakpoint(number)
+
+
+class GLuaDisasm(gdb.Command):
+    """glua_disasm closure|Proto*|CallInfo* [first[-last]]
+Print the bytecode listing of a Lua function like 'luac -l', with the current instruction marked for a CallInfo.
+The listing is cached by the address of the Proto."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_disasm", gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        if len(argv) == 0:
+            raise gdb.GdbError("Usage: glua_disasm closure|Proto*|CallInfo* [first[-last]]")
+        p, ci = lua_toproto(gdb.parse_and_eval(argv[0]))
+        first, last = 0, None
+        if len(argv) > 1:
+            m = re.match(r"^(\d+)(?:-(\d+))?$", argv[1])
+            if m is None:
+                raise gdb.GdbError("Invalid pc range %s" % argv[1])
+            first = int(m.group(1)) - 1
+            last = int(m.group(2)) - 1 if m.group(2) is not None else first
+
+        listing = LuaDisassembly.get(p)
+        for line in listing.header:
+            print(line)
+        current = ci.get_current_pc() if ci is not None else None
+        for line in listing.format(first, last, current):
+            print(line)
+
+
+class GLuaProfile(gdb.Command):
+    """glua_profile [-n] [-o file] [lua_State*] seconds hz
+Sample the Lua stack of the selected thread 'hz' times per second and print the folded stacks.
+With -n the native frames are sampled too. With lua_State* only the stack of that state is sampled."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_profile", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        native = False
+        output = None
+        while len(argv) > 0 and argv[0].startswith("-"):
+            opt = argv.pop(0)
+            if opt == "-n":
+                native = True
+            elif opt == "-o" and len(argv) > 0:
+                output = argv.pop(0)
+            else:
+                raise gdb.GdbError("Unknown option %s" % opt)
+        if len(argv) > 2:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            argv = argv[1:]
+        elif len(argv) == 2:
+            L = None
+        else:
+            raise gdb.GdbError("Usage: glua_profile [-n] [-o file] [lua_State*] seconds hz")
+        seconds = float(argv[0])
+        hz = float(argv[1])
+
+        sampler = LuaStackSampler(L, native)
+        for _ in lua_sampleinferior(seconds, hz):
+            sampler.sample()
+
+        lines = ["%s %d" % (";".join(frames) if len(frames) > 0 else "[idle]", count)
+                 for frames, count in sampler.symbolize()]
+        if output is not None:
+            with open(output, "w") as f:
+                for line in lines:
+                    f.write(line + "\n")
+            print("%d samples written to %s" % (sampler.count, output))
+        else:
+            for line in lines:
+                print(line)
+            print("%d samples" % sampler.count, file=sys.stderr)
+
+
+class GLuaHotspot(gdb.Command):
+    """glua_hotspot [-n top] [-o file] [lua_State*] seconds hz
+Sample the running instruction of the selected thread 'hz' times per second and print the hottest functions with
+their bytecode listing and source lines annotated by the sample percentages."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_hotspot", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        top = 5
+        output = None
+        while len(argv) > 0 and argv[0].startswith("-"):
+            opt = argv.pop(0)
+            if opt == "-n" and len(argv) > 0:
+                top = int(argv.pop(0))
+            elif opt == "-o" and len(argv) > 0:
+                output = argv.pop(0)
+            else:
+                raise gdb.GdbError("Unknown option %s" % opt)
+        if len(argv) > 2:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+            argv = argv[1:]
+        elif len(argv) == 2:
+            L = None
+        else:
+            raise gdb.GdbError("Usage: glua_hotspot [-n top] [-o file] [lua_State*] seconds hz")
+        seconds = float(argv[0])
+        hz = float(argv[1])
+
+        sampler = LuaStackSampler(L)
+        hotspots = LuaHotspots()
+        for _ in lua_sampleinferior(seconds, hz):
+            hotspots.add(sampler.capture_lua_top())
+        LuaHotspots.last = hotspots
+
+        if output is not None:
+            with open(output, "w") as f:
+                for line in hotspots.report(top):
+                    f.write(line + "\n")
+            print("%d samples written to %s" % (hotspots.count, output))
+        else:
+            for line in hotspots.report(top):
+                print(line)
+
+
+class GLuaPerfCheck(gdb.Command):
+    """glua_perfcheck [-n top] [lua_State*]
+Scan the bytecode of all the loaded functions for global lookups, table constructors, closures and concatenations
+inside loops. The functions are ranked by the samples of the last glua_hotspot if any, then by loop nesting."""
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_perfcheck", gdb.COMMAND_DATA, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        top = 20
+        if len(argv) > 1 and argv[0] == "-n":
+            top = int(argv[1])
+            argv = argv[2:]
+        if len(argv) > 0:
+            t = gdb.lookup_type("lua_State").pointer()
+            L = gdb.parse_and_eval(argv[0]).cast(t)
+        else:
+            L = gdb.parse_and_eval("L")
+
+        index = LuaSourceIndex.get(lua_getglobalstate(L))
+        hotspots = LuaHotspots.last
+        hot_protos = hotspots.by_proto() if hotspots is not None else {}
+        proto_ptr = gdb.lookup_type("Proto").pointer()
+
+        results = []
+        for proto in index.protos.keys():
+            smells = lua_findloopsmells(gdb.Value(proto).cast(proto_ptr))
+            if len(smells) > 0:
+                hot = sum(hotspots.samples.get((proto, pc), 0) for pc, _, _, _ in smells) \
+                    if hotspots is not None else 0
+                depth = max(depth for _, depth, _, _ in smells)
+                results.append(((-hot_protos.get(proto, 0), -hot, -depth, -len(smells)), proto, smells))
+        results.sort(key=lambda r: r[0])
+
+        print("%d of %d functions allocate or look up globals inside loops" % (len(results), len(index.protos)))
+        for _, proto, smells in results[0:top]:
+            source, linedefined, _, _, _ = index.protos[proto]
+            p = gdb.Value(proto).cast(proto_ptr)
+            title = "\n(Proto *) 0x%x %s:%d" % (proto, lua_chunkid(source, LUA_IDSIZE), linedefined)
+            if hotspots is not None and hotspots.count > 0:
+                title += " [%.1f%% samples]" % (100.0 * hot_protos.get(proto, 0) / hotspots.count)
+            print(title)
+            for pc, depth, smell, detail in sorted(smells, key=lambda s: (-s[1], s[0])):
+                line = int(p["lineinfo"][pc]) if p["lineinfo"] and pc < int(p["sizelineinfo"]) else -1
+                hot = ""
+                if hotspots is not None and hotspots.count > 0:
+                    hot = " %.1f%%" % (100.0 * hotspots.samples.get((proto, pc), 0) / hotspots.count)
+                print("\tline %d\tdepth %d\t%s %s%s" % (line, depth, smell, detail, hot))
+
+
+class GLuaReport(gdb.Command):
+    """glua_report [-L lua_State*] [-n top] [-o file] report...
+Print the reports as JSON, available reports are: traceback, objectinfo, topobjects, closures, classes,
+threads, refs, gcqueues, gcstate.
+If lua_State* is not given, the variable 'L' is looked up in the frames of all the threads."""
+
+    REPORTS = ("traceback", "objectinfo", "topobjects", "closures", "classes", "threads", "refs", "gcqueues",
+               "gcstate")
+
+    def __init__(self):
+        gdb.Command.__init__(self, "glua_report", gdb.COMMAND_STACK, gdb.COMPLETE_NONE)
+
+    def invoke(self, args, _from_tty):
+        argv = gdb.string_to_argv(args)
+        L = None
+        top = 20
+        output = None
+        while len(argv) > 0 and argv[0].startswith("-"):
+            opt = argv.pop(0)
+            if opt == "-L" and len(argv) > 0:
+                t = gdb.lookup_type("lua_State").pointer()
+                L = gdb.parse_and_eval(argv.pop(0)).cast(t)
+            elif opt == "-n" and len(argv) > 0:
+                top = int(argv.pop(0))
+            elif opt == "-o" and len(argv) > 0:
+                output = argv.pop(0)
+            else:
+                raise gdb.GdbError("Unknown option %s" % opt)
+        reports = argv if len(argv) > 0 else list(GLuaReport.REPORTS)
+        for name in reports:
+            if name not in GLuaReport.REPORTS:
+                raise gdb.GdbError("Unknown report %s" % name)
+
+        result = {}
+        for name in reports:
+            try:
+                if name == "traceback":
+                    result[name] = lua_report_traceback()
+                    continue
+                if L is None:
+                    L = lua_findstate()
+                G = lua_getglobalstate(L)
+                if name == "objectinfo":
+                    result[name] = lua_report_objectinfo(G)
+                elif name == "topobjects":
+                    result[name] = lua_report_topobjects(G, top)
+                elif name == "closures":
+                    result[name] = lua_report_closures(G, top)
+                elif name == "classes":
+                    result[name] = lua_report_classes(G, top)
+                elif name == "threads":
+                    result[name] = lua_report_threads(G, top, L)
+                elif name == "refs":
+                    result[name] = lua_report_refs(G)
+                elif name == "gcqueues":
+                    result[name] = lua_report_gcqueues(G, top)
+                elif name == "gcstate":
+                    result[name] = lua_gcstate(G)
+            except (RuntimeError, gdb.error, gdb.GdbError) as e:
+                result[name] = {"error": str(e)}
+
+        if output is not None:
+            with open(output, "w") as f:
+                json.dump(result, f)
+        else:
+            print(json.dumps(result, indent=2))
+
+
+# Frame filters
+
+
+LUA_VM_EXECUTE_FUNCTION = "luaV_execute"
+LUA_VM_CALL_FUNCTION = "luaD_call"
 
-        # iterator all the Proto*
-        cnt = 0
-        tu = gdb.lookup_type("union GCUnion").pointer()
-        obj = G["allgc"].cast(tu)
-        while obj:
-            tag = obj["gc"]["tt"]
-            tnov = tag & 0x0F
-            if tnov == LUA_TPROTO:
-                f = obj["p"]
-                if f["source"]:
-                    src = TStringWrapper(f["source"].dereference()).to_string()
-                    if regex.match(src):
-                        # looking for lineinfo
-                        if f["lineinfo"]:
-                            for i in range(0, int(f["sizelineinfo"])):
-                                if f["lineinfo"][i] == line:
-                                    if i < f["sizecode"]:
-                                        cnt += 1
-                                        if cnt >= 4:
-                                            print("Too many breakpoint found, abort")
-                                            return
-                                        addr = f["code"] + i
-                                        src_id = lua_chunkid(src, LUA_IDSIZE)
-                                        print("Breakpoint at 0x%x: %s:%d" % (addr, src_id, line))
-                                        gdb.execute("rwatch *(int*)%s" % addr)
-                                        break
-            obj = obj["gc"]["next"].cast(tu)
+
+class LuaFrameDecorator(FrameDecorator):
+    """A Lua CallInfo shown as an elided frame of the native frame which runs it."""
+
+    def __init__(self, base, L, ci):
+        FrameDecorator.__init__(self, base)
+        self.L = L
+        self.ci = ci
+        self.ar = None
+
+    def get_info(self):
+        if self.ar is None:  # decode only when gdb really prints this frame
+            self.ar = lua_getinfo(self.L, "nSlt", self.ci.dereference())
+        return self.ar
+
+    def function(self):
+        ar = self.get_info()
+        if ar.what == "main":
+            name = "[Main chunk]"
+        elif ar.what == "C":
+            name = str(ar.address)
+        else:
+            name = ar.name
+        if ar.istailcall:
+            name += " (tailcall)"
+        return "[lua] %s" % name
+
+    def filename(self):
+        ar = self.get_info()
+        return ar.short_src if len(ar.short_src) > 0 else None
+
+    def line(self):
+        ar = self.get_info()
+        return ar.currentline if ar.currentline >= 0 else None
+
+    def address(self):
+        return None
+
+    def frame_args(self):
+        return None
+
+    def frame_locals(self):
+        return None
+
+    def elided(self):
+        return None
+
+
+class LuaVMFrameDecorator(FrameDecorator):
+    """A luaV_execute/luaD_call frame with its Lua frames attached."""
+
+    def __init__(self, base, lua_frames):
+        FrameDecorator.__init__(self, base)
+        self.lua_frames = lua_frames
+
+    def elided(self):
+        return iter(self.lua_frames)
+
+
+def lua_pairframes(items, to_frame=lambda item: item, c_functions=False):
+    # yields (item, L, [(CallInfo*, callstatus)]) for each native frame with the CallInfos it runs
+    # luaV_execute runs the CallInfos from L->ci down to the first one flagged CIST_FRESH, C functions called by
+    # OP_CALL are native frames above it, they are paired with the luaV_execute too if 'c_functions' is set.
+    # luaD_call which is not the entry of a luaV_execute runs one C function.
+    cursors = {}
+    entered = set()
+    for item in items:
+        frame = to_frame(item)
+        name = frame.name()
+        if name != LUA_VM_EXECUTE_FUNCTION and name != LUA_VM_CALL_FUNCTION:
+            yield item, None, []
+            continue
+        try:
+            L = frame.read_var("L")
+            key = long(L)
+            chain = lua_getcallinfochain(L)
+        except (ValueError, RuntimeError, gdb.error):
+            yield item, None, []
+            continue
+
+        pos = cursors.get(key, 0)
+        cis = []
+        if name == LUA_VM_EXECUTE_FUNCTION:
+            while pos < len(chain) and (chain[pos][1] & CIST_LUA) == 0:
+                if c_functions:
+                    cis.append(chain[pos])
+                pos += 1
+            while pos < len(chain) and (chain[pos][1] & CIST_LUA) != 0:
+                cis.append(chain[pos])
+                pos += 1
+                if (cis[-1][1] & CIST_FRESH) != 0:
+                    break
+            entered.add(key)
+        elif key in entered:
+            entered.remove(key)
+        elif pos < len(chain) and (chain[pos][1] & CIST_LUA) == 0:
+            cis.append(chain[pos])
+            pos += 1
+        cursors[key] = pos
+        yield item, L, cis
+
+
+def lua_interleaveframes(frame_iter):
+    for decorator, L, cis in lua_pairframes(frame_iter, lambda d: d.inferior_frame()):
+        if len(cis) > 0:
+            frame = decorator.inferior_frame()
+            yield LuaVMFrameDecorator(decorator, [LuaFrameDecorator(frame, L, ci) for ci, _ in cis])
+        else:
+            yield decorator
+
+
+class LuaFrameFilter:
+    """Interleaves the Lua frames into the native backtrace."""
+
+    def __init__(self):
+        self.name = "glua"
+        self.priority = 100
+        self.enabled = True
+        gdb.frame_filters[self.name] = self
+
+    def filter(self, frame_iter):
+        return lua_interleaveframes(frame_iter)
 
 
 # Main
@@ -2171,6 +6234,17 @@ def printer_lookup_function(value):
 gdb.pretty_printers.insert(0, printer_lookup_function)
 
 
+# invalidate caches
+gdb.events.cont.connect(StopCache.invalidate)
+gdb.events.exited.connect(StopCache.invalidate)
+gdb.events.exited.connect(LuaGCTracer.stop)
+gdb.events.new_objfile.connect(StopCache.invalidate)
+gdb.events.exited.connect(LuaSourceIndex.reset)
+gdb.events.new_objfile.connect(LuaSourceIndex.reset)
+gdb.events.exited.connect(LuaDisassembly.reset)
+gdb.events.new_objfile.connect(LuaDisassembly.reset)
+
+
 # register functions
 LuaGetGlobalState()
 LuaNilObject()
@@ -2192,5 +6266,35 @@ LuaGetMetatable()
 GLuaTraceback()
 GLuaStackInfo()
 GLuaObjectInfo()
+GLuaClosures()
+GLuaClasses()
+GLuaThreads()
+GLuaRefs()
+GLuaGCQueues()
+GLuaGCState()
+GLuaGCTrace()
+GLuaAllocProf()
+GLuaWatchMem()
+GLuaReferrers()
+GLuaFind()
+GLuaModules()
+GLuaDump()
+GLuaHeapSnapshot()
+GLuaExportSqlite()
 GLuaBreak()
 GLuaBreakRegex()
+GLuaBreakFunc()
+GLuaLines()
+GLuaBreakpoints()
+GLuaCondition()
+GLuaIgnore()
+GLuaDelete()
+GLuaDisasm()
+GLuaProfile()
+GLuaHotspot()
+GLuaPerfCheck()
+GLuaReport()
+
+
+# register frame filters
+LuaFrameFilter()
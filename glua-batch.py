@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Batch post-mortem driver for GDB Lua5.3 Extension
+# Author: chu <1871361697@qq.com>
+# Github: http://github.com/9chu
+#
+# Usage:
+#   glua-batch.py [-j jobs] [-t timeout] [-r reports] [-o summary.json] executable core...
+#
+# Every core file is analysed by a 'gdb -batch' worker running 'glua_report', the results are merged into one summary.
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import concurrent.futures
+
+EXTENSION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gdb-lua-ext.py")
+DEFAULT_REPORTS = "traceback,objectinfo,topobjects"
+
+
+def gdb_quote(arg):
+    # quotes an argument for gdb.string_to_argv
+    return '"%s"' % arg.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def run_worker(gdb, executable, core, reports, state, top, timeout):
+    fd, output = tempfile.mkstemp(prefix="glua-", suffix=".json")
+    os.close(fd)
+    report_cmd = "glua_report -n %d -o %s" % (top, gdb_quote(output))
+    if state is not None:
+        report_cmd += " -L %s" % gdb_quote(state)
+    report_cmd += " " + " ".join(reports)
+    cmd = [gdb, "-batch", "-nx", "-ex", "source %s" % EXTENSION_PATH, "-ex", report_cmd, executable, core]
+
+    result = {"core": core}
+    start = time.time()
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout,
+                              universal_newlines=True)
+        result["elapsed"] = time.time() - start
+        if os.path.getsize(output) == 0:
+            result["status"] = "failed"
+            lines = proc.stderr.strip().splitlines()
+            result["error"] = lines[-1] if len(lines) > 0 else "gdb exited with %d" % proc.returncode
+        else:
+            with open(output, "r") as f:
+                result["status"] = "ok"
+                result["report"] = json.load(f)
+    except subprocess.TimeoutExpired:
+        result["elapsed"] = time.time() - start
+        result["status"] = "timeout"
+    finally:
+        os.remove(output)
+    return result
+
+
+def top_lua_frame(thread):
+    for frame in thread["frames"]:
+        if "lua" in frame:
+            return frame["lua"]
+    return None
+
+
+def merge(results):
+    summary = {"ok": 0, "failed": 0, "timeout": 0, "objects": {}, "total_bytes": 0, "top_lua_frames": {}}
+    for result in results:
+        summary[result["status"]] += 1
+        report = result.get("report")
+        if report is None:
+            continue
+        objectinfo = report.get("objectinfo")
+        if objectinfo is not None and "error" not in objectinfo:
+            for kind, item in objectinfo["objects"].items():
+                merged = summary["objects"].setdefault(kind, {"count": 0, "bytes": 0})
+                merged["count"] += item["count"]
+                merged["bytes"] += item["bytes"]
+            summary["total_bytes"] += objectinfo["total_bytes"]
+        traceback = report.get("traceback")
+        if isinstance(traceback, list):
+            for thread in traceback:
+                frame = top_lua_frame(thread)
+                if frame is not None:
+                    summary["top_lua_frames"][frame] = summary["top_lua_frames"].get(frame, 0) + 1
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run glua reports over many core dumps in parallel.")
+    parser.add_argument("executable", help="the executable which produced the core dumps")
+    parser.add_argument("cores", nargs="+", help="core dump files")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of gdb workers")
+    parser.add_argument("-t", "--timeout", type=float, default=600, help="timeout in seconds for each core")
+    parser.add_argument("-r", "--reports", default=DEFAULT_REPORTS, help="comma separated glua_report reports")
+    parser.add_argument("-L", "--state", default=None, help="lua_State* expression, default to find 'L' in frames")
+    parser.add_argument("-n", "--top", type=int, default=20, help="number of objects in the topobjects report")
+    parser.add_argument("-o", "--output", default=None, help="write the summary to this file instead of stdout")
+    parser.add_argument("--gdb", default="gdb", help="gdb executable")
+    args = parser.parse_args()
+
+    reports = [r for r in args.reports.split(",") if r]
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_worker, args.gdb, args.executable, core, reports, args.state, args.top,
+                                   args.timeout) for core in args.cores]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            print("%s: %s (%.1fs)" % (result["core"], result["status"], result["elapsed"]), file=sys.stderr)
+            results.append(result)
+    results.sort(key=lambda r: r["core"])
+
+    summary = {"summary": merge(results), "cores": results}
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    else:
+        print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()